@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Automatic choice between an incremental (`dnb.sh :r`) and a full (`dnb.sh :b`)
+build.
+
+A full build runs ifs-bundle again and is only needed when one of its inputs
+changed: the generated overrides.yaml and account.yaml, the machine file, the
+bundle branch/version (including the settings exported per build variant) and
+bundle.yml. The digests of these inputs are written next to the build on the
+remote by the build job itself, once `dnb.sh` succeeded, one record per
+sandbox (`ifsnemo-build/.ifsnemo_build_fingerprint.<sandbox>.json`). The next
+run compares its own inputs with that record and picks `:r` when none of them
+changed, i.e. when only sources did.
+"""
+import hashlib
+import json
+from pathlib import Path
+from shlex import quote
+
+FINGERPRINT_PREFIX = ".ifsnemo_build_fingerprint"
+
+# Overrides naming the bundle branch/version, recorded in clear for the reasons
+BUNDLE_VERSION_KEYS = ("DNB_IFSNEMO_BUNDLE_BRANCH", "IFS_BUNDLE_IFS_SOURCE_VERSION")
+
+
+def file_digest(path: Path):
+    """Return the sha256 of a file, None if it does not exist."""
+    try:
+        return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def input_fingerprint(local_path: Path, machine_file: str, variant: dict) -> dict:
+    """
+    Digest the inputs of ifs-bundle for one build variant.
+
+    Args:
+        local_path: Local build directory holding the generated files and src/
+        machine_file: Machine file of the pipeline YAML, relative to local_path
+        variant: Build variant (see pipeline.load_variants), with its `env`
+
+    Returns:
+        Dictionary {input name: digest or value}
+    """
+    local_path = Path(local_path)
+    bundles = hashlib.sha256()
+    for path in sorted(local_path.glob("src/*/bundle.yml")):
+        bundles.update(f"{path.relative_to(local_path)}\0{file_digest(path)}\n".encode())
+    return {
+        "overrides.yaml": file_digest(local_path / "overrides.yaml"),
+        "account.yaml": file_digest(local_path / "account.yaml"),
+        "machine file": file_digest(local_path / machine_file) if machine_file else None,
+        "bundle version": {k: variant["overrides"][k] for k in BUNDLE_VERSION_KEYS if variant["overrides"].get(k)},
+        "variant settings": hashlib.sha256("\n".join(variant.get("env") or []).encode()).hexdigest(),
+        "bundle.yml": bundles.hexdigest(),
+    }
+
+
+def fingerprint_path(remote_build_dir: str, sandbox: str) -> str:
+    """Remote record of the last successful build of `sandbox`."""
+    name = (sandbox or "default").strip("/").replace("/", "_")
+    return f"{remote_build_dir}/{FINGERPRINT_PREFIX}.{name}.json"
+
+
+def read_fingerprint(run, path: str):
+    """Read a build record with `run` (a command runner); None if missing or invalid."""
+    code, out = run(f"cat {quote(path)}")
+    if code != 0:
+        return None
+    try:
+        record = json.loads(out)
+    except ValueError:
+        return None
+    return record if isinstance(record, dict) and isinstance(record.get("inputs"), dict) else None
+
+
+def decide_build(inputs: dict, previous: dict, forced: str = None) -> dict:
+    """
+    Pick the dnb.sh build command for `inputs`.
+
+    Args:
+        inputs: Current input fingerprint (input_fingerprint)
+        previous: Record of the last successful build, None if there is none
+        forced: "partial" or "full" to override the choice (--partial-build,
+            --full-build)
+
+    Returns:
+        Dictionary {"build_cmd", "reason", "changed"}
+    """
+    if previous is None:
+        changed = None
+        reason = "no successful build of this sandbox recorded on the remote"
+        build_cmd = ":b"
+    else:
+        old = previous["inputs"]
+        changed = sorted(k for k in set(inputs) | set(old) if inputs.get(k) != old.get(k))
+        if changed:
+            reason = f"changed since the last successful build (run {previous.get('run', '?')}): {', '.join(changed)}"
+            build_cmd = ":b"
+        else:
+            reason = f"bundle inputs unchanged since the last successful build (run {previous.get('run', '?')}), only sources may have changed"
+            build_cmd = ":r"
+    if forced:
+        auto_cmd, build_cmd = build_cmd, ":r" if forced == "partial" else ":b"
+        reason = f"--{forced}-build given; the automatic choice would be dnb.sh {auto_cmd} ({reason})"
+    return {"build_cmd": build_cmd, "reason": reason, "changed": changed}
+
+
+def record_command(path: str, inputs: dict, run_id: str, build_cmd: str) -> str:
+    """Shell command writing the record of a successful build to `path`."""
+    record = {"inputs": inputs, "run": run_id, "build_cmd": build_cmd}
+    return f"printf '%s\\n' {quote(json.dumps(record, sort_keys=True))} > {quote(path)}"
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Stage ledger for checkpointing and resuming pipeline runs.
+
+The ledger is a JSON file in the results run directory recording the options
+of the run and the state of each stage (references fetched, bundle
+downloaded, synced, build job, install, every suite command). A run started
+with `pipeline.py --resume <run_dir>` skips the stages marked done and
+reattaches to a build job that is still in the queue.
+"""
+import json
+import os
+import threading
+from datetime import datetime
+from pathlib import Path
+
+LEDGER_FILENAME = "stage_ledger.json"
+
+DONE = "done"
+STARTED = "started"
+
+
+class StageLedger:
+    """Persistent record of the stages of one pipeline run."""
+
+    def __init__(self, run_dir: Path, data: dict = None):
+        self.path = Path(run_dir) / LEDGER_FILENAME
+        self.data = data or {"meta": {}, "stages": {}}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, run_dir: Path) -> "StageLedger":
+        """
+        Load the ledger of an existing run directory.
+
+        Raises:
+            FileNotFoundError: If the run directory has no ledger
+        """
+        path = Path(run_dir) / LEDGER_FILENAME
+        if not path.exists():
+            raise FileNotFoundError(f"No stage ledger found in {run_dir}")
+        with open(path) as f:
+            return cls(run_dir, json.load(f))
+
+    @property
+    def meta(self) -> dict:
+        """Options of the run, used to replay it on resume."""
+        return self.data["meta"]
+
+    def set_meta(self, **meta) -> None:
+        with self._lock:
+            self.data["meta"].update(meta)
+            self._save()
+
+    def get(self, name: str) -> dict:
+        """Return the record of a stage, or an empty dict if it never started."""
+        with self._lock:
+            return dict(self.data["stages"].get(name, {}))
+
+    def is_done(self, name: str) -> bool:
+        return self.get(name).get("status") == DONE
+
+    def skip(self, name: str) -> bool:
+        """True (and say so) if the stage was completed by an earlier attempt."""
+        record = self.get(name)
+        if record.get("status") == DONE:
+            print(f"[RESUME] Skipping stage '{name}' (completed {record.get('updated')})")
+            return True
+        return False
+
+    def update(self, name: str, status: str = None, **data) -> None:
+        """Merge `data` into the record of a stage and save the ledger."""
+        with self._lock:
+            record = self.data["stages"].setdefault(name, {})
+            record.update(data)
+            if status:
+                record["status"] = status
+            record["updated"] = datetime.now().isoformat(timespec="seconds")
+            self._save()
+
+    def mark_done(self, name: str, **data) -> None:
+        self.update(name, status=DONE, **data)
+
+    def _save(self) -> None:
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.data, f, indent=4)
+        os.replace(tmp, self.path)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Streaming log capture with a bounded in-memory tail.
+
+Output of long-running commands (psubmit runs, suite commands) is written to
+its log file as it arrives, optionally zstd-compressed, and only the last lines
+are kept in memory. The log can be followed live from another terminal:
+
+    python3 logcapture.py tail -f results/<run>/compare_norms_run-tests_<test_id>.log.zst
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Lines kept in memory for error messages and the returned output
+DEFAULT_TAIL_LINES = 200
+
+# Longest unterminated line kept in memory (e.g. progress bars using \r)
+MAX_PARTIAL_CHARS = 64 * 1024
+
+# Seconds between flushes of a compressed block, so a live tail stays current
+COMPRESS_FLUSH_INTERVAL = 2.0
+
+
+class LogCapture:
+    """
+    File-like sink that streams everything written to it into a log file.
+
+    Args:
+        path: Log file; ".zst" is appended when compressing
+        compress: zstd-compress the log (falls back to plain text if the
+            zstandard module is missing)
+        echo: Also write the output to stdout
+        tail_lines: Number of lines kept in memory
+        atomic: Write to "<path>.part" and only rename it to `path` when closed
+            without an error, so an existing log means a finished command
+    """
+
+    def __init__(self, path, compress=False, echo=True, tail_lines=DEFAULT_TAIL_LINES, atomic=False):
+        if compress and zstandard is None:
+            print("Warning: zstandard is not installed, writing an uncompressed log. Install with: pip install zstandard")
+            compress = False
+        self.path = f"{path}.zst" if compress else str(path)
+        self.partial_path = f"{self.path}.part" if atomic else self.path
+        self.echo = echo
+        self.lines = deque(maxlen=tail_lines)
+        self.bytes_written = 0
+        self._partial = ""
+        self._lock = threading.Lock()
+        self._last_flush = time.time()
+        self._file = open(self.partial_path, "wb")
+        self._writer = zstandard.ZstdCompressor(level=3).stream_writer(self._file) if compress else None
+
+    def write(self, data):
+        """Append `data` (str) to the log and the in-memory tail."""
+        if not data:
+            return 0
+        with self._lock:
+            encoded = data.encode(errors="replace")
+            if self._writer:
+                self._writer.write(encoded)
+                if time.time() - self._last_flush > COMPRESS_FLUSH_INTERVAL:
+                    self._writer.flush(zstandard.FLUSH_BLOCK)
+                    self._file.flush()
+                    self._last_flush = time.time()
+            else:
+                self._file.write(encoded)
+                self._file.flush()
+            self.bytes_written += len(encoded)
+
+            text = self._partial + data
+            *complete, partial = text.split("\n")
+            self.lines.extend(line + "\n" for line in complete)
+            self._partial = partial[-MAX_PARTIAL_CHARS:]
+        if self.echo:
+            sys.stdout.write(data)
+            sys.stdout.flush()
+        return len(data)
+
+    def flush(self):
+        with self._lock:
+            if self._writer:
+                self._writer.flush(zstandard.FLUSH_BLOCK)
+            self._file.flush()
+
+    def tail(self):
+        """The last lines written, including an unterminated last line."""
+        with self._lock:
+            return "".join(self.lines) + self._partial
+
+    def close(self, complete=True):
+        """Close the log; `complete=False` leaves an atomic log at its .part path."""
+        with self._lock:
+            if self._file.closed:
+                return
+            if self._writer:
+                self._writer.flush(zstandard.FLUSH_FRAME)
+            self._file.close()
+            if complete and self.partial_path != self.path:
+                os.replace(self.partial_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(complete=exc_type is None)
+
+
+def follow(path, follow_mode=False, interval=1.0):
+    """Print a (possibly compressed, possibly growing) log file."""
+    decompressor = None
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError("zstandard is required to read compressed logs. Install with: pip install zstandard")
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    out = sys.stdout.buffer
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1 << 16)
+            if chunk:
+                if decompressor:
+                    chunk = decompressor.decompress(chunk)
+                out.write(chunk)
+                out.flush()
+                continue
+            if not follow_mode:
+                return
+            time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read logs written by LogCapture.")
+    subs = parser.add_subparsers(dest="cmd", required=True)
+    p_tail = subs.add_parser("tail", help="Print a log, optionally following it as it grows")
+    p_tail.add_argument("path")
+    p_tail.add_argument("-f", "--follow", action="store_true", help="Keep printing new output")
+    args = parser.parse_args()
+    try:
+        follow(args.path, args.follow)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
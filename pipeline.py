@@ -3,19 +3,40 @@ import yaml
 from shlex import quote
 import subprocess
 from pathlib import Path
-from fabric import Connection
+from fabric import Config, Connection
+from fabric.runners import Remote
 from datetime import datetime
 import shutil
 import time
 import sys
 import argparse
 import json
+import atexit
+import sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from slurm import JobWatcher, job_durations, TERMINAL_STATES, UNKNOWN_STATE
+from delta_sync import delta_sync
+from ssh_mux import ConnectionManager, repeatable
 from test_runner import (
     load_test_definitions,
     validate_test_definitions,
+    tolerance_flags,
     execute_test,
     init_run_directory,
+    use_run_directory,
+    configure_logs,
+    plan_command,
+    step_results,
+    open_log,
 )
+from remote_agent import AgentEventStream, run_remote_plan, ship_plan
+import results_db
+from ledger import StageLedger
+from tracing import tracer
+from reference_mirror import materialize_references
+from reference_stage import stage_references
+from build_fingerprint import input_fingerprint, fingerprint_path, read_fingerprint, decide_build, record_command
 
 # ANSI formatting
 BOLD = '\033[1m'
@@ -27,27 +48,84 @@ def timestamp():
 
 verbose = True
 
-def wait_for_job(conn, job_id, poll_interval=30):
-    while True:
-        try:
-            result = conn.run(f"squeue -j {job_id}", hide=True, warn=True)
-            if job_id not in result.stdout:
-                break
-            timestamp = time.strftime("%H:%M:%S")
-            print(f"\rWaiting for SLURM job {job_id} to complete... (last checked: {timestamp})", end='', flush=True)
-            time.sleep(poll_interval)
-        except EOFError:
-            print("\nConnection dropped, attempting to reconnect...")
-            conn.close()
-            time.sleep(5)  # Wait a bit before retrying
-
-    print(f"\nSLURM job {job_id} completed.")
+class StreamingRemote(Remote):
+    """
+    Fabric runner that, like MuxConnection, keeps no stdout in memory when it
+    goes to an out_stream (e.g. a LogCapture): the stream receives stdout
+    even with hide, and the result's stdout is empty. Fabric otherwise
+    buffers the whole output of a command.
+    """
+
+    def handle_stdout(self, buffer_, hide, output):
+        if self.opts["out_stream"] is not None:
+            # The stream owns the output and its echo; watchers only see the last chunks
+            buffer_, hide = deque(maxlen=64), False
+        super().handle_stdout(buffer_, hide, output)
+
+def fabric_connection(host):
+    """Return a Fabric Connection to `host` that streams out_stream output (see StreamingRemote)."""
+    return Connection(host, config=Config(overrides={"runners": {"remote": StreamingRemote}}))
+
+def remote_runner(conn):
+    """
+    Return a runner for slurm.JobWatcher that executes commands over `conn`,
+    reconnecting if the connection drops. Only pass commands that are safe to
+    run twice (polling, reads, idempotent copies): they are repeated then.
+    """
+    def run(cmd):
+        while True:
+            try:
+                result = conn.run(cmd, hide=True, warn=True, **repeatable(conn))
+                return result.return_code, result.stdout
+            except EOFError:
+                print("\nConnection dropped, attempting to reconnect...")
+                conn.close()
+                time.sleep(5)  # Wait a bit before retrying
+    return run
+
+def wait_for_builds(conn, jobs):
+    """
+    Wait for SLURM jobs on the remote to finish and return their terminal states.
+
+    Every wait is recorded as a queue span and a compute span, split using the
+    submit/start/end times from sacct (one compute span if sacct has none).
+
+    Args:
+        conn: Connection to the remote machine
+        jobs: Dictionary of job ID -> name used for the spans
+
+    Returns:
+        Dictionary of job ID -> terminal state
+    """
+    run = remote_runner(conn)
+    watcher = JobWatcher(run)
+    for job_id in jobs:
+        watcher.add(job_id)
+    wait_start = time.time()
+    states = {}
+    for job_id, state in watcher.iter_finished():
+        wait_end = time.time()
+        states[job_id] = state
+        print(f"SLURM job {job_id} completed with state {state}.")
+
+        name = jobs[job_id]
+        durations = job_durations(job_id, run)
+        if durations:
+            queued, running = durations
+            # Anchor at the local end of the wait so the spans share the local clock
+            run_start = max(wait_start, wait_end - running)
+            tracer.add(f"{name} queue", "queue", max(wait_start, run_start - queued), run_start,
+                       thread=name, job_id=job_id)
+            tracer.add(f"{name} run", "compute", run_start, wait_end, thread=name, job_id=job_id, state=state)
+        else:
+            tracer.add(f"{name} wait", "compute", wait_start, wait_end, thread=name, job_id=job_id, state=state)
+    return states
 
 def check_remote_requirements(conn, verbose=False):
     # Check for yq and psubmit.sh in remote PATH
     missing = []
     for cmd in ['yq', 'psubmit.sh']:
-        result = conn.run(f'command -v {cmd}', hide=True, warn=True)
+        result = conn.run(f'command -v {cmd}', hide=True, warn=True, **repeatable(conn))
         if result.exited != 0:
             missing.append(cmd)
     if missing:
@@ -116,7 +194,7 @@ def upload_file(conn, local_path, remote_path, verbose=False):
     print(f"Ensuring remote directory {remote_dir} exists...")
 
     # Ensure the remote directory exists
-    conn.run(f"mkdir -p '{remote_dir}'")
+    conn.run(f"mkdir -p '{remote_dir}'", **repeatable(conn))
 
     if verbose:
         print(f"Uploading {local_path} → {remote_path} ...")
@@ -140,7 +218,566 @@ def upload_file(conn, local_path, remote_path, verbose=False):
     if verbose:
         print(f"Upload complete: {remote_str}")
 
-def main(pipeline_yaml_path: str, skip_build: bool, no_run: bool, partial_build: bool):
+def test_matrix(ifs_cfg, use_gpu):
+    """
+    Return the test configurations of the pipeline YAML as a list of
+    (resolution, steps, threads, ppn, nodes, gpus) tuples, gpus None on CPU.
+    """
+    keys = ["resolution", "steps", "threads", "ppn", "nodes"] + (["gpus"] if use_gpu else [])
+    # Ensure all elements are lists for zip
+    loop_items = [ifs_cfg.get(k, []) for k in keys]
+    loop_items = [x if isinstance(x, list) else [x] for x in loop_items]
+    return [items if use_gpu else items + (None,) for items in zip(*loop_items)]
+
+def load_variants(cfg):
+    """
+    Return the build variants of the pipeline YAML.
+
+    `overrides` is either one mapping (a single build, as before) or a list of
+    mappings, one per variant. A variant is named by its `name` key, or else
+    by its DNB_SANDBOX_SUBDIR, and each variant needs a sandbox of its own.
+
+    Returns:
+        List of dictionaries {name, overrides, sandbox, use_gpu}; the name is
+        None for a single build
+    """
+    ov = cfg.get("overrides") or {}
+    single = isinstance(ov, dict)
+    variants = []
+    for entry in ([ov] if single else ov):
+        entry = dict(entry or {})
+        name = entry.pop("name", None)
+        sandbox = entry.get("DNB_SANDBOX_SUBDIR", "")
+        if not single:
+            name = str(name or sandbox)
+            if not sandbox:
+                raise ValueError(f"Build variant {name or len(variants) + 1} needs its own DNB_SANDBOX_SUBDIR")
+        variants.append({
+            "name": None if single else name,
+            "overrides": entry,
+            "sandbox": sandbox,
+            "use_gpu": str(entry.get('DNB_IFSNEMO_WITH_GPU', 'FALSE')).upper() == 'TRUE',
+        })
+    if not variants:
+        raise ValueError("overrides: the list of build variants is empty")
+    for key in ("name", "sandbox"):
+        values = [v[key] for v in variants]
+        duplicates = sorted({x for x in values if values.count(x) > 1})
+        if len(variants) > 1 and duplicates:
+            raise ValueError(f"Build variants must have distinct {key}s, found {', '.join(duplicates)} twice")
+    return variants
+
+def variant_key(base, variant):
+    """Qualify a test ID or ledger stage with the variant's name (unchanged for a single build)."""
+    return f"{base}@{variant['name']}" if variant["name"] else base
+
+def override_exports(ov):
+    """Return the `export` statements dnb.sh needs for one set of overrides."""
+    exports = []
+    ifs_source_git_url_template = ov.get("IFS_BUNDLE_IFS_SOURCE_GIT", "")
+    ifs_source_git_url = ifs_source_git_url_template.format(**ov) if ifs_source_git_url_template else ""
+    if ov.get('DNB_SANDBOX_SUBDIR'):
+        exports.append(f'export DNB_SANDBOX_SUBDIR="{ov.get("DNB_SANDBOX_SUBDIR")}"')
+    if ov.get('DNB_IFSNEMO_URL'):
+        exports.append(f'export DNB_IFSNEMO_URL="{ov.get("DNB_IFSNEMO_URL")}"')
+    if ov.get('IFS_BUNDLE_IFS_SOURCE_VERSION'):
+        exports.append(f'export IFS_BUNDLE_IFS_SOURCE_VERSION="{ov.get("IFS_BUNDLE_IFS_SOURCE_VERSION")}"')
+    if ifs_source_git_url:
+        exports.append(f'export IFS_BUNDLE_IFS_SOURCE_GIT="{ifs_source_git_url}"')
+    if ov.get('DNB_IFSNEMO_BUNDLE_BRANCH'):
+        exports.append(f'export DNB_IFSNEMO_BUNDLE_BRANCH="{ov.get("DNB_IFSNEMO_BUNDLE_BRANCH")}"')
+    if ov.get('DNB_IFSNEMO_BUNDLE_GIT'):
+        exports.append(f'export DNB_IFSNEMO_BUNDLE_GIT="{ov.get("DNB_IFSNEMO_BUNDLE_GIT")}"')
+    if ov.get('IFS_BUNDLE_RAPS_GIT'):
+        exports.append(f'export IFS_BUNDLE_RAPS_GIT="{ov.get("IFS_BUNDLE_RAPS_GIT")}"')
+    if ov.get('IFS_BUNDLE_RAPS_VERSION'):
+        exports.append(f'export IFS_BUNDLE_RAPS_VERSION="{ov.get("IFS_BUNDLE_RAPS_VERSION")}"')
+    if ov.get('DNB_IFSNEMO_WITH_GPU'):
+        exports.append(f'export DNB_IFSNEMO_WITH_GPU={ov.get("DNB_IFSNEMO_WITH_GPU")}')
+    if ov.get('DNB_IFSNEMO_WITH_GPU_EXTRA'):
+        exports.append(f'export DNB_IFSNEMO_WITH_GPU_EXTRA={ov.get("DNB_IFSNEMO_WITH_GPU_EXTRA")}')
+    if ov.get('DNB_IFSNEMO_WITH_STATIC_LINKING'):
+        exports.append(f'export DNB_IFSNEMO_WITH_STATIC_LINKING={ov.get("DNB_IFSNEMO_WITH_STATIC_LINKING")}')
+    # Set DNB_IFSNEMO_USE_ARCH_AND_RAPS to TRUE by default, but allow overriding this value
+    use_arch_and_raps = ov.get('DNB_IFSNEMO_USE_ARCH_AND_RAPS', 'TRUE')
+    exports.append(f'export DNB_IFSNEMO_USE_ARCH_AND_RAPS={use_arch_and_raps}')
+
+    ## Process miscellaneous environment variables from 'env' key
+    misc_env = ov.get('env', {})
+    if misc_env:
+        for env_key, env_value in misc_env.items():
+            exports.append(f'export {env_key}="{env_value}"')
+    return exports
+
+def split_exports(variants):
+    """
+    Split the exports of the variants into those shared by all of them, which
+    go into overrides.yaml, and those of each variant, stored as its `env`
+    and exported in the shell of its own dnb.sh calls.
+
+    Returns:
+        List of the shared export statements
+    """
+    exports = [override_exports(v["overrides"]) for v in variants]
+    shared = [e for e in exports[0] if all(e in other for other in exports[1:])]
+    for variant, own in zip(variants, exports):
+        variant["env"] = [e for e in own if e not in shared]
+    return shared
+
+def env_prefix(variant):
+    """Shell prefix exporting the variant's own overrides ('' for a single build)."""
+    return "".join(f"{e}; " for e in variant["env"])
+
+def variant_summary(test_results, variants, configs):
+    """
+    Cross-tabulate the test configurations of several build variants.
+
+    Args:
+        test_results: Combined results, keyed by variant-qualified test ID
+        variants: Build variants from load_variants
+        configs: Test IDs of the configurations, without variant
+
+    Returns:
+        Dictionary config -> variant -> {"passed", "perf_passed"}, None
+        where a variant did not run the configuration
+    """
+    summary = {}
+    for config in configs:
+        row = {}
+        for variant in variants:
+            results = test_results.get(variant_key(config, variant))
+            if results is None:
+                row[variant["name"]] = None
+                continue
+            perf = [v for k, v in results.items() if k.endswith("_perf_passed") and v is not None]
+            row[variant["name"]] = {
+                "passed": all(v for k, v in results.items() if k.endswith("_passed") and not k.endswith("_perf_passed")),
+                "perf_passed": all(perf) if perf else None,
+            }
+        summary[config] = row
+    return summary
+
+def print_variant_summary(summary, variants):
+    """Print the cross-tabulation of variant_summary as a table."""
+    names = [v["name"] for v in variants]
+    width = max([len("configuration")] + [len(c) for c in summary])
+    print(f"{BOLD}{'configuration'.ljust(width)}  " + "  ".join(n.ljust(12) for n in names) + RESET)
+    for config, row in summary.items():
+        cells = []
+        for name in names:
+            cell = row[name]
+            if cell is None:
+                text = "-"
+            else:
+                text = "PASS" if cell["passed"] else "FAIL"
+                if cell["perf_passed"] is False:
+                    text += " (slow)"
+            cells.append(text.ljust(max(12, len(name))))
+        print(f"{config.ljust(width)}  " + "  ".join(cells))
+
+def run_suite_command(conn, ledger, suite_name, suite_def, cmd_name, context, test_id, hide=False):
+    """
+    Run one suite command, or return its recorded results if the ledger shows
+    it completed in an earlier attempt of this run.
+    """
+    stage = f"suite:{test_id}:{suite_name}:{cmd_name}"
+    if ledger.skip(stage):
+        return ledger.get(stage).get("results", {})
+    ledger.update(stage, status="started")
+    results = execute_test(
+        conn, suite_name, suite_def, cmd_name, context,
+        test_id, verbose=verbose, hide=hide
+    )
+    ledger.mark_done(stage, results=results)
+    return results
+
+def run_config_suites(connect, host, ledger, test_id, test_context, test_defs, requested_test_suites, hide=False):
+    """
+    Run every requested test suite for a single test configuration.
+
+    Opens a dedicated connection with `connect(host)` so that several
+    configurations can run concurrently from a worker pool. Commands already
+    completed according to `ledger` are not run again.
+
+    Returns:
+        Dictionary of results for this configuration
+    """
+    print(f"{BOLD}Processing test config: {test_id}{RESET}")
+    config_results = {}
+    with connect(host) as conn:
+        for suite_name in requested_test_suites:
+            suite_def = test_defs['test_suites'][suite_name]
+            sequence = suite_def.get('sequence', [])
+
+            for cmd_name in sequence:
+                print(f"{BOLD}Running {suite_name}:{cmd_name} for {test_id}...{RESET}")
+                results = run_suite_command(
+                    conn, ledger, suite_name, suite_def, cmd_name, test_context,
+                    test_id, hide=hide
+                )
+                config_results.update(results)
+    return config_results
+
+def pending_plan(ledger, stages, results):
+    """
+    Build the execution plan of the suite commands that are not done yet.
+
+    Args:
+        ledger: Stage ledger; results of commands it records as done are
+            merged into `results` instead
+        stages: List of stages, each a list of (group ID, plan steps)
+        results: Dictionary of group ID -> results, filled in place
+
+    Returns:
+        (plan, steps): the plan for the remote agent and a dictionary of
+        step ID -> (group ID, step) of the commands in it
+    """
+    steps = {}
+    plan = {"stages": []}
+    for stage in stages:
+        groups = []
+        for group_id, group_steps in stage:
+            results.setdefault(group_id, {})
+            pending = []
+            for step in group_steps:
+                stage_name = f"suite:{step['id']}"
+                if ledger.skip(stage_name):
+                    results[group_id].update(ledger.get(stage_name).get("results", {}))
+                    continue
+                pending.append(step)
+                steps[step["id"]] = (group_id, step)
+            if pending:
+                groups.append({"id": group_id, "steps": pending})
+        if groups:
+            plan["stages"].append({"groups": groups})
+    return plan, steps
+
+def agent_event_handler(ledger, steps, results, logs, echo=False, event_times=False):
+    """
+    Return a handler for the events of the remote agent that writes the
+    output of every step to its log and records its results in `results`
+    and the ledger, as execute_test does.
+
+    Args:
+        ledger: Stage ledger
+        steps: Dictionary of step ID -> (group ID, step)
+        results: Dictionary of group ID -> results, filled in place
+        logs: Dictionary of step ID -> open log, filled in place
+        echo: Also print the output of the steps
+        event_times: Time the spans with the times of the events (steps that
+            ran detached) instead of the local clock
+    """
+    started = {}
+
+    def handle(event):
+        kind = event.get("event")
+        if event.get("step") not in steps:
+            return
+        group_id, step = steps[event["step"]]
+        now = event["time"] if event_times else time.time()
+        if kind == "start":
+            print(f"{BOLD}Running {step['suite']}:{step['cmd']} for {step['test_id']}...{RESET}")
+            print(step["command"])
+            ledger.update(f"suite:{step['id']}", status="started")
+            logs[step["id"]] = open_log(step["output_file"], echo=echo)
+            started[step["id"]] = now
+        elif kind == "output":
+            logs[step["id"]].write(event["line"])
+        elif kind == "end":
+            log = logs.pop(step["id"])
+            log.close()
+            step_res = step_results(step, event["return_code"], log.path, event.get("report"))
+            results[group_id].update(step_res)
+            ledger.mark_done(f"suite:{step['id']}", results=step_res)
+            tracer.add(f"{step['suite']}:{step['cmd']}", "suite", started.get(step["id"], now), now,
+                       thread=group_id, test_id=step["test_id"], return_code=event["return_code"])
+    return handle
+
+def run_with_agent(conn, ledger, stages, remote_path, plan_name, jobs=1):
+    """
+    Run suite commands through the remote agent, in a single SSH session.
+
+    Args:
+        conn: Connection to the remote machine
+        ledger: Stage ledger; commands it records as done are not run again
+        stages: List of stages, each a list of (group ID, plan steps); the
+            groups of a stage run in parallel on the remote, their steps in order
+        remote_path: remote_project_dir of the pipeline YAML
+        plan_name: File name of the plan on the remote
+        jobs: Groups run in parallel on the remote
+
+    Returns:
+        Dictionary of group ID -> results of its commands
+    """
+    results = {}
+    plan, steps = pending_plan(ledger, stages, results)
+    if not steps:
+        return results
+
+    logs = {}
+    handle_step = agent_event_handler(ledger, steps, results, logs, echo=jobs == 1)
+
+    def handle(event):
+        if event.get("event") == "done":
+            print(f"{BOLD}Remote agent finished: {event['passed']} passed, {event['failed']} failed [{timestamp()}]{RESET}")
+        else:
+            handle_step(event)
+
+    print(f"{BOLD}Running {len(steps)} command(s) through the remote agent with up to {jobs} group(s) in parallel{RESET}")
+    code = run_remote_plan(conn, plan, remote_path, plan_name, handle, jobs=jobs)
+    for log in logs.values():
+        log.close(complete=False)
+    unfinished = [step_id for step_id in steps if not ledger.is_done(f"suite:{step_id}")]
+    if unfinished:
+        raise RuntimeError(f"Remote agent exited with status {code} before finishing: {', '.join(unfinished)}")
+    return results
+
+def submit_detached(conn, ledger, cfg, remote_path, stages, group_variants, install_variants, build_jobs,
+                    plan_name, config_ids):
+    """
+    Submit the install of every variant and every pending suite command as
+    SLURM jobs chained by dependencies, so nothing has to wait locally.
+
+    Installs run after their build (afterok). The first command of a group
+    runs after the install of its variant (afterok), the others also after the
+    previous command of the group (afterany, so a failed run still gets its
+    compare, as with the other modes, while a failed install cancels them all). Each command runs as
+    `remote_agent.py --step` with its events going to the job's output file,
+    read later by `pipeline.py collect`.
+
+    Args:
+        conn: Connection to the remote machine
+        ledger: Stage ledger; the submitted jobs are recorded as stage "detached"
+        cfg: Pipeline YAML
+        remote_path: remote_project_dir of the pipeline YAML
+        stages: List of stages, each a list of (group ID, plan steps)
+        group_variants: Dictionary of group ID -> build variant
+        install_variants: Variants whose install has to be submitted
+        build_jobs: Dictionary of variant_key("build", variant) -> build job
+            still to finish
+        plan_name: File name of the plan on the remote
+        config_ids: Test IDs of the configurations, without variant
+    """
+    psubmit_cfg = cfg.get('psubmit', {})
+    header = f"""#!/bin/bash
+#SBATCH -A {psubmit_cfg.get('account', '')}
+#SBATCH --qos={psubmit_cfg.get('node_type', '')}
+#SBATCH --nodes=1
+#SBATCH --ntasks=1
+"""
+    submit = ["#!/bin/bash", "set -e", f"cd {quote(str(remote_path))}"]
+
+    def sbatch(key, script, dependency=None, options=""):
+        if dependency:
+            options = f"--dependency={dependency} --kill-on-invalid-dep=yes {options}"
+        var = f"job{len(submit)}"
+        submit.append(f"{var}=$(sbatch --parsable {options}{script})")
+        submit.append(f"{var}=${{{var}%%;*}}")
+        submit.append(f"printf '%s\\t%s\\n' {quote(key)} ${var}")
+        return f"${var}"
+
+    installs = {}
+    for variant in install_variants:
+        stage = variant_key("install", variant)
+        suffix = f"_{variant['name']}" if variant["name"] else ""
+        script_name = f"ifsnemo_install_dnb_i{'.' + variant['name'] if variant['name'] else ''}.sbatch"
+        env_lines = "".join(f"{e}\n" for e in variant["env"])
+        Path(script_name).write_text(header + f"""#SBATCH --job-name=dnb_sh_install{suffix}
+#SBATCH --output=dnb_sh_install_%j.out
+#SBATCH --error=dnb_sh_install_%j.err
+#SBATCH --time=01:00:00
+
+cd {remote_path}/ifsnemo-build
+{env_lines}./dnb.sh :i
+""")
+        conn.put(script_name, f"{remote_path}/{script_name}")
+        build_job = build_jobs.get(variant_key("build", variant))
+        installs[stage] = sbatch(stage, script_name, f"afterok:{build_job}" if build_job else None)
+
+    results = {}
+    plan, steps = pending_plan(ledger, stages, results)
+    remote_dir = None
+    events_dir = None
+    if steps:
+        remote_dir = ship_plan(conn, plan, remote_path, plan_name)
+        events_dir = f"{remote_dir}/events/{Path(plan_name).stem}"
+        Path("ifsnemo_compare_step.sbatch").write_text(header + f"""#SBATCH --job-name=ifsnemo_compare_step
+#SBATCH --time={psubmit_cfg.get('step_time', '04:00:00')}
+
+python3 {remote_dir}/remote_agent.py "$1" --step "$2"
+""")
+        conn.put("ifsnemo_compare_step.sbatch", f"{remote_dir}/ifsnemo_compare_step.sbatch")
+        submit.append(f"mkdir -p {quote(events_dir)}")
+        for stage in plan["stages"]:
+            for group in stage["groups"]:
+                install = installs.get(variant_key("install", group_variants[group["id"]]))
+                previous = None
+                for step in group["steps"]:
+                    events = f"{events_dir}/{len(submit):05d}.ndjson"
+                    steps[step["id"]][1]["events"] = events
+                    dependency = ",".join(d for d in (previous and f"afterany:{previous}",
+                                                      install and f"afterok:{install}") if d) or None
+                    previous = sbatch(step["id"], f"{quote(remote_dir)}/ifsnemo_compare_step.sbatch "
+                                      f"{quote(remote_dir + '/' + plan_name)} {quote(step['id'])}",
+                                      dependency, f"--output={quote(events)} --error={quote(events)}.err ")
+
+    Path("ifsnemo_submit_detached.sh").write_text("\n".join(submit) + "\n")
+    conn.put("ifsnemo_submit_detached.sh", f"{remote_path}/ifsnemo_submit_detached.sh")
+    print(f"{BOLD}Submitting {len(installs)} install job(s) and {len(steps)} suite command job(s)... [{timestamp()}]{RESET}")
+    with tracer.span("sbatch detached", "remote", jobs=len(installs) + len(steps)):
+        result = conn.run(f"bash {quote(str(remote_path))}/ifsnemo_submit_detached.sh", hide=True, warn=True)
+    job_ids = dict(line.split("\t", 1) for line in result.stdout.splitlines() if "\t" in line)
+
+    # Record whatever was submitted, even if a submission failed midway
+    for stage in installs:
+        if stage in job_ids:
+            ledger.update(stage, status="started", job_id=job_ids[stage], state="SUBMITTED")
+    ledger.update("detached", status="started", remote_dir=remote_dir, plan=plan_name, config_ids=config_ids,
+                  builds=build_jobs,
+                  installs={stage: job_ids.get(stage) for stage in installs},
+                  groups=[[group_id, [dict(step, events=steps.get(step["id"], (None, step))[1].get("events"))
+                                      for step in group_steps]]
+                          for stage in stages for group_id, group_steps in stage],
+                  jobs={step_id: job_ids.get(step_id) for step_id in steps})
+    if result.return_code != 0:
+        raise RuntimeError(f"Submitting the detached jobs failed after {len(job_ids)} job(s): {result.stderr.strip()}")
+    ledger.mark_done("detached")
+    for key, job_id in job_ids.items():
+        print(f"  {job_id}  {key}")
+
+def finish_run(run_dir, ledger, test_results, variants, config_ids):
+    """
+    Write test_results.json and the variant summary, mark the run complete
+    and add it to the results history.
+    """
+    results_file = run_dir / "test_results.json"
+    with open(results_file, "w") as f:
+        json.dump(test_results, f, indent=4)
+    print(f"{BOLD}Test results written to {results_file} [{timestamp()}]{RESET}")
+    if len(variants) > 1 and config_ids:
+        # Side by side view of the variants over the test matrix
+        summary = variant_summary(test_results, variants, config_ids)
+        with open(run_dir / "variants.json", "w") as f:
+            json.dump({"variants": {v["name"]: v["sandbox"] for v in variants}, "configs": summary}, f, indent=4)
+        print_variant_summary(summary, variants)
+        print(f"Variant summary written to {run_dir / 'variants.json'}")
+    ledger.mark_done("complete")
+    tracer.print_summary()
+    print(f"Stage timings written to {run_dir / 'timings.json'} and {run_dir / 'trace.json'} (open in https://ui.perfetto.dev)")
+
+    # Add the run to the cross-run history (needs the timings on disk)
+    tracer.write(run_dir)
+    try:
+        db = results_db.connect()
+        results_db.ingest_run(db, run_dir)
+        db.close()
+        print(f"Run added to the results history {results_db.DEFAULT_DB} (query with results_db.py)")
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print(f"Warning: could not add the run to the results history: {e}")
+
+def collect(run_dir: str, wait: bool = False, use_ssh_mux: bool = True, compress_logs: bool = False):
+    """
+    Collect the results of a run started with --detach.
+
+    Reads the events of every finished suite command job into the usual
+    logs, stage ledger and test_results.json. With `wait`, blocks until every
+    job has finished; otherwise reports the jobs still queued or running, and
+    collect can be run again later.
+
+    Returns:
+        Number of suite commands still pending
+    """
+    run_dir = use_run_directory(run_dir)
+    tracer.load(run_dir)
+    ledger = StageLedger.load(run_dir)
+    detached = ledger.get("detached")
+    if not detached:
+        raise RuntimeError(f"{run_dir} was not started with --detach")
+    configure_logs(compress_logs)
+    atexit.register(tracer.write, run_dir)
+
+    with open(ledger.meta["pipeline_yaml"]) as f:
+        cfg = yaml.safe_load(f) or {}
+    variants = load_variants(cfg)
+    host = f"{cfg.get('user', {}).get('remote_username')}@{cfg.get('user', {}).get('remote_machine_url')}"
+    if use_ssh_mux:
+        ssh_manager = ConnectionManager()
+        atexit.register(ssh_manager.close_all)
+        conn = ssh_manager.connection(host)
+    else:
+        conn = fabric_connection(host)
+    run = remote_runner(conn)
+
+    groups = detached["groups"]
+    steps = {step["id"]: (group_id, step) for group_id, group_steps in groups for step in group_steps
+             if step["id"] in detached["jobs"] and not ledger.is_done(f"suite:{step['id']}")}
+    setup_jobs = {stage: job_id for stage, job_id in {**detached["builds"], **detached["installs"]}.items()
+                  if job_id and not ledger.is_done(stage)}
+
+    watcher = JobWatcher(run, verbose=wait)
+    for job_id in list(setup_jobs.values()) + [detached["jobs"][step_id] for step_id in steps]:
+        if job_id:
+            watcher.add(job_id)
+    if wait:
+        watcher.wait()
+    else:
+        watcher.poll()
+    states = watcher.states
+
+    for stage, job_id in setup_jobs.items():
+        state = states.get(job_id)
+        print(f"{stage}: SLURM job {job_id} {state}")
+        if state == 'COMPLETED':
+            ledger.mark_done(stage, state=state)
+        elif state in TERMINAL_STATES:
+            ledger.update(stage, state=state)
+
+    results = {}
+    logs = {}
+    handle = agent_event_handler(ledger, steps, results, logs, event_times=True)
+    pending = []
+    for step_id, (group_id, step) in steps.items():
+        results.setdefault(group_id, {})
+        job_id = detached["jobs"][step_id]
+        state = states.get(job_id) if job_id else UNKNOWN_STATE
+        if state not in TERMINAL_STATES and state != UNKNOWN_STATE:
+            pending.append(f"{step_id} (job {job_id}: {state})")
+            continue
+        code, out = run(f"cat {quote(step['events'])}")
+        stream = AgentEventStream(handle)
+        stream.write(out if code == 0 else "")
+        stream.write("\n")
+        for log in logs.values():
+            log.close(complete=False)
+        logs.clear()
+        if not ledger.is_done(f"suite:{step_id}"):
+            # The job never ran the command, e.g. its dependency failed
+            with open_log(step["output_file"], echo=False) as log:
+                log.write(f"SLURM job {job_id} ended in state {state} without finishing {step['suite']}:{step['cmd']}\n")
+            step_res = step_results(step, None, log.path, None)
+            ledger.mark_done(f"suite:{step_id}", results=step_res, state=state)
+            print(f"{step_id}: job {job_id} ended in state {state} without finishing")
+
+    test_results = {}
+    for group_id, group_steps in groups:
+        test_results[group_id] = {}
+        for step in group_steps:
+            test_results[group_id].update(ledger.get(f"suite:{step['id']}").get("results", {}))
+    if pending:
+        with open(run_dir / "test_results.json", "w") as f:
+            json.dump(test_results, f, indent=4)
+        print(f"{BOLD}{len(pending)} suite command(s) still queued or running:{RESET}")
+        for entry in pending:
+            print(f"  {entry}")
+        print(f"Partial results written to {run_dir / 'test_results.json'}; run `pipeline.py collect {run_dir}` again later, or with --wait")
+        return len(pending)
+    finish_run(run_dir, ledger, test_results, variants, detached.get("config_ids") or [])
+    return 0
+
+def main(pipeline_yaml_path: str, skip_build: bool, no_run: bool, build_mode: str = "auto",
+         max_parallel_configs: int = 1, use_run_cache: bool = True, full_sync: bool = False,
+         sync_streams: int = 4, use_ssh_mux: bool = True, resume_dir: str = None,
+         compress_logs: bool = False, use_remote_agent: bool = False, detach: bool = False):
     ############################################
     # 1.1 Ensure yq installed on local machine
     ############################################
@@ -165,13 +802,33 @@ def main(pipeline_yaml_path: str, skip_build: bool, no_run: bool, partial_build:
     ############################################
     # 1.3 Write ifsnemo-build config files
     ############################################
+    if resume_dir:
+        # Continue an earlier run with its own options, from its first
+        # incomplete stage
+        run_dir = use_run_directory(resume_dir)
+        tracer.load(run_dir)
+        ledger = StageLedger.load(run_dir)
+        pipeline_yaml_path = ledger.meta["pipeline_yaml"]
+        skip_build = ledger.meta["skip_build"]
+        no_run = ledger.meta["no_run"]
+        # Ledgers of older versions only know --partial-build
+        build_mode = ledger.meta.get("build_mode") or ("partial" if ledger.meta.get("partial_build") else "full")
+        detach = ledger.meta.get("detach", False)
+        print(f"{BOLD}Resuming run in {run_dir} ({pipeline_yaml_path}){RESET}")
+    else:
+        # Initialize output directory for this run
+        run_dir = init_run_directory(pipeline_yaml_path)
+        ledger = StageLedger(run_dir)
+        ledger.set_meta(pipeline_yaml=str(Path(pipeline_yaml_path).resolve()), skip_build=skip_build,
+                        no_run=no_run, build_mode=build_mode, detach=detach)
+    print(f"{BOLD}Output directory: {run_dir}{RESET}")
+    configure_logs(compress_logs)
+    # Written on exit too, so failed runs still show where the time went
+    atexit.register(tracer.write, run_dir)
+
     with open(pipeline_yaml_path, "r") as f:
         cfg = yaml.safe_load(f) or {}
 
-    # Initialize output directory for this run
-    run_dir = init_run_directory(pipeline_yaml_path)
-    print(f"{BOLD}Output directory: {run_dir}{RESET}")
-
     remote_username = cfg.get("user", {}).get("remote_username")
     remote_machine = cfg.get("user", {}).get("remote_machine_url")
     machine_file = cfg.get("user", {}).get("machine_file")
@@ -188,65 +845,63 @@ def main(pipeline_yaml_path: str, skip_build: bool, no_run: bool, partial_build:
     gpus = ifs_cfg.get("gpus", [])
     gold_standard_tag = ifs_cfg.get("gold_standard_tag", "")
 
-    ov = cfg.get("overrides", {})
-
-    ifs_source_git_url_template = ov.get("IFS_BUNDLE_IFS_SOURCE_GIT", "")
-    ifs_source_git_url = ifs_source_git_url_template.format(**ov) if ifs_source_git_url_template else ""
-    dnb_sandbox_subdir = ov.get('DNB_SANDBOX_SUBDIR', '')
-
-    # Establish connection to remote
-    conn = Connection(f"{remote_username}@{remote_machine}")
-    # This will raise if remote requirements are missing
-    check_remote_requirements(conn, verbose=True)
+    # One build per variant, each into its own sandbox; all of them are
+    # tested against the same references
+    variants = load_variants(cfg)
+    multi_variant = len(variants) > 1
+    shared_exports = split_exports(variants)
+    if multi_variant:
+        print(f"{BOLD}Build variants: " + ", ".join(f"{v['name']} ({v['sandbox']})" for v in variants) + RESET)
+
+    # Recorded for the results history
+    branches = [v["overrides"].get('IFS_BUNDLE_IFS_SOURCE_VERSION') or v["overrides"].get('DNB_IFSNEMO_BUNDLE_BRANCH')
+                for v in variants]
+    ledger.set_meta(gold_standard_tag=gold_standard_tag, sandbox=", ".join(v["sandbox"] for v in variants),
+                    branch=", ".join(dict.fromkeys(b for b in branches if b)) or None,
+                    variant_branches={v["name"]: b for v, b in zip(variants, branches) if v["name"]} or None,
+                    variants=[v["name"] for v in variants] if multi_variant else None)
+
+    # Establish connection to remote. By default every command, transfer and
+    # rsync stream shares one multiplexed SSH master per host.
+    host = f"{remote_username}@{remote_machine}"
+    if use_ssh_mux:
+        ssh_manager = ConnectionManager()
+        atexit.register(ssh_manager.close_all)
+        connect = ssh_manager.connection
+        rsh = ssh_manager.rsh(host)
+    else:
+        ssh_manager = None
+        connect = fabric_connection
+        rsh = None
+    with tracer.span("connect", "network", host=host):
+        conn = connect(host)
+        # This will raise if remote requirements are missing
+        check_remote_requirements(conn, verbose=True)
 
     # Handle flag interactions
-    if skip_build and partial_build:
-        print("Warning: --partial-build is ignored when --skip-build is set")
-        partial_build = False
-
-    if skip_build:
-        # If we skip the build, the remote tests directory may not be empty.
-        # We'd have to delete any subdirectory in there that corresponds to the
-        # test configuration we are running.
-        if dnb_sandbox_subdir:
-            remote_tests_dir = f"{remote_path}/ifsnemo-build/ifsnemo/tests/{dnb_sandbox_subdir}"
-            print(f"Deleting remote tests directory: {remote_tests_dir}")
-            conn.run(f"rm -rf {remote_tests_dir}")
-
+    if skip_build and build_mode != "auto":
+        print(f"Warning: --{build_mode}-build is ignored when --skip-build is set")
+        build_mode = "auto"
+
+    if not use_run_cache:
+        # The remote tests directory may not be empty. Without the run cache we
+        # delete any subdirectory in there that corresponds to the test
+        # configuration we are running. With the run cache enabled,
+        # compare_norms reuses results of identical runs and drops stale ones.
+        for variant in variants:
+            if variant["sandbox"] and not ledger.skip(variant_key("clean_tests_dir", variant)):
+                remote_tests_dir = f"{remote_path}/ifsnemo-build/ifsnemo/tests/{variant['sandbox']}"
+                print(f"Deleting remote tests directory: {remote_tests_dir}")
+                conn.run(f"rm -rf {remote_tests_dir}")
+                ledger.mark_done(variant_key("clean_tests_dir", variant))
+
+    # Build jobs left for the detached installs to wait for
+    build_jobs = {}
     if not skip_build:
-        # Generate overrides.yaml
-        overrides_content = ['---', 'environment:']
-        if dnb_sandbox_subdir:
-            overrides_content.append(f'  - export DNB_SANDBOX_SUBDIR="{dnb_sandbox_subdir}"')
-        if ov.get('DNB_IFSNEMO_URL'):
-            overrides_content.append(f'  - export DNB_IFSNEMO_URL="{ov.get("DNB_IFSNEMO_URL")}"')
-        if ov.get('IFS_BUNDLE_IFS_SOURCE_VERSION'):
-            overrides_content.append(f'  - export IFS_BUNDLE_IFS_SOURCE_VERSION="{ov.get("IFS_BUNDLE_IFS_SOURCE_VERSION")}"')
-        if ifs_source_git_url:
-            overrides_content.append(f'  - export IFS_BUNDLE_IFS_SOURCE_GIT="{ifs_source_git_url}"')
-        if ov.get('DNB_IFSNEMO_BUNDLE_BRANCH'):
-            overrides_content.append(f'  - export DNB_IFSNEMO_BUNDLE_BRANCH="{ov.get("DNB_IFSNEMO_BUNDLE_BRANCH")}"')
-        if ov.get('DNB_IFSNEMO_BUNDLE_GIT'):
-            overrides_content.append(f'  - export DNB_IFSNEMO_BUNDLE_GIT="{ov.get("DNB_IFSNEMO_BUNDLE_GIT")}"')
-        if ov.get('IFS_BUNDLE_RAPS_GIT'):
-            overrides_content.append(f'  - export IFS_BUNDLE_RAPS_GIT="{ov.get("IFS_BUNDLE_RAPS_GIT")}"')
-        if ov.get('IFS_BUNDLE_RAPS_VERSION'):
-            overrides_content.append(f'  - export IFS_BUNDLE_RAPS_VERSION="{ov.get("IFS_BUNDLE_RAPS_VERSION")}"')
-        if ov.get('DNB_IFSNEMO_WITH_GPU'):
-            overrides_content.append(f'  - export DNB_IFSNEMO_WITH_GPU={ov.get("DNB_IFSNEMO_WITH_GPU")}')
-        if ov.get('DNB_IFSNEMO_WITH_GPU_EXTRA'):
-            overrides_content.append(f'  - export DNB_IFSNEMO_WITH_GPU_EXTRA={ov.get("DNB_IFSNEMO_WITH_GPU_EXTRA")}')
-        if ov.get('DNB_IFSNEMO_WITH_STATIC_LINKING'):
-            overrides_content.append(f'  - export DNB_IFSNEMO_WITH_STATIC_LINKING={ov.get("DNB_IFSNEMO_WITH_STATIC_LINKING")}')
-        # Set DNB_IFSNEMO_USE_ARCH_AND_RAPS to TRUE by default, but allow overriding this value
-        use_arch_and_raps = ov.get('DNB_IFSNEMO_USE_ARCH_AND_RAPS', 'TRUE')
-        overrides_content.append(f'  - export DNB_IFSNEMO_USE_ARCH_AND_RAPS={use_arch_and_raps}')
-
-        ## Process miscellaneous environment variables from 'env' key
-        misc_env = ov.get('env', {})
-        if misc_env:
-            for env_key, env_value in misc_env.items():
-                overrides_content.append(f'  - export {env_key}="{env_value}"')
+        # Generate overrides.yaml with the overrides shared by all variants;
+        # what differs between variants is exported in the shell of their
+        # own dnb.sh calls instead
+        overrides_content = ['---', 'environment:'] + [f'  - {e}' for e in shared_exports]
 
         (local_path / "overrides.yaml").write_text('\n'.join(overrides_content) + '\n')
 
@@ -265,47 +920,47 @@ psubmit:
         # 1.4 Fetch and Package Build Artifacts
         ############################################
 
-        # Fetch references if specified
-        if "references" in cfg:
+        # Fetch references if specified: update the persistent mirror and
+        # hardlink the gold standard tag's references for the test matrix
+        if "references" in cfg and not ledger.skip("fetch_references"):
             ref_cfg = cfg["references"]
             ref_url = ref_cfg["url"]
             ref_branch = ref_cfg.get("branch", "main")
-            ref_path_in_repo = ref_cfg["path_in_repo"]
-
-            temp_ref_dir = local_path / "temp_ref"
-            if temp_ref_dir.exists():
-                shutil.rmtree(temp_ref_dir)
 
             print(f"{BOLD}Fetching references: {ref_url} (branch: {ref_branch}) [{timestamp()}]{RESET}")
-            run_command(["git", "clone", "--depth", "1", "--branch", ref_branch, ref_url, str(temp_ref_dir)], verbose=verbose)
-
-            source_path = temp_ref_dir / ref_path_in_repo
-            target_path = local_path / "references"
-
-            if target_path.exists():
-                shutil.rmtree(target_path)
-
-            print(f"Copying {source_path} to {target_path}")
-            shutil.copytree(source_path, target_path)
-
-            print(f"Cleaning up {temp_ref_dir}")
-            shutil.rmtree(temp_ref_dir)
+            with tracer.span("reference fetch", "network", url=ref_url, branch=ref_branch) as span_args:
+                matrix = list(dict.fromkeys(c for v in variants for c in test_matrix(ifs_cfg, v["use_gpu"])))
+                ref_commit = materialize_references(ref_cfg, gold_standard_tag, matrix,
+                                                    local_path / "references", verbose=verbose)
+                span_args["commit"] = ref_commit
+            ledger.mark_done("fetch_references", commit=ref_commit)
 
         # Create src folder for dnb.sh :du
         (local_path / "src").mkdir(exist_ok=True, parents=True)
 
-        # Run './dnb.sh :du' from within local_path
-        run_command(['./dnb.sh', ':du'], cwd=local_path, verbose=verbose)
+        # Run './dnb.sh :du' from within local_path, once per variant
+        for variant in variants:
+            if ledger.skip(variant_key("download_bundle", variant)):
+                continue
+            with tracer.span(variant_key("dnb.sh :du", variant), "network"):
+                if variant["env"]:
+                    run_command(['bash', '-c', f"{env_prefix(variant)}./dnb.sh :du"], cwd=local_path, verbose=verbose)
+                else:
+                    run_command(['./dnb.sh', ':du'], cwd=local_path, verbose=verbose)
+            ledger.mark_done(variant_key("download_bundle", variant))
 
         # Copy local ifsnemo-compare into the local_path
+        # (--delete instead of removing the copy first keeps the mtimes of
+        # unchanged files, so the delta sync below does not push them again)
         script_dir = Path(__file__).resolve().parent
-        subprocess.run(["rm", "-fr", str(local_path) + "/ifsnemo-compare"], check=True)
         rsync_compare_cmd = [
-            "rsync", "-a", "--exclude", ".git", "--exclude", "__pycache__", "--exclude", "*.log",
+            "rsync", "-a", "--delete", "--exclude", ".git", "--exclude", "__pycache__", "--exclude", "*.log",
+            "--exclude", "/results",
             str(script_dir) + "/",
             str(local_path) + "/ifsnemo-compare/"
         ]
-        run_command(rsync_compare_cmd, verbose=verbose, show_spinner=True)
+        with tracer.span("copy ifsnemo-compare", "local"):
+            run_command(rsync_compare_cmd, verbose=verbose, show_spinner=True)
 
         ############################################
         # 2.1-2.3 Build and Install on remote
@@ -315,17 +970,17 @@ psubmit:
         local_path = Path(local_path)
         remote_path = Path(remote_path)
 
-        # Ensure the remote directory exists
-        print(f"Ensuring remote directory {remote_path}/ifsnemo-build exists...")
-        conn.run(f"mkdir -p '{remote_path}/ifsnemo-build'")
+        if not ledger.skip("sync"):
+            # Ensure the remote directory exists
+            print(f"Ensuring remote directory {remote_path}/ifsnemo-build exists...")
+            conn.run(f"mkdir -p '{remote_path}/ifsnemo-build'", **repeatable(conn))
 
-        print(f"{BOLD}Syncing to remote: {remote_username}@{remote_machine}:{remote_path}/ifsnemo-build/ [{timestamp()}]{RESET}")
-        rsync_cmd = [
-            "rsync", "-rlpgoD", "--compress", "--info=progress2",
-            str(local_path) + "/",
-            f"{remote_username}@{remote_machine}:{remote_path}/ifsnemo-build/"
-        ]
-        run_command(rsync_cmd, verbose=verbose, show_spinner=True)
+            print(f"{BOLD}Syncing to remote: {remote_username}@{remote_machine}:{remote_path}/ifsnemo-build/ [{timestamp()}]{RESET}")
+            with tracer.span("rsync to remote", "network") as span_args:
+                sync_report = delta_sync(local_path, f"{remote_username}@{remote_machine}", f"{remote_path}/ifsnemo-build",
+                                         remote_runner(conn), streams=sync_streams, full=full_sync, rsh=rsh)
+                span_args.update(files_sent=sync_report["files_sent"], bytes_sent=sync_report["bytes_sent"])
+            ledger.mark_done("sync", report=sync_report)
 
         psubmit_account = cfg.get('psubmit', {}).get('account', '')
         psubmit_node_type = cfg.get('psubmit', {}).get('node_type', '')
@@ -349,25 +1004,43 @@ psubmit:
         else:
             print(f"Warning: machine_file '{machine_config_path}' not found. Using default ntasks-per-node={ntasks_per_node}.")
 
-        # Determine build command
-        if partial_build:
-            build_cmd = ":r"
-            print("""
- PARTIAL BUILD MODE
- Using incremental/partial rebuild instead of full build
- This is primarily intended for only when source code
- changes have occurred and re-run of the bundle is not
- needed.
- If in doubt, run a full build instead!
-""")
-        else:
-            build_cmd = ":b"
-
-        # Build on a compute node
-        sbatch_script = f"""#!/bin/bash
+        # Determine the build command of each variant: a full build (:b) when
+        # an input of ifs-bundle changed since the last successful build of its
+        # sandbox on the remote, an incremental one (:r) otherwise
+        build_decisions = {}
+        remote_build_dir = f"{remote_path}/ifsnemo-build"
+        for variant in variants:
+            stage = variant_key("build", variant)
+            if ledger.is_done(stage) or ledger.get(stage).get("state") == "SUBMITTED":
+                continue
+            inputs = input_fingerprint(local_path, machine_file, variant)
+            record_path = fingerprint_path(remote_build_dir, variant["sandbox"])
+            previous = read_fingerprint(remote_runner(conn), record_path)
+            decision = decide_build(inputs, previous, None if build_mode == "auto" else build_mode)
+            print(f"{BOLD}Build{' of ' + variant['name'] if variant['name'] else ''}: dnb.sh {decision['build_cmd']}{RESET} "
+                  f"({decision['reason']})")
+            build_decisions[stage] = dict(decision, inputs=inputs, previous=previous, record=record_path)
+        if build_decisions:
+            with open(run_dir / "build_decision.json", "w") as f:
+                json.dump(build_decisions, f, indent=4)
+
+        # Build on compute nodes, one sbatch job per variant, all submitted
+        # before waiting so that their queue waits and builds overlap
+        jobs = {}
+        for variant in variants:
+            stage = variant_key("build", variant)
+            decision = build_decisions.get(stage) or {"build_cmd": ledger.get(stage).get("build_cmd", ":b")}
+            build_cmd = decision["build_cmd"]
+            # The build job records its inputs once dnb.sh succeeded
+            record_line = (f" && {record_command(decision['record'], decision['inputs'], run_dir.name, build_cmd)}"
+                           if "record" in decision else "")
+            suffix = f"_{variant['name']}" if variant["name"] else ""
+            sbatch_name = f"ifsnemo_build_dnb_b{'.' + variant['name'] if variant['name'] else ''}.sbatch"
+            env_lines = "".join(f"{e}\n" for e in variant["env"])
+            sbatch_script = f"""#!/bin/bash
 #SBATCH -A {psubmit_account}
 #SBATCH --qos={psubmit_node_type}
-#SBATCH --job-name=dnb_sh_build
+#SBATCH --job-name=dnb_sh_build{suffix}
 #SBATCH --output=dnb_sh_build_%j.out
 #SBATCH --error=dnb_sh_build_%j.err
 #SBATCH --nodes=1
@@ -380,29 +1053,75 @@ module load cmake/3.30.5
 
 cd {remote_path}/ifsnemo-build
 ln -sf {machine_file} machine.yaml
-./dnb.sh {build_cmd}
+{env_lines}./dnb.sh {build_cmd}{record_line}
 """
 
-        Path("ifsnemo_build_dnb_b.sbatch").write_text(sbatch_script)
-        conn.put("ifsnemo_build_dnb_b.sbatch", f"{remote_path}/ifsnemo_build_dnb_b.sbatch")
-
-        # Run the build on compute node with sbatch job
-        print(f"{BOLD}Submitting build job to remote... [{timestamp()}]{RESET}")
-        job_output = conn.run(f"cd {remote_path} && sbatch ifsnemo_build_dnb_b.sbatch", hide=True)
-
-        # Wait until completion
-        job_id = job_output.stdout.strip().split()[-1]
-        wait_for_job(conn, job_id)
+            build = ledger.get(stage)
+            if ledger.skip(stage):
+                continue
+            if build.get("job_id") and build.get("state") == "SUBMITTED":
+                # An earlier attempt submitted the build and lost track of it;
+                # reattach instead of building again
+                job_id = build["job_id"]
+                print(f"{BOLD}Reattaching to build job {job_id}... [{timestamp()}]{RESET}")
+            else:
+                Path(sbatch_name).write_text(sbatch_script)
+                conn.put(sbatch_name, f"{remote_path}/{sbatch_name}")
+
+                # Run the build on compute node with sbatch job
+                print(f"{BOLD}Submitting build job{' for ' + variant['name'] if variant['name'] else ''} to remote... [{timestamp()}]{RESET}")
+                with tracer.span(variant_key("sbatch build", variant), "remote"):
+                    job_output = conn.run(f"cd {remote_path} && sbatch {sbatch_name}", hide=True)
+                job_id = job_output.stdout.strip().split()[-1]
+                ledger.update(stage, status="started", job_id=job_id, state="SUBMITTED", build_cmd=build_cmd,
+                              build_reason=decision["reason"])
+            jobs[job_id] = (stage, variant)
+
+        if detach:
+            # The installs and suite commands are submitted with dependencies
+            # on the builds below, nothing waits here
+            build_jobs = {stage: job_id for job_id, (stage, _) in jobs.items()}
+        elif jobs:
+            # Wait until completion
+            build_states = wait_for_builds(conn, {job_id: f"{stage} {ledger.get(stage).get('build_cmd', '')}".rstrip()
+                                                  for job_id, (stage, _) in jobs.items()})
+            failed = []
+            for job_id, (stage, variant) in jobs.items():
+                build_state = build_states[job_id]
+                if build_state == UNKNOWN_STATE:
+                    print(f"Warning: could not determine the final state of build job {job_id}; continuing with install.")
+                elif build_state != 'COMPLETED':
+                    ledger.update(stage, state=build_state)
+                    failed.append(f"build job {job_id}{' (' + variant['name'] + ')' if variant['name'] else ''} "
+                                  f"ended in state {build_state}, see dnb_sh_build_{job_id}.err on the remote")
+                    continue
+                ledger.mark_done(stage, state=build_state)
+            if failed:
+                raise RuntimeError("; ".join(failed))
 
         # Run ./dnb.sh :i on login node
-        conn.run(f"cd {remote_path}/ifsnemo-build && ./dnb.sh :i")
-
-        # Copy references into the test arena if they exist
-        if "references" in cfg:
-            conn.run(f"rsync -a {remote_path}/ifsnemo-build/references/ {remote_path}/ifsnemo-build/ifsnemo/references/")
+        for variant in ([] if detach else variants):
+            if not ledger.skip(variant_key("install", variant)):
+                with tracer.span(variant_key("dnb.sh :i", variant), "remote"):
+                    conn.run(f"cd {remote_path}/ifsnemo-build && {env_prefix(variant)}./dnb.sh :i")
+                ledger.mark_done(variant_key("install", variant))
+
+    # Stage changed references into the test arena. This is also done with
+    # --skip-build, from the references pushed by the last build.
+    if "references" in cfg and not ledger.skip("stage_references"):
+        with tracer.span("stage references", "remote") as span_args:
+            staging = stage_references(remote_runner(conn), f"{remote_path}/ifsnemo-build/references",
+                                       f"{remote_path}/ifsnemo-build/ifsnemo/references", gold_standard_tag)
+            span_args["staged_sets"] = len(staging["staged"] or [])
+        ledger.mark_done("stage_references", **staging)
 
     test_results = {}
-    results_file = run_dir / "test_results.json"
+    config_ids = []
+    # With the remote agent or detached, commands are collected here and run
+    # (or submitted) at the end
+    agent_stages = []
+    group_variants = {}
+    plan_commands = use_remote_agent or detach
 
     # Explicitly handle the case where the user asked to skip run/compare
     if no_run:
@@ -435,18 +1154,30 @@ ln -sf {machine_file} machine.yaml
             if missing:
                 raise ValueError(f"Build context missing required params: {missing}")
 
-            test_results['build'] = {}
-            for suite_name in requested_build_suites:
-                suite_def = test_defs['build_suites'][suite_name]
-                sequence = suite_def.get('sequence', [])
+            # One group of build suite results per variant
+            build_groups = [(variant_key('build', v), dict(build_context, test_subdir=v["sandbox"], test_id=variant_key('build', v)))
+                            for v in variants]
+            for (build_id, _), variant in zip(build_groups, variants):
+                test_results[build_id] = {}
+                group_variants[build_id] = variant
+            if plan_commands:
+                agent_stages.append([(build_id, [
+                    plan_command(suite_name, test_defs['build_suites'][suite_name], cmd_name, context, build_id)
+                    for suite_name in requested_build_suites
+                    for cmd_name in test_defs['build_suites'][suite_name].get('sequence', [])
+                ]) for build_id, context in build_groups])
+            else:
+                for build_id, context in build_groups:
+                    for suite_name in requested_build_suites:
+                        suite_def = test_defs['build_suites'][suite_name]
+                        sequence = suite_def.get('sequence', [])
 
-                for cmd_name in sequence:
-                    print(f"{BOLD}Running build suite {suite_name}:{cmd_name}...{RESET}")
-                    results = execute_test(
-                        conn, suite_name, suite_def, cmd_name, build_context,
-                        'build', verbose=verbose
-                    )
-                    test_results['build'].update(results)
+                        for cmd_name in sequence:
+                            print(f"{BOLD}Running build suite {suite_name}:{cmd_name}{' for ' + build_id if multi_variant else ''}...{RESET}")
+                            results = run_suite_command(
+                                conn, ledger, suite_name, suite_def, cmd_name, context, build_id
+                            )
+                            test_results[build_id].update(results)
 
         # === Test suites (run per configuration) ===
         if not (resolution and steps and threads and ppn and nodes):
@@ -458,33 +1189,34 @@ ln -sf {machine_file} machine.yaml
             if requested_test_suites:
                 # Validate test suites exist
                 validate_test_definitions(test_defs, cfg, requested_test_suites, suite_type='test_suites')
-
-                use_gpu = str(ov.get('DNB_IFSNEMO_WITH_GPU', 'FALSE')).upper() == 'TRUE'
-                loop_items = [resolution, steps, threads, ppn, nodes]
-                if use_gpu:
-                    loop_items.append(gpus)
-
-                # Ensure all elements are lists for zip
-                loop_items = [x if isinstance(x, list) else [x] for x in loop_items]
-
-                for items in zip(*loop_items):
-                    # Unpack test parameters and build test_id
-                    if use_gpu:
-                        r, s, t, p, n, g = items
-                        test_id = f"r{r}_s{s}_t{t}_p{p}_n{n}_g{g}"
+                compare_tolerances = tolerance_flags(test_defs, ifs_cfg.get('tolerance_profile'),
+                                                     bool(ifs_cfg.get('fail_fast', False)))
+                # Without the run cache compare_norms resubmits every run,
+                # whatever its run_cache.json or the run index record
+                run_cache_flags = "" if use_run_cache else " --no-cache"
+
+                # Build the context of every configuration of every variant up
+                # front so that missing parameters are reported before anything
+                # is submitted
+                configs = []
+                config_ids = []
+                for variant, (r, s, t, p, n, g) in ((v, c) for v in variants for c in test_matrix(ifs_cfg, v["use_gpu"])):
+                    # Build test_id
+                    if variant["use_gpu"]:
+                        config_id = f"r{r}_s{s}_t{t}_p{p}_n{n}_g{g}"
                         gpu_flag = f" --gpus {quote(str(g))}"
                     else:
-                        r, s, t, p, n = items
-                        test_id = f"r{r}_s{s}_t{t}_p{p}_n{n}"
+                        config_id = f"r{r}_s{s}_t{t}_p{p}_n{n}"
                         gpu_flag = ""
-
-                    print(f"{BOLD}Processing test config: {test_id}{RESET}")
-                    test_results[test_id] = {}
+                    test_id = variant_key(config_id, variant)
+                    if config_id not in config_ids:
+                        config_ids.append(config_id)
 
                     # Build context for template substitution
                     test_context = {
+                        'test_id': test_id,
                         'remote_path': str(remote_path),
-                        'test_subdir': dnb_sandbox_subdir,
+                        'test_subdir': variant["sandbox"],
                         'gold_standard_tag': gold_standard_tag,
                         'resolution': r,
                         'steps': s,
@@ -492,8 +1224,10 @@ ln -sf {machine_file} machine.yaml
                         'ppn': p,
                         'nodes': n,
                         'gpu_flag': gpu_flag,
+                        'tolerance_flags': compare_tolerances,
+                        'run_cache_flags': run_cache_flags,
                     }
-                    if use_gpu:
+                    if variant["use_gpu"]:
                         test_context['gpus'] = g
 
                     # Validate test context
@@ -502,26 +1236,86 @@ ln -sf {machine_file} machine.yaml
                     if missing:
                         raise ValueError(f"Test context missing required params: {missing}")
 
-                    # Execute each requested test suite
-                    for suite_name in requested_test_suites:
-                        suite_def = test_defs['test_suites'][suite_name]
-                        sequence = suite_def.get('sequence', [])
-
-                        for cmd_name in sequence:
-                            print(f"{BOLD}Running {suite_name}:{cmd_name}...{RESET}")
-                            results = execute_test(
-                                conn, suite_name, suite_def, cmd_name, test_context,
-                                test_id, verbose=verbose
+                    configs.append((test_id, test_context))
+                    group_variants[test_id] = variant
+
+                if plan_commands:
+                    agent_stages.append([
+                        (test_id, [
+                            plan_command(suite_name, test_defs['test_suites'][suite_name], cmd_name, test_context, test_id)
+                            for suite_name in requested_test_suites
+                            for cmd_name in test_defs['test_suites'][suite_name].get('sequence', [])
+                        ])
+                        for test_id, test_context in configs
+                    ])
+                else:
+                    # Run the configurations on a bounded pool, each worker with its
+                    # own connection, so that their queue waits overlap
+                    workers = max(1, min(max_parallel_configs, len(configs)))
+                    print(f"{BOLD}Running {len(configs)} test configuration(s) with up to {workers} in parallel{RESET}")
+                    with ThreadPoolExecutor(max_workers=workers) as executor:
+                        futures = [
+                            executor.submit(
+                                run_config_suites, connect, host, ledger, test_id, test_context, test_defs,
+                                requested_test_suites, hide=workers > 1
                             )
-                            test_results[test_id].update(results)
-
-    # Write the results to a JSON file
-    with open(results_file, "w") as f:
-        json.dump(test_results, f, indent=4)
-    print(f"{BOLD}Test results written to {results_file} [{timestamp()}]{RESET}")
+                            for test_id, test_context in configs
+                        ]
+                        # Collect in submission order so test_results is deterministic
+                        for (test_id, _), future in zip(configs, futures):
+                            test_results.setdefault(test_id, {}).update(future.result())
+
+        if agent_stages and not detach:
+            # Ship the whole plan once and run it in a single remote session;
+            # results are merged in plan order so test_results is deterministic
+            agent_results = run_with_agent(conn, ledger, agent_stages, remote_path,
+                                           f"plan.{run_dir.name}.json", jobs=max_parallel_configs)
+            for group_id, results in agent_results.items():
+                test_results.setdefault(group_id, {}).update(results)
+
+    if detach:
+        if not ledger.skip("detached"):
+            install_variants = [] if skip_build else [v for v in variants if not ledger.is_done(variant_key("install", v))]
+            submit_detached(conn, ledger, cfg, remote_path, agent_stages, group_variants, install_variants,
+                            build_jobs, f"plan.{run_dir.name}.json", config_ids)
+        print(f"{BOLD}Jobs submitted; this machine can disconnect now. Collect the results with:{RESET}")
+        print(f"    python3 pipeline.py collect {run_dir} [--wait]")
+    else:
+        finish_run(run_dir, ledger, test_results, variants, config_ids if not no_run else [])
+
+    if ssh_manager:
+        latency_file = run_dir / "ssh_latency.json"
+        ssh_manager.write_report(latency_file)
+        for latency_host, stats in ssh_manager.report().items():
+            print(f"SSH {latency_host}: {stats['commands']} command(s), mean {stats['mean_seconds']:.2f}s, "
+                  f"p95 {stats['p95_seconds']:.2f}s, max {stats['max_seconds']:.2f}s (details in {latency_file})")
+
+def collect_main(argv):
+    """Entry point of `pipeline.py collect <run_dir>`."""
+    parser = argparse.ArgumentParser(prog="pipeline.py collect",
+                                     description="Collect the results of a pipeline run started with --detach.")
+    parser.add_argument("run_dir", help="Results directory of the detached run")
+    parser.add_argument("--wait", action="store_true", help="Wait until every job has finished")
+    parser.add_argument("--no-ssh-mux", dest="use_ssh_mux", action="store_false",
+                        help="Use a Fabric connection instead of a multiplexed OpenSSH master")
+    parser.add_argument("--compress-logs", dest="compress_logs", action="store_true",
+                        help="zstd-compress the command logs (needs the zstandard module)")
+    args = parser.parse_args(argv)
+    pending = collect(args.run_dir, wait=args.wait, use_ssh_mux=args.use_ssh_mux, compress_logs=args.compress_logs)
+    return 0 if pending == 0 else 3
 
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Build and run ifs-nemo comparison pipeline.")
+    if sys.argv[1:2] == ["collect"]:
+        try:
+            sys.exit(collect_main(sys.argv[2:]))
+        except Exception as e:
+            print("ERROR:", e)
+            import traceback
+            traceback.print_exc()
+            sys.exit(1)
+
+    parser = argparse.ArgumentParser(description="Build and run ifs-nemo comparison pipeline.",
+                                     epilog="Results of a run started with --detach are collected with: pipeline.py collect <run_dir> [--wait]")
     parser.add_argument(
         "-y", "--yaml",
         dest="pipeline_yaml",
@@ -540,16 +1334,84 @@ if __name__ == '__main__':
         action="store_true",
         help="Do the build/install but skip the run and compare stages (produce no test runs)"
     )
-    parser.add_argument(
+    build_choice = parser.add_mutually_exclusive_group()
+    build_choice.add_argument(
         "--partial-build",
-        dest="partial_build",
+        dest="build_mode",
+        action="store_const",
+        const="partial",
+        default="auto",
+        help="Always use partial build (dnb.sh :r), which does not invoke ifs-bundle. By default it is used when the bundle inputs are unchanged since the last successful build on the remote."
+    )
+    build_choice.add_argument(
+        "--full-build",
+        dest="build_mode",
+        action="store_const",
+        const="full",
+        help="Always use full build (dnb.sh :b), even if the bundle inputs are unchanged since the last successful build on the remote"
+    )
+    parser.add_argument(
+        "--max-parallel-configs",
+        dest="max_parallel_configs",
+        type=int,
+        default=1,
+        help="Maximum number of test configurations run concurrently, each over its own connection (default: 1, i.e. one after another)"
+    )
+    parser.add_argument(
+        "--no-run-cache",
+        dest="use_run_cache",
+        action="store_false",
+        help="Do not reuse results of identical test runs; the remote tests directory of the sandbox is wiped before running"
+    )
+    parser.add_argument(
+        "--full-sync",
+        dest="full_sync",
+        action="store_true",
+        help="Push the whole local build dir instead of only the files changed since the last successful push"
+    )
+    parser.add_argument(
+        "--sync-streams",
+        dest="sync_streams",
+        type=int,
+        default=4,
+        help="Maximum number of parallel rsync streams used to push large change sets (default: 4)"
+    )
+    parser.add_argument(
+        "--no-ssh-mux",
+        dest="use_ssh_mux",
+        action="store_false",
+        help="Use separate Fabric/paramiko connections instead of one multiplexed OpenSSH master per host"
+    )
+    parser.add_argument(
+        "--resume",
+        dest="resume_dir",
+        metavar="RUN_DIR",
+        help="Continue an interrupted run from its first incomplete stage, using the options recorded in RUN_DIR/stage_ledger.json"
+    )
+    parser.add_argument(
+        "--compress-logs",
+        dest="compress_logs",
+        action="store_true",
+        help="zstd-compress the command logs in the results directory (needs the zstandard module)"
+    )
+    parser.add_argument(
+        "--remote-agent",
+        dest="use_remote_agent",
+        action="store_true",
+        help="Ship the rendered suite commands once and run them all from a single remote agent process, streaming progress back (up to --max-parallel-configs configurations in parallel on the remote)"
+    )
+    parser.add_argument(
+        "--detach",
+        dest="detach",
         action="store_true",
-        help="Use partial build (dnb.sh :r) instead of full build (dnb.sh :b). Intended for quick rebuilds involving small changes in the code, and does not invoke ifs-bundle."
+        help="Submit the install and every suite command as SLURM jobs chained to the build and exit; collect the results later with 'pipeline.py collect <run_dir>'"
     )
     args = parser.parse_args()
 
     try:
-        main(args.pipeline_yaml, args.skip_build, args.no_run, args.partial_build)
+        main(args.pipeline_yaml, args.skip_build, args.no_run, args.build_mode,
+             args.max_parallel_configs, args.use_run_cache, args.full_sync, args.sync_streams,
+             args.use_ssh_mux, args.resume_dir, args.compress_logs, args.use_remote_agent, args.detach)
     except Exception as e:
         print("ERROR:", e)
         # Print traceback for easier debugging
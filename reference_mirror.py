@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Persistent local mirror of the references repository.
+
+Instead of a fresh `git clone --depth 1` of the whole references repository
+on every build, a partial (blob-less), shallow clone is kept in a cache
+directory. Each run only fetches the new tip of the branch and sparse-checks
+out the gold standard tag and the configurations of the pipeline matrix, so
+only the blobs of those paths are ever downloaded. The checked-out tree is
+then materialized into `local_build_dir/references` with hardlinks instead of
+copies, together with a content manifest per tag (see reference_stage.py).
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+from reference_stage import build_manifest, write_manifest
+
+# Default parent directory of the mirrors, one per references URL
+DEFAULT_MIRROR_ROOT = Path.home() / ".cache" / "ifsnemo-compare" / "references"
+
+
+def default_mirror_dir(url: str) -> Path:
+    """Return the mirror directory used for `url` when none is configured."""
+    digest = hashlib.sha1(url.encode()).hexdigest()[:12]
+    return DEFAULT_MIRROR_ROOT / digest
+
+
+def config_reference_dir(resolution, threads, ppn, nodes, gpus, steps) -> str:
+    """
+    Relative directory of one configuration below a reference tag, laid out
+    like compare_norms.run_dir (the gpus component only when non-zero).
+    """
+    parts = [str(resolution), f"nthreads{threads}", f"ppn{ppn}", f"nnodes{nodes}"]
+    if gpus:
+        parts.append(f"gpus{gpus}")
+    parts.append(f"nsteps{steps}")
+    return "/".join(parts)
+
+
+def sparse_paths(path_in_repo: str, tag: str, matrix: list) -> list:
+    """
+    Paths of the references repository needed for `tag` and the test matrix.
+
+    Args:
+        path_in_repo: Directory of the references within the repository
+        tag: Gold standard tag
+        matrix: List of (resolution, steps, threads, ppn, nodes, gpus) tuples
+
+    Returns:
+        Sorted list of repository paths for `git sparse-checkout set --cone`
+    """
+    tag_dir = f"{path_in_repo.strip('/')}/{tag.strip('/')}"
+    paths = {f"{tag_dir}/bundle_validator"}
+    for r, s, t, p, n, g in matrix:
+        paths.add(f"{tag_dir}/{config_reference_dir(r, t, p, n, g, s)}")
+    return sorted(paths)
+
+
+def git(args: list, cwd: Path, verbose: bool = False) -> str:
+    """Run a git command in `cwd` and return its stdout."""
+    if verbose:
+        print(f"Running: git {' '.join(args)} in {cwd}")
+    result = subprocess.run(["git", *args], cwd=cwd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, ["git", *args], result.stdout, result.stderr)
+    return result.stdout
+
+
+def update_mirror(url: str, branch: str, mirror_dir: Path, paths: list = None, verbose: bool = False) -> str:
+    """
+    Create or update the mirror and check out `paths` of the tip of `branch`.
+
+    Args:
+        url: URL of the references repository
+        branch: Branch to check out
+        mirror_dir: Directory of the mirror
+        paths: Repository paths to check out (None for the whole tree)
+        verbose: Print the git commands
+
+    Returns:
+        Commit checked out in the mirror
+    """
+    mirror_dir = Path(mirror_dir)
+    if not (mirror_dir / ".git").is_dir():
+        if mirror_dir.exists():
+            shutil.rmtree(mirror_dir)
+        mirror_dir.parent.mkdir(parents=True, exist_ok=True)
+        print(f"Creating reference mirror in {mirror_dir}")
+        git(["clone", "--filter=blob:none", "--no-checkout", "--depth", "1", "--branch", branch,
+             url, str(mirror_dir)], cwd=mirror_dir.parent, verbose=verbose)
+    else:
+        if git(["remote", "get-url", "origin"], mirror_dir).strip() != url:
+            git(["remote", "set-url", "origin", url], mirror_dir, verbose=verbose)
+        git(["fetch", "--filter=blob:none", "--depth", "1", "origin", branch], mirror_dir, verbose=verbose)
+
+    if paths:
+        git(["sparse-checkout", "set", "--cone", *paths], mirror_dir, verbose=verbose)
+    else:
+        git(["sparse-checkout", "disable"], mirror_dir, verbose=verbose)
+
+    # Blobs of the sparse paths are fetched on demand by the checkout
+    ref = "FETCH_HEAD" if (mirror_dir / ".git" / "FETCH_HEAD").exists() else "HEAD"
+    git(["checkout", "--force", "-B", branch, ref], mirror_dir, verbose=verbose)
+    return git(["rev-parse", "HEAD"], mirror_dir).strip()
+
+
+def tree_blobs(mirror_dir: Path, path: str) -> dict:
+    """
+    Return {path relative to `path`: (blob id, size)} for the files below
+    `path` at HEAD, straight from the git index of the mirror (no hashing).
+    """
+    out = git(["ls-tree", "-r", "-l", "-z", "HEAD", "--", path.strip("/") + "/"], mirror_dir)
+    blobs = {}
+    prefix = path.strip("/") + "/"
+    for record in out.split("\0"):
+        if not record:
+            continue
+        meta, name = record.split("\t", 1)
+        mode, kind, blob, size = meta.split()
+        if kind == "blob":
+            blobs[name[len(prefix):]] = (blob, 0 if size == "-" else int(size))
+    return blobs
+
+
+def link_tree(source: Path, target: Path) -> int:
+    """
+    Replace `target` with a copy of `source` made of hardlinks.
+
+    Falls back to copying when hardlinks are not possible (e.g. the mirror is
+    on another filesystem). Files keep the mtime of the mirror, so the delta
+    sync does not push unchanged references again.
+
+    Returns:
+        Number of files materialized
+    """
+    source, target = Path(source), Path(target)
+    if target.is_symlink() or target.is_file():
+        target.unlink()
+    elif target.exists():
+        shutil.rmtree(target)
+    target.mkdir(parents=True)
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(source):
+        rel = Path(dirpath).relative_to(source)
+        (target / rel).mkdir(parents=True, exist_ok=True)
+        for name in filenames:
+            src, dst = Path(dirpath) / name, target / rel / name
+            if src.is_symlink():
+                os.symlink(os.readlink(src), dst)
+            else:
+                try:
+                    os.link(src, dst)
+                except OSError:
+                    shutil.copy2(src, dst)
+            count += 1
+    return count
+
+
+def materialize_references(ref_cfg: dict, tag: str, matrix: list, target: Path, verbose: bool = False) -> str:
+    """
+    Bring `target` up to date with the references of `tag` for `matrix`.
+
+    Args:
+        ref_cfg: `references` section of the pipeline YAML
+        tag: Gold standard tag
+        matrix: List of (resolution, steps, threads, ppn, nodes, gpus) tuples
+        target: Local references directory, e.g. local_build_dir/references
+        verbose: Print the git commands
+
+    Returns:
+        Commit of the references repository that was materialized
+    """
+    url = ref_cfg["url"]
+    branch = ref_cfg.get("branch", "main")
+    path_in_repo = ref_cfg["path_in_repo"].strip("/")
+    mirror_dir = Path(ref_cfg.get("mirror_dir") or default_mirror_dir(url)).expanduser()
+
+    # Without a tag there is nothing to narrow the checkout down to
+    paths = sparse_paths(path_in_repo, tag, matrix) if tag and ref_cfg.get("sparse", True) else [path_in_repo]
+    commit = update_mirror(url, branch, mirror_dir, paths, verbose=verbose)
+
+    count = link_tree(mirror_dir / path_in_repo, target)
+
+    # One content manifest per tag, for hash-gated staging on the remote,
+    # covering the files that were checked out
+    by_tag = {}
+    for rel, entry in tree_blobs(mirror_dir, path_in_repo).items():
+        tag_name, _, rest = rel.partition("/")
+        if rest and os.path.lexists(target / rel):
+            by_tag.setdefault(tag_name, {})[rest] = entry
+    for tag_name, blobs in by_tag.items():
+        write_manifest(target / tag_name, build_manifest(blobs, commit))
+
+    print(f"Materialized {count} reference file(s) from {url}@{commit[:12]} into {target}")
+    return commit
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Hash-gated staging of references into the test arena.
+
+The references pushed to the remote (`ifsnemo-build/references`, the store)
+carry one content manifest per gold standard tag, `<tag>/.ref_manifest.json`.
+It maps every result set (a directory that directly holds files, e.g.
+`tco79-eORCA1/nthreads4/ppn28/nnodes1/nstepsd1/results`) to a digest of its
+files. The manifest is written locally from the git blob IDs of the reference
+mirror, so nothing is hashed on GPFS.
+
+Staging reads the manifest of the store and the copy left in the test arena
+(`ifsnemo-build/ifsnemo/references`) by the previous staging, and only copies
+the result sets that are missing or changed. The same manifests answer whether
+the arena holds the exact references a compare needs, without walking the
+tree:
+
+    python3 reference_stage.py check --store <store> --arena <arena> -g <tag> [--set <prefix> ...]
+"""
+import argparse
+import hashlib
+import json
+import os
+import posixpath
+import subprocess
+import sys
+from pathlib import Path
+from shlex import quote
+
+MANIFEST_FILENAME = ".ref_manifest.json"
+
+# Result sets per remote command when staging, to bound the command length
+STAGE_BATCH = 50
+
+
+def build_manifest(blobs: dict, commit: str = None) -> dict:
+    """
+    Group the files of one tag into result sets and digest each set.
+
+    Args:
+        blobs: {path relative to the tag dir: (blob id, size)}
+        commit: Commit of the references repository the files come from
+
+    Returns:
+        Manifest dictionary {"commit", "sets": {set: {"digest", "files", "bytes"}}}
+    """
+    grouped = {}
+    for rel, (blob, size) in blobs.items():
+        if posixpath.basename(rel) == MANIFEST_FILENAME:
+            continue
+        grouped.setdefault(posixpath.dirname(rel) or ".", []).append((posixpath.basename(rel), blob, size))
+    sets = {}
+    for name, files in sorted(grouped.items()):
+        h = hashlib.sha256()
+        for filename, blob, _ in sorted(files):
+            h.update(f"{filename}\0{blob}\n".encode())
+        sets[name] = {
+            "digest": h.hexdigest(),
+            "files": len(files),
+            "bytes": sum(size for _, _, size in files),
+        }
+    return {"commit": commit, "sets": sets}
+
+
+def write_manifest(tag_dir: Path, manifest: dict) -> None:
+    """Write the manifest of a tag into its directory."""
+    path = Path(tag_dir) / MANIFEST_FILENAME
+    path.write_text(json.dumps(manifest, indent=1, sort_keys=True) + "\n")
+
+
+def read_manifest(run, path: str):
+    """Read a manifest with `run` (a command runner); None if missing or invalid."""
+    code, out = run(f"cat {quote(path)}")
+    if code != 0:
+        return None
+    try:
+        return json.loads(out)
+    except ValueError:
+        return None
+
+
+def outdated_sets(store: dict, arena: dict, prefixes: list = None) -> list:
+    """
+    Result sets of the store that are missing from or differ in the arena.
+
+    Args:
+        store: Manifest of the store
+        arena: Manifest of the arena (None if nothing was staged yet)
+        prefixes: Only consider sets equal to or below one of these paths
+    """
+    arena_sets = (arena or {}).get("sets", {})
+    outdated = []
+    for name, entry in store["sets"].items():
+        if prefixes and not any(name == p or name.startswith(p.rstrip("/") + "/") for p in prefixes):
+            continue
+        if arena_sets.get(name, {}).get("digest") != entry["digest"]:
+            outdated.append(name)
+    return outdated
+
+
+def missing_prefixes(store: dict, prefixes: list) -> list:
+    """Prefixes for which the store has no result set at all."""
+    return [p for p in prefixes
+            if not any(n == p or n.startswith(p.rstrip("/") + "/") for n in store["sets"])]
+
+
+def stage_references(run, store_dir: str, arena_dir: str, tag: str) -> dict:
+    """
+    Copy the changed result sets of `tag` from the store into the arena.
+
+    Falls back to a plain rsync of the whole store when the store has no
+    manifest for the tag (e.g. references pushed by an older version).
+
+    Args:
+        run: Callable running a shell command on the remote, returning (exit code, stdout)
+        store_dir: References directory pushed to the remote
+        arena_dir: References directory of the test arena
+        tag: Gold standard tag
+
+    Returns:
+        Dictionary with the staged and up-to-date result sets
+    """
+    tag = tag.strip("/")
+    store_tag, arena_tag = f"{store_dir}/{tag}", f"{arena_dir}/{tag}"
+    store = read_manifest(run, f"{store_tag}/{MANIFEST_FILENAME}")
+    if store is None:
+        print(f"No reference manifest in {store_tag}; copying the whole reference store.")
+        code, _ = run(f"mkdir -p {quote(arena_dir)} && rsync -a {quote(store_dir)}/ {quote(arena_dir)}/")
+        if code != 0:
+            raise RuntimeError(f"Copying references from {store_dir} to {arena_dir} failed")
+        return {"staged": None, "up_to_date": None}
+
+    arena = read_manifest(run, f"{arena_tag}/{MANIFEST_FILENAME}")
+    outdated = outdated_sets(store, arena)
+    for start in range(0, len(outdated), STAGE_BATCH):
+        cmds = []
+        for name in outdated[start:start + STAGE_BATCH]:
+            src, dst = quote(f"{store_tag}/{name}") + "/", quote(f"{arena_tag}/{name}") + "/"
+            # Files of this set only; its subdirectories are sets of their own
+            cmds.append(f"mkdir -p {dst} && rsync -a --delete --exclude='*/' {src} {dst}")
+        code, _ = run(" && ".join(cmds))
+        if code != 0:
+            raise RuntimeError(f"Staging references of {tag} into {arena_dir} failed")
+    # The arena manifest is updated last, so an interrupted staging is redone
+    code, _ = run(f"mkdir -p {quote(arena_tag)} && cp {quote(store_tag)}/{MANIFEST_FILENAME} {quote(arena_tag)}/{MANIFEST_FILENAME}")
+    if code != 0:
+        raise RuntimeError(f"Writing the reference manifest of {arena_tag} failed")
+
+    staged_bytes = sum(store["sets"][n]["bytes"] for n in outdated)
+    print(f"References {tag}@{(store.get('commit') or '?')[:12]}: staged {len(outdated)} result set(s) "
+          f"({staged_bytes} bytes), {len(store['sets']) - len(outdated)} already up to date")
+    return {"staged": outdated, "up_to_date": len(store["sets"]) - len(outdated)}
+
+
+def check_arena(run, store_dir: str, arena_dir: str, tag: str, prefixes: list = None) -> list:
+    """
+    Check that the arena holds exactly the store's references below `prefixes`.
+
+    Returns:
+        List of problems, empty if the arena is up to date
+    """
+    tag = tag.strip("/")
+    store = read_manifest(run, f"{store_dir}/{tag}/{MANIFEST_FILENAME}")
+    if store is None:
+        return [f"no reference manifest in {store_dir}/{tag}"]
+    arena = read_manifest(run, f"{arena_dir}/{tag}/{MANIFEST_FILENAME}")
+    problems = [f"not in the reference store: {p}" for p in missing_prefixes(store, prefixes or [])]
+    problems += [f"missing or outdated in the arena: {n}" for n in outdated_sets(store, arena, prefixes)]
+    return problems
+
+
+def local_runner(cmd):
+    """Run a shell command on this machine and return (exit code, stdout)."""
+    result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+    return result.returncode, result.stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stage references into the test arena, or check that they are staged.")
+    parser.add_argument("action", choices=["stage", "check"])
+    parser.add_argument("--store", required=True, help="References directory pushed by the pipeline")
+    parser.add_argument("--arena", required=True, help="References directory of the test arena")
+    parser.add_argument("-g", "--tag", required=True, help="Gold standard tag")
+    parser.add_argument("--set", dest="prefixes", action="append", default=[],
+                        help="Only check result sets at or below this path of the tag (repeatable)")
+    args = parser.parse_args()
+
+    store_dir, arena_dir = os.path.abspath(args.store), os.path.abspath(args.arena)
+    if args.action == "stage":
+        stage_references(local_runner, store_dir, arena_dir, args.tag)
+        return 0
+    problems = check_arena(local_runner, store_dir, arena_dir, args.tag, args.prefixes)
+    for problem in problems:
+        print(problem)
+    print("references up to date" if not problems else f"{len(problems)} problem(s)")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
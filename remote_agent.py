@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+Remote driver agent for ifsnemo-compare.
+
+Instead of one SSH round trip per (configuration, suite, command), the
+pipeline renders the whole execution plan, ships it once together with this
+file, and starts a single agent process on the login node:
+
+    python3 remote_agent.py plan.json --jobs 4
+
+The plan is a list of stages run one after another (build suites, then the
+test configurations). Each stage holds groups that run in parallel, up to
+--jobs at a time, and each group is a list of steps (rendered commands) run
+in order. Progress and results are streamed back on stdout as NDJSON events:
+
+    {"event": "start", "step": ..., "time": ...}
+    {"event": "output", "step": ..., "line": ...}
+    {"event": "end", "step": ..., "return_code": ..., "report": {...}, "time": ...}
+    {"event": "done", "passed": ..., "failed": ..., "time": ...}
+
+Reports declared by a command (report_file) are read by the agent and sent
+with its end event, so no separate copy is needed.
+
+In detached mode (pipeline.py --detach) every step is a SLURM job of its own
+running `remote_agent.py plan.json --step <id>`, with the events going to the
+job's output file until `pipeline.py collect` reads them.
+
+The agent side only uses the standard library; AgentEventStream and
+run_remote_plan are used by pipeline.py on the local side.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from shlex import quote
+
+# Remote directory (below remote_project_dir) receiving the agent and plans
+AGENT_DIRNAME = ".ifsnemo-agent"
+
+_emit_lock = threading.Lock()
+
+
+def emit(event, **fields):
+    """Write one NDJSON event to stdout."""
+    fields["event"] = event
+    fields["time"] = time.time()
+    line = json.dumps(fields)
+    with _emit_lock:
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+
+def read_report(path):
+    """Load a JSON report written by a command; None if missing or invalid."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def run_step(step):
+    """Run one step, streaming its output as events. Returns True if it passed."""
+    emit("start", step=step["id"], command=step["command"])
+    env = dict(os.environ, PYTHONUNBUFFERED="1")
+    proc = subprocess.Popen(step["command"], shell=True, env=env, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            universal_newlines=True, bufsize=1)
+    for line in proc.stdout:
+        emit("output", step=step["id"], line=line)
+    proc.wait()
+    report = read_report(step["report_file"]) if step.get("report_file") else None
+    emit("end", step=step["id"], return_code=proc.returncode, report=report)
+    return proc.returncode == 0
+
+
+def run_group(group):
+    """Run the steps of a group in order; a failed step does not stop the group."""
+    return [run_step(step) for step in group["steps"]]
+
+
+def find_step(plan, step_id):
+    """Return the step `step_id` of `plan`."""
+    for stage in plan["stages"]:
+        for group in stage["groups"]:
+            for step in group["steps"]:
+                if step["id"] == step_id:
+                    return step
+    raise KeyError(f"No step {step_id} in the plan")
+
+
+def run_plan(plan, jobs):
+    """Run every stage of `plan`; returns (passed, failed) step counts."""
+    passed = failed = 0
+    for stage in plan["stages"]:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            for outcomes in executor.map(run_group, stage["groups"]):
+                passed += sum(outcomes)
+                failed += len(outcomes) - sum(outcomes)
+    return passed, failed
+
+
+class AgentEventStream:
+    """
+    File-like sink for the agent's stdout (pass as out_stream to conn.run).
+
+    Complete NDJSON lines are decoded and passed to `handler(event)`; any
+    other line (e.g. a login banner) is printed as-is.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self._partial = ""
+
+    def write(self, data):
+        text = self._partial + data
+        *lines, self._partial = text.split("\n")
+        for line in lines:
+            line = line.rstrip("\r")
+            if not line:
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError:
+                print(line)
+                continue
+            self.handler(event)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def ship_plan(conn, plan, remote_project_dir, plan_name):
+    """
+    Copy the agent and `plan` to `<remote_project_dir>/.ifsnemo-agent/`.
+
+    Returns:
+        Remote directory holding the agent and the plan
+    """
+    remote_dir = f"{remote_project_dir}/{AGENT_DIRNAME}"
+    local_plan = f"{plan_name}.tmp"
+    with open(local_plan, "w") as f:
+        json.dump(plan, f)
+    try:
+        conn.run(f"mkdir -p {quote(remote_dir)}", hide=True)
+        conn.put(os.path.abspath(__file__), f"{remote_dir}/remote_agent.py")
+        conn.put(local_plan, f"{remote_dir}/{plan_name}")
+    finally:
+        os.unlink(local_plan)
+    return remote_dir
+
+
+def run_remote_plan(conn, plan, remote_project_dir, plan_name, handler, jobs=1):
+    """
+    Ship the agent and `plan` to the remote and run it in a single session.
+
+    Args:
+        conn: Connection to the remote (Fabric or ssh_mux)
+        plan: Execution plan {"stages": [{"groups": [{"id", "steps"}]}]}
+        remote_project_dir: remote_project_dir of the pipeline YAML
+        plan_name: File name for the plan on the remote
+        handler: Called with every event decoded from the agent
+        jobs: Groups run in parallel on the remote
+
+    Returns:
+        Exit code of the agent
+    """
+    remote_dir = ship_plan(conn, plan, remote_project_dir, plan_name)
+    stream = AgentEventStream(handler)
+    result = conn.run(f"python3 {quote(remote_dir)}/remote_agent.py {quote(remote_dir)}/{quote(plan_name)} --jobs {int(jobs)}",
+                      warn=True, out_stream=stream)
+    stream.write("\n")
+    return result.return_code
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run an ifsnemo-compare execution plan and stream NDJSON events.")
+    parser.add_argument("plan", help="Execution plan (JSON) rendered by pipeline.py")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Groups (test configurations) run in parallel")
+    parser.add_argument("--step", help="Only run this step (detached mode); the exit code is the step's")
+    args = parser.parse_args()
+
+    with open(args.plan) as f:
+        plan = json.load(f)
+    if args.step:
+        passed = run_step(find_step(plan, args.step))
+        emit("done", passed=int(passed), failed=int(not passed))
+        return 0 if passed else 1
+    passed, failed = run_plan(plan, args.jobs)
+    emit("done", passed=passed, failed=failed)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
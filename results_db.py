@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Cross-run results history for ifsnemo-compare.
+
+Every pipeline run is ingested into a local SQLite database
+(`results/history.sqlite`): one row per run, per suite command result, per
+compared norm variable and per timing span. Queries over hundreds of runs
+then take milliseconds instead of globbing and parsing every
+`results/<run>/test_results.json`.
+
+    python3 results_db.py ingest results/*__pipeline           # (re)ingest existing runs
+    python3 results_db.py history --test-id rtco399-eORCA025_sd1_t4_p28_n16
+    python3 results_db.py divergence --test-id rtco399-eORCA025_sd1_t4_p28_n16
+    python3 results_db.py timings --name compare_norms:run-tests --last 30
+
+Runs are only ever added; ingesting a run again (e.g. after --resume)
+replaces the rows of that run. Every result row carries the branch of the
+build it tested, so --branch also finds the variants of multi-variant runs.
+"""
+import argparse
+import json
+import re
+import sqlite3
+import sys
+from datetime import datetime
+from pathlib import Path
+
+DEFAULT_DB = Path("results") / "history.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    timestamp TEXT,
+    pipeline_yaml TEXT,
+    gold_standard_tag TEXT,
+    branch TEXT,
+    sandbox TEXT,
+    ingested_at TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id TEXT,
+    test_id TEXT,
+    suite TEXT,
+    command TEXT,
+    passed INTEGER,
+    output TEXT,
+    resolution TEXT,
+    steps TEXT,
+    threads INTEGER,
+    ppn INTEGER,
+    nodes INTEGER,
+    gpus INTEGER,
+    first_divergence_step INTEGER,
+    first_divergence_variable TEXT,
+    report TEXT,
+    perf_passed INTEGER,
+    variant TEXT,
+    branch TEXT
+);
+CREATE TABLE IF NOT EXISTS norm_diffs (
+    run_id TEXT,
+    test_id TEXT,
+    variable TEXT,
+    identical INTEGER,
+    first_divergent_step INTEGER,
+    max_abs_diff REAL,
+    max_rel_diff REAL,
+    max_ulp_diff REAL
+);
+CREATE TABLE IF NOT EXISTS timings (
+    run_id TEXT,
+    test_id TEXT,
+    name TEXT,
+    category TEXT,
+    start REAL,
+    seconds REAL,
+    status TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_timestamp ON runs (timestamp);
+CREATE INDEX IF NOT EXISTS runs_tag ON runs (gold_standard_tag);
+CREATE INDEX IF NOT EXISTS runs_branch ON runs (branch);
+CREATE INDEX IF NOT EXISTS results_test_id ON results (test_id);
+CREATE INDEX IF NOT EXISTS results_suite ON results (suite);
+CREATE INDEX IF NOT EXISTS results_run ON results (run_id);
+CREATE INDEX IF NOT EXISTS norm_diffs_test_id ON norm_diffs (test_id, variable);
+CREATE INDEX IF NOT EXISTS timings_name ON timings (name, test_id);
+"""
+
+# Columns of the results table added after its first version, in order
+ADDED_RESULT_COLUMNS = [("perf_passed", "INTEGER"), ("variant", "TEXT"), ("branch", "TEXT")]
+
+# test_id as built by pipeline.py, e.g. rtco79-eORCA1_sd1_t4_p28_n1[_g4][@<variant>]
+TEST_ID_RE = re.compile(r"^r(?P<resolution>.+)_s(?P<steps>[^_]+)_t(?P<threads>\d+)_p(?P<ppn>\d+)_n(?P<nodes>\d+)(?:_g(?P<gpus>\d+))?"
+                        r"(?:@(?P<variant>.+))?$")
+
+
+def connect(db_path=DEFAULT_DB) -> sqlite3.Connection:
+    """Open (and create if needed) the history database."""
+    db_path = Path(db_path)
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(db_path)
+    db.row_factory = sqlite3.Row
+    db.executescript(SCHEMA)
+    # Columns added after the first version of the schema
+    columns = {row["name"] for row in db.execute("PRAGMA table_info(results)")}
+    for column, kind in ADDED_RESULT_COLUMNS:
+        if column not in columns:
+            db.execute(f"ALTER TABLE results ADD COLUMN {column} {kind}")
+    db.execute("CREATE INDEX IF NOT EXISTS results_branch ON results (branch)")
+    return db
+
+
+def _load_json(path: Path):
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def run_timestamp(run_id: str):
+    """ISO timestamp from a run directory name <YYYYmmdd_HHMMSS>__<yaml>."""
+    try:
+        return datetime.strptime(run_id.split("__")[0], "%Y%m%d_%H%M%S").isoformat()
+    except ValueError:
+        return None
+
+
+def split_output(output: str, test_id: str):
+    """(suite, output prefix) from a log name <suite>-<prefix>-<test_id>.log[.zst]."""
+    name = Path(output).name
+    stem = name.split(f"-{test_id}.log")[0]
+    suite, _, prefix = stem.partition("-")
+    return suite, prefix
+
+
+def _flag(value):
+    """0/1 for a boolean result, None if it was not recorded."""
+    return None if value is None else int(bool(value))
+
+
+def ingest_run(db: sqlite3.Connection, run_dir) -> int:
+    """
+    Ingest one results directory (test_results.json, stage_ledger.json meta
+    and timings.json).
+
+    Returns:
+        Number of command results ingested
+    """
+    run_dir = Path(run_dir)
+    run_id = run_dir.name
+    test_results = _load_json(run_dir / "test_results.json")
+    if test_results is None:
+        raise FileNotFoundError(f"No test_results.json in {run_dir}")
+    meta = (_load_json(run_dir / "stage_ledger.json") or {}).get("meta", {})
+    timings = (_load_json(run_dir / "timings.json") or {}).get("spans", [])
+    # Branch of each build variant; runs ingested before it was recorded only
+    # have the (joined) branches of the run
+    variant_branches = meta.get("variant_branches") or {}
+
+    results_rows = []
+    diff_rows = []
+    for test_id, results in test_results.items():
+        params = TEST_ID_RE.match(test_id)
+        params = params.groupdict() if params else {}
+        # Build suites of a variant run as "build@<variant>"
+        variant = params.get("variant") or (test_id.partition("@")[2] or None)
+        branch = variant_branches.get(variant) if variant else meta.get("branch")
+        for key, output in results.items():
+            if not key.endswith("_output"):
+                continue
+            prefix = key[:-len("_output")]
+            suite, _ = split_output(output, test_id)
+            report = results.get(f"{prefix}_report")
+            first = {}
+            for entry in (report or {}).get("reports", []):
+                for name, m in entry.get("variables", {}).items():
+                    diff_rows.append((run_id, test_id, name, int(m["identical"]), m["first_divergent_step"],
+                                      m["max_abs_diff"], m["max_rel_diff"], m["max_ulp_diff"]))
+                if entry.get("first_divergence") and not first:
+                    first = entry["first_divergence"]
+            results_rows.append((
+                run_id, test_id, suite, prefix, int(bool(results.get(f"{prefix}_passed"))), output,
+                params.get("resolution"), params.get("steps"), params.get("threads"), params.get("ppn"),
+                params.get("nodes"), params.get("gpus"), first.get("step"), first.get("variable"),
+                json.dumps(report) if report is not None else None,
+                _flag(results.get(f"{prefix}_perf_passed")), variant, branch,
+            ))
+
+    timing_rows = [(run_id, s.get("args", {}).get("test_id"), s["name"], s["category"], s["start"],
+                    s["seconds"], s.get("status")) for s in timings]
+
+    with db:
+        for table in ("runs", "results", "norm_diffs", "timings"):
+            db.execute(f"DELETE FROM {table} WHERE run_id = ?", (run_id,))
+        db.execute("INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)", (
+            run_id, run_timestamp(run_id), meta.get("pipeline_yaml"), meta.get("gold_standard_tag"),
+            meta.get("branch"), meta.get("sandbox"), datetime.now().isoformat(timespec="seconds"),
+        ))
+        db.executemany("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", results_rows)
+        db.executemany("INSERT INTO norm_diffs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", diff_rows)
+        db.executemany("INSERT INTO timings VALUES (?, ?, ?, ?, ?, ?, ?)", timing_rows)
+    return len(results_rows)
+
+
+def _filters(args, columns):
+    """
+    WHERE clause and parameters for the common filter options. `columns` maps
+    options to a column compared with `=`, or to a condition with one `?`.
+    """
+    clauses, params = [], []
+    for option, column in columns.items():
+        value = getattr(args, option, None)
+        if value is not None:
+            clauses.append(column if "?" in column else f"{column} = ?")
+            params.append(value)
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+RUN_FILTERS = {"tag": "r.gold_standard_tag"}
+
+
+def branch_filter(alias):
+    """Condition matching the rows of table `alias` whose test was built from the --branch value."""
+    return (f"EXISTS (SELECT 1 FROM results b WHERE b.run_id = {alias}.run_id AND b.branch = ? "
+            f"AND ({alias}.test_id IS NULL OR b.test_id = {alias}.test_id))")
+
+
+def query_history(db, args):
+    where, params = _filters(args, dict(RUN_FILTERS, branch="x.branch", test_id="x.test_id", suite="x.suite",
+                                        command="x.command", variant="x.variant"))
+    return db.execute(f"""
+        SELECT r.timestamp, x.run_id, x.test_id, x.variant, x.branch, x.suite, x.command, x.passed, x.perf_passed,
+               x.first_divergence_step, x.first_divergence_variable
+        FROM results x JOIN runs r USING (run_id){where}
+        ORDER BY r.timestamp DESC LIMIT ?""", params + [args.last]).fetchall()
+
+
+def query_divergence(db, args):
+    """Per run, the first divergent step of the test configuration (earliest run first)."""
+    where, params = _filters(args, dict(RUN_FILTERS, branch=branch_filter("d"), test_id="d.test_id",
+                                        variable="d.variable"))
+    return db.execute(f"""
+        SELECT r.timestamp, d.run_id, d.test_id, MIN(d.first_divergent_step) AS first_divergent_step,
+               SUM(1 - d.identical) AS divergent_variables, MAX(d.max_rel_diff) AS max_rel_diff
+        FROM norm_diffs d JOIN runs r USING (run_id){where}
+        GROUP BY d.run_id, d.test_id
+        ORDER BY r.timestamp DESC LIMIT ?""", params + [args.last]).fetchall()
+
+
+def query_timings(db, args):
+    where, params = _filters(args, dict(RUN_FILTERS, branch=branch_filter("t"), test_id="t.test_id",
+                                        name="t.name", category="t.category"))
+    return db.execute(f"""
+        SELECT r.timestamp, t.run_id, t.test_id, t.name, t.category, ROUND(t.seconds, 1) AS seconds
+        FROM timings t JOIN runs r USING (run_id){where}
+        ORDER BY r.timestamp DESC, t.start LIMIT ?""", params + [args.last]).fetchall()
+
+
+def print_rows(rows, as_json=False):
+    """Print query rows as a table or as JSON."""
+    rows = [dict(row) for row in rows]
+    if as_json:
+        print(json.dumps(rows, indent=2))
+        return
+    if not rows:
+        print("No matching rows.")
+        return
+    columns = list(rows[0])
+    widths = [max(len(c), *(len(str(r[c])) for r in rows)) for c in columns]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for r in rows:
+        print("  ".join(str(r[c]).ljust(w) for c, w in zip(columns, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the history of pipeline results.")
+    parser.add_argument("--db", default=str(DEFAULT_DB), help=f"History database (default: {DEFAULT_DB})")
+    subs = parser.add_subparsers(dest="cmd", required=True)
+
+    p_ingest = subs.add_parser("ingest", help="Ingest results directories")
+    p_ingest.add_argument("run_dirs", nargs="+")
+
+    queries = {
+        "history": (query_history, "Pass/fail and first divergence of suite commands per run"),
+        "divergence": (query_divergence, "First divergent step and largest relative norm difference per run"),
+        "timings": (query_timings, "Duration of stages and suite commands per run"),
+    }
+    for name, (func, help_text) in queries.items():
+        p = subs.add_parser(name, help=help_text)
+        p.add_argument("--test-id")
+        p.add_argument("--tag", help="gold_standard_tag")
+        p.add_argument("--branch", help="Branch of the build under test (of its variant in multi-variant runs)")
+        p.add_argument("--last", type=int, default=50, help="Maximum number of rows (default: 50)")
+        p.add_argument("--json", action="store_true", help="Print JSON instead of a table")
+        p.set_defaults(func=func)
+    subs.choices["history"].add_argument("--suite")
+    subs.choices["history"].add_argument("--command", help="Output prefix of the command, e.g. run_tests")
+    subs.choices["history"].add_argument("--variant", help="Build variant (multi-variant pipelines)")
+    subs.choices["divergence"].add_argument("--variable")
+    subs.choices["timings"].add_argument("--name", help="Span name, e.g. compare_norms:run-tests")
+    subs.choices["timings"].add_argument("--category", help="e.g. queue, compute, network")
+
+    args = parser.parse_args()
+    db = connect(args.db)
+    if args.cmd == "ingest":
+        for run_dir in args.run_dirs:
+            try:
+                count = ingest_run(db, run_dir)
+                print(f"Ingested {run_dir}: {count} result(s)")
+            except (OSError, ValueError) as e:
+                print(f"[WARN] skipping {run_dir}: {e}", file=sys.stderr)
+        return 0
+    print_rows(args.func(db, args), args.json)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
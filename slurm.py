@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+SLURM job watcher for ifsnemo-compare.
+
+Tracks any number of SLURM jobs with a single squeue query per tick (plus a
+single sacct query for jobs that have left the queue), backing off adaptively
+while nothing changes. The watcher only needs a callable that runs a shell
+command, so it works locally (compare_norms on the login node) as well as over
+a Fabric connection (pipeline.py).
+"""
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+# States after which a job will never run again
+TERMINAL_STATES = {
+    'COMPLETED', 'FAILED', 'TIMEOUT', 'NODE_FAIL', 'CANCELLED', 'OUT_OF_MEMORY',
+    'PREEMPTED', 'BOOT_FAIL', 'DEADLINE', 'REVOKED',
+}
+
+# Reported when a job has left the queue and sacct has no record of it
+UNKNOWN_STATE = 'UNKNOWN'
+
+# A runner takes a shell command and returns (exit code, stdout)
+Runner = Callable[[str], Tuple[int, str]]
+
+
+def local_runner(cmd: str) -> Tuple[int, str]:
+    """Run a shell command on this machine and return (exit code, stdout)."""
+    result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+    return result.returncode, result.stdout
+
+
+def parse_state(raw: str) -> str:
+    """Normalize a SLURM state string, e.g. 'CANCELLED by 1234' -> 'CANCELLED'."""
+    raw = raw.strip()
+    if not raw:
+        return UNKNOWN_STATE
+    return raw.split()[0].rstrip('+').upper()
+
+
+class JobWatcher:
+    """
+    Watch a set of SLURM jobs until they reach a terminal state.
+
+    Every tick issues one `squeue --me` query for all tracked jobs and, only if
+    some of them have left the queue, one `sacct` query to learn how they
+    ended. The poll interval starts at `min_interval` and grows by `backoff`
+    each tick without a state change, capped at `max_interval` while all jobs
+    are pending and at `running_interval` once one of them is running. Any
+    state change resets it to `min_interval`.
+    """
+
+    def __init__(self, run: Runner = local_runner, min_interval: float = 5,
+                 running_interval: float = 30, max_interval: float = 120,
+                 backoff: float = 1.5, verbose: bool = True):
+        self.run = run
+        self.min_interval = min_interval
+        self.running_interval = running_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.verbose = verbose
+        self.states: Dict[str, str] = {}
+        self.interval = min_interval
+
+    def add(self, job_id: str) -> None:
+        """Start tracking a job."""
+        self.states.setdefault(str(job_id), 'PENDING')
+
+    def pending(self) -> list:
+        """Job IDs that have not reached a terminal state yet."""
+        return [j for j, s in self.states.items() if s not in TERMINAL_STATES and s != UNKNOWN_STATE]
+
+    def _query_squeue(self) -> Optional[Dict[str, str]]:
+        code, out = self.run("squeue --me -h -o '%i %T'")
+        if code != 0:
+            return None
+        queued = {}
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) >= 2:
+                queued[fields[0]] = parse_state(fields[1])
+        return queued
+
+    def _query_sacct(self, job_ids: Iterable[str]) -> Dict[str, str]:
+        job_list = ','.join(job_ids)
+        code, out = self.run(f"sacct -n -X -P -o JobID,State -j {job_list}")
+        if code != 0:
+            return {}
+        finished = {}
+        for line in out.splitlines():
+            fields = line.split('|')
+            if len(fields) >= 2:
+                finished[fields[0].strip()] = parse_state(fields[1])
+        return finished
+
+    def poll(self) -> Dict[str, str]:
+        """
+        Query SLURM once for every tracked job.
+
+        Returns:
+            Dictionary of job ID -> terminal state for jobs that finished in this tick
+        """
+        pending = self.pending()
+        if not pending:
+            return {}
+
+        queued = self._query_squeue()
+        if queued is None:
+            # squeue failed (e.g. slurmctld busy), try again next tick
+            return {}
+
+        changed = False
+        gone = []
+        for job_id in pending:
+            if job_id in queued:
+                if queued[job_id] != self.states[job_id]:
+                    self.states[job_id] = queued[job_id]
+                    changed = True
+            else:
+                gone.append(job_id)
+
+        finished = {}
+        if gone:
+            accounted = self._query_sacct(gone)
+            for job_id in gone:
+                state = accounted.get(job_id, UNKNOWN_STATE)
+                if state in TERMINAL_STATES or state == UNKNOWN_STATE:
+                    finished[job_id] = state
+                if state != self.states[job_id]:
+                    self.states[job_id] = state
+                    changed = True
+
+        # Adapt the poll interval to what the jobs are doing
+        if changed:
+            self.interval = self.min_interval
+        else:
+            active = self.pending()
+            if any(self.states[j] == 'COMPLETING' for j in active):
+                cap = self.min_interval
+            elif any(self.states[j] == 'RUNNING' for j in active):
+                cap = self.running_interval
+            else:
+                cap = self.max_interval
+            self.interval = min(self.interval * self.backoff, cap)
+
+        return finished
+
+    def _report(self) -> None:
+        counts = {}
+        for state in self.states.values():
+            counts[state] = counts.get(state, 0) + 1
+        summary = ', '.join(f"{n} {s}" for s, n in sorted(counts.items()))
+        checked = time.strftime("%H:%M:%S")
+        print(f"\rWaiting for {len(self.states)} SLURM job(s): {summary} (last checked: {checked}, next in {self.interval:.0f}s)",
+              end='', flush=True)
+
+    def iter_finished(self) -> Iterator[Tuple[str, str]]:
+        """Yield (job ID, terminal state) as each tracked job finishes."""
+        while True:
+            for job_id, state in self.poll().items():
+                if self.verbose:
+                    print(f"\nSLURM job {job_id} finished: {state}")
+                yield job_id, state
+            if not self.pending():
+                return
+            if self.verbose:
+                self._report()
+            time.sleep(self.interval)
+
+    def wait(self) -> Dict[str, str]:
+        """
+        Block until every tracked job has finished.
+
+        Returns:
+            Dictionary of job ID -> terminal state
+        """
+        for _ in self.iter_finished():
+            pass
+        return dict(self.states)
+
+
+def job_durations(job_id: str, run: Runner = local_runner) -> Optional[Tuple[float, float]]:
+    """
+    Return (seconds queued, seconds running) of a finished job from sacct,
+    or None if accounting has no usable record of it.
+    """
+    code, out = run(f"sacct -n -X -P -o Submit,Start,End -j {job_id}")
+    if code != 0 or not out.strip():
+        return None
+    try:
+        submit, start, end = (datetime.strptime(v.strip(), "%Y-%m-%dT%H:%M:%S")
+                              for v in out.splitlines()[0].split('|')[:3])
+    except ValueError:
+        # 'Unknown' or 'None' for jobs that never started
+        return None
+    return (start - submit).total_seconds(), (end - start).total_seconds()
+
+
+def wait_for_jobs(job_ids: Iterable[str], run: Runner = local_runner, **kwargs) -> Dict[str, str]:
+    """Convenience wrapper: watch `job_ids` until all of them are finished."""
+    watcher = JobWatcher(run, **kwargs)
+    for job_id in job_ids:
+        watcher.add(job_id)
+    return watcher.wait()
+
+
+if __name__ == '__main__':
+    states = wait_for_jobs(sys.argv[1:])
+    for job_id, state in states.items():
+        print(f"{job_id} {state}")
+    sys.exit(0 if all(s == 'COMPLETED' for s in states.values()) else 1)
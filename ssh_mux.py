@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Persistent multiplexed SSH connections for ifsnemo-compare.
+
+One OpenSSH ControlMaster is started per host and shared by every remote
+command, file transfer and rsync stream of a pipeline run, so only a single
+SSH handshake hits the login node. When the master goes away it is restarted;
+commands marked as safe to repeat (`retry=True`, e.g. squeue/sacct polling)
+are run again, any other command returns the connection error (exit 255)
+since the remote side may already have acted on it (e.g. an sbatch). The
+latency of every command is recorded.
+
+MuxConnection mirrors the parts of Fabric's Connection used by the pipeline
+(run, put, get, close), so it can be passed wherever a Connection is expected.
+"""
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+# ssh exits with 255 when the connection itself failed
+SSH_CONNECTION_ERROR = 255
+
+
+class RemoteCommandError(RuntimeError):
+    """Raised when a remote command fails and warn=False."""
+
+    def __init__(self, result):
+        self.result = result
+        super().__init__(f"Remote command exited {result.return_code}: {result.command}\n{result.stderr}")
+
+
+class CommandResult:
+    """Outcome of a remote command, with the attribute names of Fabric's Result."""
+
+    def __init__(self, command, return_code, stdout, stderr, elapsed):
+        self.command = command
+        self.return_code = return_code
+        self.stdout = stdout
+        self.stderr = stderr
+        self.elapsed = elapsed
+
+    @property
+    def exited(self):
+        return self.return_code
+
+    @property
+    def ok(self):
+        return self.return_code == 0
+
+
+class ConnectionManager:
+    """
+    Owns one ControlMaster per host and the latency log of all commands.
+
+    Args:
+        persist: Seconds the master stays up after the last client disconnects
+        control_dir: Directory for the control sockets (default: a private temp dir)
+        retries: Reconnection attempts when a command loses its connection
+    """
+
+    def __init__(self, persist: int = 600, control_dir: str = None, retries: int = 3):
+        self.persist = persist
+        self.retries = retries
+        self.control_dir = Path(control_dir or tempfile.mkdtemp(prefix="ifsnemo-ssh-"))
+        self.control_dir.mkdir(parents=True, exist_ok=True)
+        os.chmod(self.control_dir, 0o700)
+        self._lock = threading.Lock()
+        self._started = set()
+        self.latencies = []
+
+    def control_path(self, host: str) -> str:
+        # Socket paths are limited to ~100 characters, so use a short digest
+        digest = hashlib.sha1(host.encode()).hexdigest()[:12]
+        return str(self.control_dir / f"cm-{digest}")
+
+    def ssh_options(self, host: str) -> list:
+        """OpenSSH options that route a session through the master of `host`."""
+        return [
+            "-o", f"ControlPath={self.control_path(host)}",
+            "-o", "ControlMaster=auto",
+            "-o", f"ControlPersist={self.persist}",
+            "-o", "ServerAliveInterval=30",
+        ]
+
+    def rsh(self, host: str) -> str:
+        """Value for `rsync -e` so rsync reuses the master of `host`."""
+        return "ssh " + " ".join(shlex.quote(o) for o in self.ssh_options(host))
+
+    def is_alive(self, host: str) -> bool:
+        result = subprocess.run(
+            ["ssh", "-o", f"ControlPath={self.control_path(host)}", "-O", "check", host],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        return result.returncode == 0
+
+    def ensure_master(self, host: str, restart: bool = False) -> None:
+        """Start the master of `host` if it is not running."""
+        with self._lock:
+            if not restart and host in self._started and self.is_alive(host):
+                return
+            if self.is_alive(host):
+                self._started.add(host)
+                return
+            start = time.time()
+            subprocess.run(
+                ["ssh", *self.ssh_options(host), "-o", "ControlMaster=yes", "-MNf", host],
+                check=True,
+            )
+            self._started.add(host)
+            self.record(host, "<connect>", 0, time.time() - start)
+
+    def connection(self, host: str) -> "MuxConnection":
+        """Return a connection to `host` that shares its master."""
+        self.ensure_master(host)
+        return MuxConnection(self, host)
+
+    def record(self, host: str, command: str, return_code: int, elapsed: float) -> None:
+        with self._lock:
+            self.latencies.append({
+                "host": host,
+                "command": command,
+                "return_code": return_code,
+                "seconds": elapsed,
+            })
+
+    def report(self) -> dict:
+        """Per-host command counts and latency statistics."""
+        by_host = {}
+        for entry in self.latencies:
+            by_host.setdefault(entry["host"], []).append(entry["seconds"])
+        summary = {}
+        for host, values in by_host.items():
+            values = sorted(values)
+            summary[host] = {
+                "commands": len(values),
+                "total_seconds": sum(values),
+                "mean_seconds": sum(values) / len(values),
+                "p95_seconds": values[min(len(values) - 1, int(0.95 * len(values)))],
+                "max_seconds": values[-1],
+            }
+        return summary
+
+    def write_report(self, path: Path) -> None:
+        """Write the latency summary and per-command log as JSON."""
+        with open(path, "w") as f:
+            json.dump({"summary": self.report(), "commands": self.latencies}, f, indent=4)
+
+    def close_all(self) -> None:
+        """Stop every master started by this manager."""
+        for host in list(self._started):
+            subprocess.run(
+                ["ssh", "-o", f"ControlPath={self.control_path(host)}", "-O", "exit", host],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+        self._started.clear()
+
+
+def repeatable(conn) -> dict:
+    """
+    Keyword arguments for `conn.run` marking a command as safe to repeat after
+    a dropped connection; empty for connections other than MuxConnection
+    (e.g. Fabric's, which do not reconnect).
+    """
+    return {"retry": True} if isinstance(conn, MuxConnection) else {}
+
+
+class MuxConnection:
+    """A Fabric-like connection whose sessions all go through one ControlMaster."""
+
+    def __init__(self, manager: ConnectionManager, host: str):
+        self.manager = manager
+        self.host = host
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _ssh(self, pty: bool) -> list:
+        return ["ssh", *self.manager.ssh_options(self.host), *(["-tt"] if pty else []), self.host]
+
+    def _execute(self, cmd: str, hide: bool, pty: bool, out_stream=None):
+        proc = subprocess.Popen(
+            self._ssh(pty) + [cmd],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            bufsize=1,
+        )
+        stderr_lines = []
+
+        def drain_stderr():
+            for line in proc.stderr:
+                stderr_lines.append(line)
+                if not hide:
+                    sys.stderr.write(line)
+
+        reader = threading.Thread(target=drain_stderr, daemon=True)
+        reader.start()
+        stdout_lines = []
+        for line in proc.stdout:
+            if out_stream is not None:
+                # The stream owns the output (and its echo); nothing is kept in memory
+                out_stream.write(line)
+                continue
+            stdout_lines.append(line)
+            if not hide:
+                sys.stdout.write(line)
+                sys.stdout.flush()
+        proc.wait()
+        reader.join()
+        return proc.returncode, "".join(stdout_lines), "".join(stderr_lines)
+
+    def run(self, cmd: str, hide: bool = False, warn: bool = False, pty: bool = False,
+            out_stream=None, retry: bool = False) -> CommandResult:
+        """
+        Run `cmd` on the remote host.
+
+        Args:
+            cmd: Shell command to run
+            hide: Do not echo the output to the console (out_stream
+                still receives stdout)
+            warn: Return the result instead of raising when the command fails
+            pty: Allocate a pseudo-terminal (stderr is then merged into stdout)
+            out_stream: File-like object receiving stdout instead of the
+                console; stdout is then not kept in the result
+            retry: The command is safe to repeat and is run again if the
+                connection drops; otherwise the master is restarted and the
+                connection error (exit 255) is returned or raised
+
+        Returns:
+            CommandResult with stdout, stderr and return_code
+        """
+        attempt = 0
+        while True:
+            start = time.time()
+            code, out, err = self._execute(cmd, hide, pty, out_stream)
+            elapsed = time.time() - start
+            if code == SSH_CONNECTION_ERROR and not self.manager.is_alive(self.host):
+                if retry and attempt < self.manager.retries:
+                    attempt += 1
+                    print(f"\nConnection to {self.host} lost, reconnecting (attempt {attempt})...")
+                    time.sleep(5 * attempt)
+                    self.manager.ensure_master(self.host, restart=True)
+                    continue
+                if not retry:
+                    # The remote side may have acted on the command: report it instead of repeating it
+                    print(f"\nConnection to {self.host} lost while running a command that is not safe to repeat: "
+                          f"{cmd}", file=sys.stderr)
+                    try:
+                        self.manager.ensure_master(self.host, restart=True)
+                    except subprocess.CalledProcessError:
+                        pass  # Left to the next command, ControlMaster=auto
+            break
+        self.manager.record(self.host, cmd, code, elapsed)
+        result = CommandResult(cmd, code, out, err, elapsed)
+        if code != 0 and not warn:
+            raise RemoteCommandError(result)
+        return result
+
+    def _copy(self, src: str, dst: str, label: str) -> None:
+        self.manager.ensure_master(self.host)
+        start = time.time()
+        result = subprocess.run(["scp", "-q", *self.manager.ssh_options(self.host), src, dst],
+                                capture_output=True, text=True)
+        self.manager.record(self.host, f"{label} {src} {dst}", result.returncode, time.time() - start)
+        if result.returncode != 0:
+            raise OSError(f"scp {src} {dst} failed: {result.stderr.strip()}")
+
+    def put(self, local, remote) -> None:
+        """Copy a local file to the remote host."""
+        self._copy(str(local), f"{self.host}:{remote}", "put")
+
+    def get(self, remote, local=None) -> None:
+        """Copy a remote file to the local machine."""
+        self._copy(f"{self.host}:{remote}", str(local or os.path.basename(str(remote))), "get")
+
+    def close(self) -> None:
+        """Nothing to do: the master is shared and closed by its manager."""
@@ -4,10 +4,13 @@ Test runner module for ifsnemo-compare pipeline.
 
 Loads test definitions from YAML and executes test suites.
 """
+import json
 import yaml
 from datetime import datetime
 from pathlib import Path
 from shlex import quote
+from tracing import tracer
+from logcapture import LogCapture
 
 # Timestamp for this run (shared across all log files)
 RUN_TIMESTAMP = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -15,6 +18,9 @@ RUN_TIMESTAMP = datetime.now().strftime("%Y%m%d_%H%M%S")
 # Run output directory (initialized by init_run_directory)
 RUN_OUTPUT_DIR = None
 
+# Whether command logs are zstd-compressed (set by configure_logs)
+COMPRESS_LOGS = False
+
 
 def init_run_directory(yaml_path: str) -> Path:
     """
@@ -34,6 +40,47 @@ def init_run_directory(yaml_path: str) -> Path:
     return RUN_OUTPUT_DIR
 
 
+def use_run_directory(run_dir: Path) -> Path:
+    """
+    Reuse an existing output directory, e.g. when resuming a run.
+
+    Args:
+        run_dir: Path to the output directory of an earlier run
+
+    Returns:
+        Path to the output directory
+    """
+    global RUN_OUTPUT_DIR
+    RUN_OUTPUT_DIR = Path(run_dir)
+    RUN_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    return RUN_OUTPUT_DIR
+
+
+def configure_logs(compress: bool) -> None:
+    """
+    Set how the logs of test commands are written.
+
+    Args:
+        compress: zstd-compress the logs (written as <name>.log.zst)
+    """
+    global COMPRESS_LOGS
+    COMPRESS_LOGS = compress
+
+
+def open_log(output_file, echo: bool = True) -> LogCapture:
+    """
+    Open the streaming log of a command.
+
+    Args:
+        output_file: Log file from get_output_filename
+        echo: Also print the output to the console
+
+    Returns:
+        LogCapture writing to output_file (compressed if configured)
+    """
+    return LogCapture(output_file, compress=COMPRESS_LOGS, echo=echo)
+
+
 def load_test_definitions(path: str) -> dict:
     """
     Load test definitions from a YAML file.
@@ -81,6 +128,41 @@ def validate_test_definitions(defs: dict, cfg: dict, requested_suites: list, sui
             )
 
 
+def tolerance_flags(defs: dict, profile: str = None, fail_fast: bool = False) -> str:
+    """
+    Render the compare_norms options of a tolerance profile.
+
+    Args:
+        defs: Loaded test definitions
+        profile: Name of a profile in `tolerance_profiles`, None for
+            `default_tolerance_profile`
+        fail_fast: Add --fail-fast
+
+    Returns:
+        Options for the {tolerance_flags} placeholder, with a leading space,
+        or an empty string
+
+    Raises:
+        ValueError: If the profile is not defined
+    """
+    profiles = defs.get('tolerance_profiles') or {}
+    name = profile or defs.get('default_tolerance_profile')
+    flags = ""
+    if name:
+        if name not in profiles:
+            raise ValueError(
+                f"Tolerance profile '{name}' not found in tolerance_profiles. "
+                f"Available: {list(profiles.keys())}"
+            )
+        for pattern, tolerance in (profiles[name] or {}).items():
+            tolerance = tolerance or {}
+            spec = f"{pattern}={float(tolerance.get('abs', 0.0))!r},{float(tolerance.get('rel', 0.0))!r}"
+            flags += f" --tolerance {quote(spec)}"
+    if fail_fast:
+        flags += " --fail-fast"
+    return flags
+
+
 def render_command(suite_def: dict, cmd_name: str, context: dict) -> str:
     """
     Build a command string from a suite definition and context.
@@ -108,8 +190,8 @@ def render_command(suite_def: dict, cmd_name: str, context: dict) -> str:
     # Build quoted context for shell safety
     quoted_context = {}
     for key, value in context.items():
-        if key == 'gpu_flag':
-            # gpu_flag is already formatted with --gpus prefix or empty
+        if key in ('gpu_flag', 'tolerance_flags', 'run_cache_flags'):
+            # Already formatted options (quoted) or empty
             quoted_context[key] = value
         else:
             quoted_context[key] = quote(str(value))
@@ -155,16 +237,144 @@ def get_result_keys(suite_def: dict, cmd_name: str) -> tuple:
         cmd_name: Name of the command
 
     Returns:
-        Tuple of (passed_key, output_key) for storing results
+        Tuple of (passed_key, output_key, report_key) for storing results
     """
     commands = suite_def.get('commands', {})
     cmd_def = commands.get(cmd_name, {})
     output_prefix = cmd_def.get('output_prefix', cmd_name.replace('-', '_'))
-    return (f"{output_prefix}_passed", f"{output_prefix}_output")
+    return (f"{output_prefix}_passed", f"{output_prefix}_output", f"{output_prefix}_report")
+
+
+def get_report_file(suite_def: dict, cmd_name: str, context: dict):
+    """
+    Get the remote path of the machine-readable report of a command, if any.
+
+    Commands may declare a `report_file` template in test_definitions.yaml.
+    The rendered path is also available to the command's args as {report_file}.
+
+    Args:
+        suite_def: The test suite definition dict
+        cmd_name: Name of the command
+        context: Dictionary of parameter values to substitute
+
+    Returns:
+        The rendered remote path, or None if the command has no report
+    """
+    cmd_def = suite_def.get('commands', {}).get(cmd_name, {})
+    template = cmd_def.get('report_file')
+    if not template:
+        return None
+    return template.format(**context)
+
+
+def fetch_report(conn, remote_file: str, local_file: Path):
+    """
+    Copy a JSON report from the remote machine and load it.
+
+    Args:
+        conn: Fabric connection to the remote machine
+        remote_file: Path of the report on the remote machine
+        local_file: Where to store the local copy
+
+    Returns:
+        The parsed report, or None if it could not be fetched or parsed
+    """
+    try:
+        conn.get(remote_file, local=str(local_file))
+        with open(local_file) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: could not fetch report {remote_file}: {e}")
+        return None
+
+
+def plan_command(suite_name: str, suite_def: dict, cmd_name: str, context: dict, test_id: str) -> dict:
+    """
+    Render a command into a step of an execution plan for the remote agent.
+
+    Args:
+        suite_name: Name of the test suite
+        suite_def: The test suite definition dict
+        cmd_name: Name of the command
+        context: Dictionary of parameter values
+        test_id: The test identifier string
+
+    Returns:
+        Dictionary with the step ID, the rendered command, the local log
+        file, the remote report file (or None) and the result keys
+    """
+    report_file = get_report_file(suite_def, cmd_name, context)
+    if report_file:
+        context = dict(context, report_file=report_file)
+    return {
+        "id": f"{test_id}:{suite_name}:{cmd_name}",
+        "suite": suite_name,
+        "cmd": cmd_name,
+        "test_id": test_id,
+        "command": render_command(suite_def, cmd_name, context),
+        "output_file": str(get_output_filename(suite_name, suite_def, cmd_name, test_id)),
+        "report_file": report_file,
+        "keys": list(get_result_keys(suite_def, cmd_name)),
+    }
+
+
+def report_results(report_key: str, report) -> dict:
+    """
+    Results taken from a command's report, stored next to it: the verdict of
+    the performance comparison of compare_norms as `<prefix>_perf_passed`, and
+    the build fingerprint of bundle_validator as `build_fingerprint` (with
+    `build_matches_reference`).
+
+    Args:
+        report_key: Result key of the report, `<prefix>_report`
+        report: Parsed report, or None
+
+    Returns:
+        Dictionary of extra result keys
+    """
+    results = {}
+    if isinstance(report, dict) and "perf_passed" in report:
+        results[f"{report_key[:-len('_report')]}_perf_passed"] = report["perf_passed"]
+    if isinstance(report, dict) and "fingerprint" in report:
+        results["build_fingerprint"] = report["fingerprint"]
+        if "matches_reference" in report:
+            results["build_matches_reference"] = report["matches_reference"]
+    return results
+
+
+def step_results(step: dict, return_code: int, log_path: str, report) -> dict:
+    """
+    Build the results of a plan step executed by the remote agent, in the
+    same form as execute_test. A report sent by the agent is also stored
+    next to the log.
+
+    Args:
+        step: Plan step from plan_command
+        return_code: Exit code of the command
+        log_path: Local log file of the command
+        report: Parsed report sent by the agent, or None
+
+    Returns:
+        Dictionary with result keys mapping to pass/fail and output file
+    """
+    passed_key, output_key, report_key = step["keys"]
+    results = {
+        passed_key: return_code == 0,
+        output_key: log_path,
+    }
+    if step["report_file"]:
+        if report is not None:
+            with open(Path(step["output_file"]).with_suffix('.json'), "w") as f:
+                json.dump(report, f, indent=4)
+        else:
+            print(f"Warning: could not fetch report {step['report_file']}")
+        results[report_key] = report
+        results.update(report_results(report_key, report))
+    return results
 
 
 def execute_test(conn, suite_name: str, suite_def: dict, cmd_name: str, context: dict,
-                 test_id: str, verbose: bool = False) -> dict:
+                 test_id: str, verbose: bool = False, hide: bool = False) -> dict:
     """
     Execute a single test command and return results.
 
@@ -176,24 +386,37 @@ def execute_test(conn, suite_name: str, suite_def: dict, cmd_name: str, context:
         context: Dictionary of parameter values
         test_id: The test identifier string
         verbose: Whether to print verbose output
+        hide: Whether to suppress live echo of the remote output (used when
+            several configurations run concurrently); the log file is still written
 
     Returns:
-        Dictionary with result keys mapping to pass/fail and output file
+        Dictionary with result keys mapping to pass/fail and output file, plus
+        the parsed report for commands that declare a report_file
     """
+    report_file = get_report_file(suite_def, cmd_name, context)
+    if report_file:
+        context = dict(context, report_file=report_file)
     cmd = render_command(suite_def, cmd_name, context)
     output_file = get_output_filename(suite_name, suite_def, cmd_name, test_id)
-    passed_key, output_key = get_result_keys(suite_def, cmd_name)
+    passed_key, output_key, report_key = get_result_keys(suite_def, cmd_name)
 
     print(cmd)
-    result = conn.run(cmd, warn=True, pty=True)
-
-    with open(output_file, "w") as f:
-        f.write(result.stdout)
+    # Stream the output into the log as it arrives; only a bounded tail is
+    # kept in memory
+    with open_log(output_file, echo=not hide) as log:
+        print(f"Streaming output to {log.path}")
+        with tracer.span(f"{suite_name}:{cmd_name}", "suite", test_id=test_id) as span_args:
+            result = conn.run(cmd, warn=True, pty=True, out_stream=log)
+            span_args["return_code"] = result.return_code
 
     if verbose:
-        print(f"Output of {cmd_name} saved to local file {output_file}")
+        print(f"Output of {cmd_name} saved to local file {log.path}")
 
-    return {
+    results = {
         passed_key: result.return_code == 0,
-        output_key: str(output_file),
+        output_key: log.path,
     }
+    if report_file:
+        results[report_key] = fetch_report(conn, report_file, output_file.with_suffix('.json'))
+        results.update(report_results(report_key, results[report_key]))
+    return results
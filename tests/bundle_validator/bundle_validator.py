@@ -8,12 +8,26 @@ This tool compares version information and CMake flags between the intended inpu
 And the build directory output, consisting of:
 - CMake config-version files in build directory
 - CMakeCache.txt in build directory
+
+Parsed files and the validation output are indexed in the build directory
+(.bundle_validator_index.json) by file size and mtime, so validating an
+unchanged build is near-instant; pass --no-cache to parse everything.
+
+The fingerprint subcommand digests the resolved versions and CMake flags
+together with the installed executables of the sandbox into a single build
+identity, which compare_norms uses to skip test runs of a build identical to
+the reference build.
 """
 
 import argparse
+import hashlib
 import json
+import os
 import re
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Tuple, Optional, Any
 
@@ -40,6 +54,31 @@ class BundleConfig:
     # Regex patterns
     PACKAGE_VERSION_PATTERN = r'set\s*\(\s*PACKAGE_VERSION\s+"([^"]+)"\s*\)'
     CMAKE_FLAG_PATTERN = r'^([^:]+):([^=]+)=(.*)$'
+    CONFIGURE_FLAG_PATTERN = r'-D([A-Za-z_][A-Za-z0-9_]*)=("[^"]*"|\'[^\']*\'|[^\s]+)'
+    PACKAGE_VERSION_RE = re.compile(PACKAGE_VERSION_PATTERN)
+    CMAKE_FLAG_RE = re.compile(CMAKE_FLAG_PATTERN)
+    CONFIGURE_FLAG_RE = re.compile(CONFIGURE_FLAG_PATTERN)
+
+    # Parse index kept in the build directory
+    INDEX_FILENAME = ".bundle_validator_index.json"
+    INDEX_VERSION = 1
+    # Files modified more recently than this are not indexed, as a change
+    # within the same mtime tick would go unnoticed
+    INDEX_MIN_AGE_SECONDS = 2.0
+    # Threads scanning project config-version files
+    SCAN_WORKERS = 16
+
+    # Reference fingerprint written by create-refs --sandbox
+    FINGERPRINT_FILENAME = "fingerprint.json"
+    HASH_CHUNK_SIZE = 1 << 20
+
+    # Fields compared by the structural diff; the others (passed, difference,
+    # note) follow from these
+    DIFF_FIELDS = {
+        'bundle_version': ('package_name', 'bundle_version', 'cmake_version'),
+        'project': ('bundle_version', 'cmake_version', 'skip_reason'),
+        'flag': ('bundle_values', 'cache_values', 'from_configure_script'),
+    }
 
     # Reasons a project may not have a config-version file
     SKIP_REASONS = {
@@ -52,6 +91,119 @@ class BundleConfig:
     PATH_PLACEHOLDER = "{BUILD_ROOT}"
 
 
+class ParseIndex:
+    """
+    Parse index of a build directory, keyed by file size and mtime.
+
+    Stored as INDEX_FILENAME in the build directory. It keeps the parsed
+    config-version files and configure.sh, and the validation output together
+    with the size and mtime of every file it was computed from, so validating
+    an unchanged build only stats its files. CMakeCache.txt is only recorded as
+    an input: its parsed form is as large as the file and no faster to load.
+    Without a build directory (or with --no-cache) every file is parsed.
+    """
+
+    def __init__(self, build_dir: Optional[Path] = None):
+        self.path = build_dir / BundleConfig.INDEX_FILENAME if build_dir else None
+        self.files = {}
+        self.results = {}
+        self.inputs = {}
+        self.racy = False
+        self.dirty = False
+        self._lock = threading.Lock()
+        if self.path and self.path.is_file():
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+                if data.get('version') == BundleConfig.INDEX_VERSION:
+                    self.files = data.get('files', {})
+                    self.results = data.get('results', {})
+            except (OSError, ValueError, AttributeError):
+                pass
+
+    @staticmethod
+    def signature(path: str) -> Optional[List[int]]:
+        """[size, mtime_ns] of a file, None if it does not exist."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns]
+
+    @staticmethod
+    def is_recent(sig: Optional[List[int]]) -> bool:
+        """True if a change within the same mtime tick could go unnoticed."""
+        return bool(sig) and time.time() - sig[1] / 1e9 < BundleConfig.INDEX_MIN_AGE_SECONDS
+
+    def track(self, path: Path) -> Tuple[str, Optional[List[int]]]:
+        """Record `path` as an input of the validation; returns (key, signature)."""
+        key = os.path.abspath(path)
+        sig = self.signature(key)
+        with self._lock:
+            self.inputs[key] = sig
+            self.racy = self.racy or self.is_recent(sig)
+        return key, sig
+
+    def get(self, kind: str, path: Path, parse, store: bool = True):
+        """
+        Return `parse(path)`, from the index if the file is unchanged.
+
+        Args:
+            kind: Kind of parse (files may be parsed in several ways)
+            path: File to parse
+            parse: Function parsing the file; its result must be JSON-serializable
+            store: Keep the parsed value in the index
+
+        Returns:
+            Parsed value
+        """
+        key, sig = self.track(path)
+        entry = self.files.get(f"{kind}:{key}")
+        if sig and entry and entry['sig'] == sig:
+            return entry['value']
+        value = parse(path)
+        if sig and store and self.path and not self.is_recent(sig):
+            with self._lock:
+                self.files[f"{kind}:{key}"] = {'sig': sig, 'value': value}
+                self.dirty = True
+        return value
+
+    def get_many(self, kind: str, paths: List[Path], parse) -> List[Any]:
+        """Like get() for several files, scanned in parallel."""
+        if len(paths) < 2:
+            return [self.get(kind, p, parse) for p in paths]
+        with ThreadPoolExecutor(max_workers=min(BundleConfig.SCAN_WORKERS, len(paths))) as executor:
+            return list(executor.map(lambda p: self.get(kind, p, parse), paths))
+
+    def result(self, bundle_yaml: Path) -> Optional[Dict[str, Any]]:
+        """Validation output for `bundle_yaml` if none of its input files changed."""
+        entry = self.results.get(os.path.abspath(bundle_yaml))
+        if not entry or any(self.signature(p) != sig for p, sig in entry['inputs'].items()):
+            return None
+        return entry['output']
+
+    def store_result(self, bundle_yaml: Path, output: Dict[str, Any]) -> None:
+        """Keep the validation output with the files it was computed from."""
+        key, _ = self.track(bundle_yaml)
+        if self.path and not self.racy:
+            self.results[key] = {'inputs': dict(self.inputs), 'output': output}
+            self.dirty = True
+
+    def save(self) -> None:
+        """Write the index if it changed (a read-only build dir is not an error)."""
+        if not (self.path and self.dirty):
+            return
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        try:
+            tmp.write_text(json.dumps({'version': BundleConfig.INDEX_VERSION,
+                                       'files': self.files, 'results': self.results}))
+            os.replace(tmp, self.path)
+            self.dirty = False
+        except OSError as e:
+            print(f"WARNING: Could not write parse index {self.path}: {e}", file=sys.stderr)
+            tmp.unlink(missing_ok=True)
+
+
 def normalize_paths(data: Any, root_path: str) -> Any:
     """
     Recursively normalize paths in data by replacing root_path with placeholder.
@@ -112,7 +264,7 @@ def extract_package_version_from_cmake(cmake_file: Path) -> Optional[str]:
         # Remove leading/trailing whitespace from each line before matching
         content_normalized = '\n'.join(line.strip() for line in content.splitlines())
 
-        match = re.search(BundleConfig.PACKAGE_VERSION_PATTERN, content_normalized)
+        match = BundleConfig.PACKAGE_VERSION_RE.search(content_normalized)
         if match:
             return match.group(1).strip()
     except Exception as e:
@@ -173,9 +325,7 @@ def parse_configure_script(configure_path: Path) -> Dict[str, List[str]]:
             if 'cmake' in line.lower() and '-D' in line:
                 # Extract all -DFLAG=VALUE patterns
                 # Pattern: -D followed by FLAG=VALUE (may have quotes around value)
-                import re
-                pattern = r'-D([A-Za-z_][A-Za-z0-9_]*)=("[^"]*"|\'[^\']*\'|[^\s]+)'
-                matches = re.findall(pattern, line)
+                matches = BundleConfig.CONFIGURE_FLAG_RE.findall(line)
 
                 for flag, value in matches:
                     # Remove quotes from value if present
@@ -203,6 +353,7 @@ def load_cmake_cache(cache_path: Path) -> Dict[str, List[Tuple[str, str]]]:
         sys.exit(1)
 
     cache_flags = {}
+    flag_re = BundleConfig.CMAKE_FLAG_RE
 
     try:
         with open(cache_path, 'r') as f:
@@ -212,7 +363,7 @@ def load_cmake_cache(cache_path: Path) -> Dict[str, List[Tuple[str, str]]]:
                 if not line or line.startswith('#') or line.startswith('//'):
                     continue
 
-                match = re.match(BundleConfig.CMAKE_FLAG_PATTERN, line)
+                match = flag_re.match(line)
                 if match:
                     flag = match.group(1).strip()
                     flag_type = match.group(2).strip()
@@ -228,12 +379,13 @@ def load_cmake_cache(cache_path: Path) -> Dict[str, List[Tuple[str, str]]]:
     return cache_flags
 
 
-def check_bundle_version(bundle_data: Dict, build_dir: Path) -> Dict[str, Any]:
+def check_bundle_version(bundle_data: Dict, build_dir: Path, index: Optional[ParseIndex] = None) -> Dict[str, Any]:
     """
     Routine 1: Check that bundle.yml version matches ifs-bundle-config-version.cmake.
 
     Returns a dict with check results.
     """
+    index = index or ParseIndex()
     bundle_name = bundle_data.get('name', '')
     bundle_version = bundle_data.get('version', '')
 
@@ -247,7 +399,7 @@ def check_bundle_version(bundle_data: Dict, build_dir: Path) -> Dict[str, Any]:
         project=bundle_name
     )
 
-    cmake_version = extract_package_version_from_cmake(config_file)
+    cmake_version = index.get('version', config_file, extract_package_version_from_cmake)
 
     passed = False
     difference = None
@@ -268,16 +420,20 @@ def check_bundle_version(bundle_data: Dict, build_dir: Path) -> Dict[str, Any]:
     }
 
 
-def check_project_versions(bundle_data: Dict, build_dir: Path) -> Dict[str, Any]:
+def check_project_versions(bundle_data: Dict, build_dir: Path, index: Optional[ParseIndex] = None) -> Dict[str, Any]:
     """
     Routine 2: Check that all project versions match their config-version files.
 
+    The config-version files are read in parallel.
+
     Returns a dict with check results for all projects.
     """
+    index = index or ParseIndex()
     projects = bundle_data.get('projects', [])
 
     results = []
     routine_passed = True
+    pending = []
 
     for project_entry in projects:
         if not isinstance(project_entry, dict):
@@ -321,20 +477,24 @@ def check_project_versions(bundle_data: Dict, build_dir: Path) -> Dict[str, Any]
             config_file = build_dir / project_name / BundleConfig.CONFIG_VERSION_FILENAME_TEMPLATE.format(
                 project=project_name
             )
+            pending.append((result, config_file))
 
-            cmake_version = extract_package_version_from_cmake(config_file)
-            result['cmake_version'] = cmake_version
+        results.append(result)
 
-            if cmake_version is None:
-                result['difference'] = f"CMake config file not found: {config_file}"
-                routine_passed = False
-            elif bundle_version == cmake_version:
-                result['passed'] = True
-            else:
-                result['difference'] = f"bundle.yml: '{bundle_version}' != cmake: '{cmake_version}'"
-                routine_passed = False
+    versions = index.get_many('version', [config_file for _, config_file in pending],
+                              extract_package_version_from_cmake)
+    for (result, config_file), cmake_version in zip(pending, versions):
+        bundle_version = result['bundle_version']
+        result['cmake_version'] = cmake_version
 
-        results.append(result)
+        if cmake_version is None:
+            result['difference'] = f"CMake config file not found: {config_file}"
+            routine_passed = False
+        elif bundle_version == cmake_version:
+            result['passed'] = True
+        else:
+            result['difference'] = f"bundle.yml: '{bundle_version}' != cmake: '{cmake_version}'"
+            routine_passed = False
 
     return {
         'passed': routine_passed,
@@ -342,7 +502,7 @@ def check_project_versions(bundle_data: Dict, build_dir: Path) -> Dict[str, Any]
     }
 
 
-def check_cmake_flags(bundle_data: Dict, build_dir: Path) -> Dict[str, Any]:
+def check_cmake_flags(bundle_data: Dict, build_dir: Path, index: Optional[ParseIndex] = None) -> Dict[str, Any]:
     """
     Routine 3: Check that CMake flags from bundle.yml appear in CMakeCache.txt.
 
@@ -350,8 +510,9 @@ def check_cmake_flags(bundle_data: Dict, build_dir: Path) -> Dict[str, Any]:
 
     Returns a dict with check results for all flags.
     """
+    index = index or ParseIndex()
     cache_path = build_dir / BundleConfig.CMAKE_CACHE_FILENAME
-    cache_flags = load_cmake_cache(cache_path)
+    cache_flags = index.get('cmake_cache', cache_path, load_cmake_cache, store=False)
 
     # Collect all CMake flags from bundle.yml
     all_bundle_flags = {}
@@ -384,7 +545,7 @@ def check_cmake_flags(bundle_data: Dict, build_dir: Path) -> Dict[str, Any]:
 
     # 3. Command-line flags from configure.sh (these override/supplement bundle.yml)
     configure_path = build_dir / BundleConfig.CONFIGURE_SCRIPT_FILENAME
-    configure_flags = parse_configure_script(configure_path)
+    configure_flags = index.get('configure', configure_path, parse_configure_script)
 
     # Merge configure.sh flags (these take precedence as they are actual arguments used)
     for flag, values in configure_flags.items():
@@ -452,13 +613,14 @@ def check_cmake_flags(bundle_data: Dict, build_dir: Path) -> Dict[str, Any]:
     }
 
 
-def run_validation(bundle_yaml: Path, build_dir: Path) -> Dict[str, Any]:
+def run_validation(bundle_yaml: Path, build_dir: Path, use_index: bool = True) -> Dict[str, Any]:
     """
     Run all validation routines and return results.
 
     Args:
         bundle_yaml: Path to bundle.yml file
         build_dir: Path to build directory
+        use_index: Read and update the parse index in the build directory
 
     Returns:
         Dictionary with validation results
@@ -476,13 +638,19 @@ def run_validation(bundle_yaml: Path, build_dir: Path) -> Dict[str, Any]:
         print(f"ERROR: Build path is not a directory: {build_dir}", file=sys.stderr)
         sys.exit(1)
 
+    # An unchanged build has nothing to parse
+    index = ParseIndex(build_dir if use_index else None)
+    cached = index.result(bundle_yaml)
+    if cached is not None:
+        return cached
+
     # Load bundle.yml
     bundle_data = load_yaml(bundle_yaml)
 
     # Run all three routines
-    routine1_result = check_bundle_version(bundle_data, build_dir)
-    routine2_result = check_project_versions(bundle_data, build_dir)
-    routine3_result = check_cmake_flags(bundle_data, build_dir)
+    routine1_result = check_bundle_version(bundle_data, build_dir, index)
+    routine2_result = check_project_versions(bundle_data, build_dir, index)
+    routine3_result = check_cmake_flags(bundle_data, build_dir, index)
 
     # Determine overall pass/fail
     all_passed = (
@@ -491,17 +659,212 @@ def run_validation(bundle_yaml: Path, build_dir: Path) -> Dict[str, Any]:
         routine3_result['passed']
     )
 
-    return {
+    output = {
         'overall_passed': all_passed,
         'bundle_version': routine1_result,
         'project_versions': routine2_result,
         'cmake_flags': routine3_result
     }
+    index.store_result(bundle_yaml, output)
+    index.save()
+    return output
+
+
+def _keyed(items: List[Dict], key: str) -> Dict[str, Dict]:
+    """Index a list of result entries by `key`, in order."""
+    return {item.get(key): item for item in items or [] if isinstance(item, dict)}
+
+
+def _change(change_type: str, name: str, field: Optional[str], ref: Any, test: Any) -> Dict[str, Any]:
+    return {'type': change_type, 'name': name, 'field': field, 'ref': ref, 'test': test}
+
+
+def _generic_changes(ref: Any, test: Any, path: str, changes: List[Dict]) -> None:
+    """Report differing values below `path` (dicts walked by key, other values compared whole)."""
+    if isinstance(ref, dict) and isinstance(test, dict):
+        for key in list(ref) + [k for k in test if k not in ref]:
+            _generic_changes(ref.get(key), test.get(key), f"{path}.{key}" if path else key, changes)
+    elif ref != test:
+        changes.append(_change('other_changed', path, None, ref, test))
+
+
+def diff_validation(ref_data: Dict, test_data: Dict) -> List[Dict[str, Any]]:
+    """
+    Structural diff of two validation outputs.
+
+    Walks the bundle version, the projects and the CMake flags by name, in
+    time linear in their size, and reports one typed change per differing
+    field: bundle_version_changed, project_added, project_removed,
+    project_version_changed, project_skip_changed, flag_added, flag_removed
+    and flag_changed. If the outputs differ in anything else, that is reported
+    as other_changed.
+
+    Args:
+        ref_data: Reference bundle_validation.json
+        test_data: Tested bundle_validation.json
+
+    Returns:
+        List of changes {type, name, field, ref, test}
+    """
+    changes = []
+
+    ref_bundle = ref_data.get('bundle_version') or {}
+    test_bundle = test_data.get('bundle_version') or {}
+    for field in BundleConfig.DIFF_FIELDS['bundle_version']:
+        if ref_bundle.get(field) != test_bundle.get(field):
+            changes.append(_change('bundle_version_changed', test_bundle.get('package_name') or ref_bundle.get('package_name'),
+                                   field, ref_bundle.get(field), test_bundle.get(field)))
+
+    ref_projects = _keyed((ref_data.get('project_versions') or {}).get('projects'), 'project_name')
+    test_projects = _keyed((test_data.get('project_versions') or {}).get('projects'), 'project_name')
+    for name, ref_proj in ref_projects.items():
+        test_proj = test_projects.get(name)
+        if test_proj is None:
+            changes.append(_change('project_removed', name, 'cmake_version', ref_proj.get('cmake_version'), None))
+            continue
+        for field in BundleConfig.DIFF_FIELDS['project']:
+            if ref_proj.get(field) != test_proj.get(field):
+                change_type = 'project_skip_changed' if field == 'skip_reason' else 'project_version_changed'
+                changes.append(_change(change_type, name, field, ref_proj.get(field), test_proj.get(field)))
+    for name, test_proj in test_projects.items():
+        if name not in ref_projects:
+            changes.append(_change('project_added', name, 'cmake_version', None, test_proj.get('cmake_version')))
+
+    ref_flags = _keyed((ref_data.get('cmake_flags') or {}).get('flags'), 'flag')
+    test_flags = _keyed((test_data.get('cmake_flags') or {}).get('flags'), 'flag')
+    for name, ref_flag in ref_flags.items():
+        test_flag = test_flags.get(name)
+        if test_flag is None:
+            changes.append(_change('flag_removed', name, 'cache_values', ref_flag.get('cache_values'), None))
+            continue
+        for field in BundleConfig.DIFF_FIELDS['flag']:
+            if ref_flag.get(field) != test_flag.get(field):
+                changes.append(_change('flag_changed', name, field, ref_flag.get(field), test_flag.get(field)))
+    for name, test_flag in test_flags.items():
+        if name not in ref_flags:
+            changes.append(_change('flag_added', name, 'cache_values', None, test_flag.get('cache_values')))
+
+    if not changes and ref_data != test_data:
+        _generic_changes(ref_data, test_data, '', changes)
+    return changes
+
+
+def format_changes(changes: List[Dict[str, Any]]) -> str:
+    """Render a change set as an aligned table."""
+    def cell(value):
+        return '-' if value is None else value if isinstance(value, str) else json.dumps(value)
+
+    header = ('CHANGE', 'NAME', 'FIELD', 'REFERENCE', 'TEST')
+    rows = [header] + [(c['type'], cell(c['name']), cell(c['field']), cell(c['ref']), cell(c['test'])) for c in changes]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header) - 1)]
+    lines = ['  '.join(value.ljust(width) for value, width in zip(row, widths)) + '  ' + row[-1] for row in rows]
+    return '\n'.join(line.rstrip() for line in lines)
+
+
+def _hash_file(path: str) -> str:
+    """sha256 of a file, read in chunks."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(BundleConfig.HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _scan_dir(path: str) -> Tuple[List[str], List[str]]:
+    """Subdirectories and executable files of one directory (symlinked dirs are not followed)."""
+    subdirs, executables = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file() and os.access(entry.path, os.X_OK):
+                    executables.append(entry.path)
+    except OSError as e:
+        print(f"WARNING: Failed to scan {path}: {e}", file=sys.stderr)
+    return subdirs, executables
+
+
+def executable_checksums(sandbox: Path) -> Dict[str, str]:
+    """
+    Checksum every executable file below `sandbox`.
+
+    Directories are listed and files hashed on a thread pool, as both are
+    bound by file system latency on the remote.
+
+    Returns:
+        Dictionary {path relative to sandbox: sha256}, sorted by path
+    """
+    root = str(sandbox)
+    executables = []
+    with ThreadPoolExecutor(max_workers=BundleConfig.SCAN_WORKERS) as executor:
+        pending = [executor.submit(_scan_dir, root)]
+        while pending:
+            subdirs, files = pending.pop().result()
+            executables.extend(files)
+            pending.extend(executor.submit(_scan_dir, d) for d in subdirs)
+        executables.sort()
+        digests = executor.map(_hash_file, executables)
+        return {os.path.relpath(path, root): digest for path, digest in zip(executables, digests)}
+
+
+def build_fingerprint(bundle_yaml: Path, build_dir: Path, sandbox: Optional[Path] = None,
+                      use_index: bool = True) -> Dict[str, Any]:
+    """
+    Compute a stable identity of a build.
+
+    Args:
+        bundle_yaml: Path to bundle.yml file
+        build_dir: Path to build directory
+        sandbox: Directory of the installed executables (None to leave them out)
+        use_index: Read and update the parse index in the build directory
+
+    Returns:
+        Dictionary with the combined fingerprint and its components
+    """
+    output = normalize_paths(run_validation(bundle_yaml, build_dir, use_index),
+                             str(build_dir.resolve().parent))
+    fields = BundleConfig.DIFF_FIELDS
+    bundle = output['bundle_version']
+    config = {
+        'bundle_version': {k: bundle.get(k) for k in fields['bundle_version']},
+        'projects': {p['project_name']: {k: p.get(k) for k in fields['project']}
+                     for p in output['project_versions']['projects']},
+        'cmake_flags': {f['flag']: f['cache_values'] for f in output['cmake_flags']['flags']},
+    }
+    config_digest = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+
+    checksums = executable_checksums(sandbox) if sandbox else {}
+    if sandbox and not checksums:
+        print(f"WARNING: No executables found below {sandbox}", file=sys.stderr)
+    exe_hash = hashlib.sha256()
+    for rel, digest in checksums.items():
+        exe_hash.update(f"{rel}\0{digest}\n".encode())
+    executables_digest = exe_hash.hexdigest()
+
+    fingerprint = hashlib.sha256(f"{config_digest}\n{executables_digest}\n".encode()).hexdigest()
+    return {
+        'fingerprint': fingerprint,
+        'config_digest': config_digest,
+        'executables_digest': executables_digest,
+        'executables': len(checksums),
+        'sandbox': os.path.realpath(sandbox) if sandbox else None,
+        'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def write_json_atomic(path: Path, data: Any) -> None:
+    """Write JSON to `path` through a temporary file, so readers never see it half written."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(data))
+    os.replace(tmp, path)
 
 
 def cmd_validate(args):
     """Run validation (original behavior)."""
-    output = run_validation(args.bundle_yaml, args.build_dir)
+    output = run_validation(args.bundle_yaml, args.build_dir, use_index=not args.no_cache)
 
     # Normalize if requested
     if args.normalize:
@@ -525,7 +888,7 @@ def cmd_validate(args):
 
 def cmd_create_refs(args):
     """Run validation and save normalized output as reference."""
-    output = run_validation(args.bundle_yaml, args.build_dir)
+    output = run_validation(args.bundle_yaml, args.build_dir, use_index=not args.no_cache)
 
     # Normalize paths using build_dir's parent as root
     root_path = str(args.build_dir.resolve().parent)
@@ -533,16 +896,19 @@ def cmd_create_refs(args):
 
     # Save to output directory
     output_path = Path(args.output_dir) / "bundle_validation.json"
-    output_path.parent.mkdir(parents=True, exist_ok=True)
-
-    json_output = json.dumps(output)
-    output_path.write_text(json_output)
+    write_json_atomic(output_path, output)
     print(f"Reference saved to: {output_path}")
 
+    if args.sandbox:
+        fingerprint = build_fingerprint(args.bundle_yaml, args.build_dir, args.sandbox, use_index=not args.no_cache)
+        fingerprint_path = Path(args.output_dir) / BundleConfig.FINGERPRINT_FILENAME
+        write_json_atomic(fingerprint_path, fingerprint)
+        print(f"Reference fingerprint {fingerprint['fingerprint']} saved to: {fingerprint_path}")
+
 
 def cmd_run_tests(args):
     """Run validation and save normalized output as test result."""
-    output = run_validation(args.bundle_yaml, args.build_dir)
+    output = run_validation(args.bundle_yaml, args.build_dir, use_index=not args.no_cache)
 
     # Normalize paths using build_dir's parent as root
     root_path = str(args.build_dir.resolve().parent)
@@ -550,10 +916,7 @@ def cmd_run_tests(args):
 
     # Save to output directory
     output_path = Path(args.output_dir) / "bundle_validation.json"
-    output_path.parent.mkdir(parents=True, exist_ok=True)
-
-    json_output = json.dumps(output)
-    output_path.write_text(json_output)
+    write_json_atomic(output_path, output)
     print(f"Test result saved to: {output_path}")
 
 
@@ -576,15 +939,53 @@ def cmd_compare(args):
         test_data = json.load(f)
 
     # Compare the two
-    if ref_data == test_data:
+    changes = diff_validation(ref_data, test_data)
+    counts = {}
+    for change in changes:
+        counts[change['type']] = counts.get(change['type'], 0) + 1
+    report = {'passed': not changes, 'counts': counts, 'changes': changes}
+
+    if args.json:
+        try:
+            Path(args.json).parent.mkdir(parents=True, exist_ok=True)
+            Path(args.json).write_text(json.dumps(report))
+        except Exception as e:
+            print(f"ERROR: Failed to write report file: {e}", file=sys.stderr)
+            sys.exit(1)
+
+    if args.format == 'json':
+        print(json.dumps(report, indent=2))
+    elif not changes:
         print(f"{BOLD}bundle_validator: MATCH:{RESET} Test output matches reference")
     else:
-        print(f"{BOLD}bundle_validator: DIFF:{RESET} Test output differs from reference")
-        import difflib
-        ref_str = json.dumps(ref_data, indent=2, sort_keys=True).splitlines(keepends=True)
-        test_str = json.dumps(test_data, indent=2, sort_keys=True).splitlines(keepends=True)
-        diff = difflib.unified_diff(ref_str, test_str, fromfile='reference', tofile='test')
-        print(''.join(diff))
+        summary = ', '.join(f"{n} {change_type}" for change_type, n in sorted(counts.items()))
+        print(f"{BOLD}bundle_validator: DIFF:{RESET} Test output differs from reference ({summary})")
+        print(format_changes(changes))
+    sys.exit(0 if not changes else 1)
+
+
+def cmd_fingerprint(args):
+    """Compute the build fingerprint, optionally checking it against a reference."""
+    output = build_fingerprint(args.bundle_yaml, args.build_dir, args.sandbox, use_index=not args.no_cache)
+
+    if args.ref:
+        try:
+            with open(args.ref) as f:
+                output['reference'] = json.load(f).get('fingerprint')
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"WARNING: Could not read reference fingerprint {args.ref}: {e}", file=sys.stderr)
+            output['reference'] = None
+        output['matches_reference'] = output['reference'] == output['fingerprint']
+
+    if args.output:
+        try:
+            write_json_atomic(args.output, output)
+        except Exception as e:
+            print(f"ERROR: Failed to write output file: {e}", file=sys.stderr)
+            sys.exit(1)
+    print(f"Build fingerprint: {output['fingerprint']} ({output['executables']} executable(s))")
+    if args.ref:
+        print("Matches the reference build" if output['matches_reference'] else "Differs from the reference build")
     sys.exit(0)
 
 
@@ -602,6 +1003,7 @@ def main():
     p_validate.add_argument('build_dir', type=Path, help='Path to build directory')
     p_validate.add_argument('-o', '--output', type=Path, help='Output JSON file (default: stdout)')
     p_validate.add_argument('--normalize', action='store_true', help='Normalize machine-specific paths')
+    p_validate.add_argument('--no-cache', action='store_true', help='Parse every file instead of using the parse index')
     p_validate.set_defaults(func=cmd_validate)
 
     # create-refs subcommand
@@ -609,6 +1011,9 @@ def main():
     p_create.add_argument('bundle_yaml', type=Path, help='Path to bundle.yml file')
     p_create.add_argument('build_dir', type=Path, help='Path to build directory')
     p_create.add_argument('-og', '--output-dir', required=True, help='Output directory for reference')
+    p_create.add_argument('--no-cache', action='store_true', help='Parse every file instead of using the parse index')
+    p_create.add_argument('--sandbox', type=Path,
+                          help='Installed sandbox of the reference build; also saves its fingerprint')
     p_create.set_defaults(func=cmd_create_refs)
 
     # run-tests subcommand
@@ -616,12 +1021,26 @@ def main():
     p_run.add_argument('bundle_yaml', type=Path, help='Path to bundle.yml file')
     p_run.add_argument('build_dir', type=Path, help='Path to build directory')
     p_run.add_argument('-ot', '--output-dir', required=True, help='Output directory for test result')
+    p_run.add_argument('--no-cache', action='store_true', help='Parse every file instead of using the parse index')
     p_run.set_defaults(func=cmd_run_tests)
 
+    # fingerprint subcommand
+    p_fp = subparsers.add_parser('fingerprint', help='Compute a digest identifying the build')
+    p_fp.add_argument('bundle_yaml', type=Path, help='Path to bundle.yml file')
+    p_fp.add_argument('build_dir', type=Path, help='Path to build directory')
+    p_fp.add_argument('--sandbox', type=Path, help='Directory of the installed executables to include')
+    p_fp.add_argument('--ref', help='Reference fingerprint JSON to check the build against')
+    p_fp.add_argument('-o', '--output', type=Path, help='Write the fingerprint and its components to this JSON file')
+    p_fp.add_argument('--no-cache', action='store_true', help='Parse every file instead of using the parse index')
+    p_fp.set_defaults(func=cmd_fingerprint)
+
     # compare subcommand
-    p_compare = subparsers.add_parser('compare', help='Compare test result against reference')
+    p_compare = subparsers.add_parser('compare', help='Compare test result against reference (exit code 1 on any change)')
     p_compare.add_argument('-og', '--ref-dir', required=True, help='Reference directory')
     p_compare.add_argument('-ot', '--test-dir', required=True, help='Test result directory')
+    p_compare.add_argument('--format', choices=['table', 'json'], default='table',
+                           help='Print the changes as a table (default) or as JSON')
+    p_compare.add_argument('--json', help='Also write the changes as a JSON report to this file')
     p_compare.set_defaults(func=cmd_compare)
 
     args = parser.parse_args()
@@ -1,11 +1,25 @@
 #!/usr/bin/env python3
 import os, time
+import fcntl
 import shutil
 import sys
 import argparse
 import itertools
 import subprocess
 import tempfile
+import threading
+import json
+import hashlib
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+# Helper modules live next to this script and at the root of ifsnemo-compare
+SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(SCRIPT_DIR, os.pardir, os.pardir))
+sys.path.insert(0, SCRIPT_DIR)
+from slurm import JobWatcher
+from logcapture import LogCapture
+import norms
 
 #Section 1: File+Dir Utilities
 
@@ -34,13 +48,48 @@ def copy_results(jobid, ref_dir):
             print(f"Copying file: {src_path} -> {dst_path}")
             shutil.copy2(src_path, dst_path)
 
+def run_dir(root, name, res, nthreads, ppn, nnodes, gpus, nsteps):
+    """
+    Return the directory of a run, e.g. <root>/<name>/<res>/nthreads4/ppn28/nnodes1/nstepsd1.
+    The gpus component is only included when non-zero.
+    """
+    parts = [
+        root,
+        name,
+        str(res),
+        "nthreads"+str(nthreads),
+        "ppn"+str(ppn),
+        "nnodes"+str(nnodes),
+    ]
+    if gpus != 0:
+        parts.append("gpus"+str(gpus))
+    parts.append("nsteps"+str(nsteps))
+    return os.path.join(*parts)
+
+def write_json_atomic(path, data):
+    """Write `data` as JSON to `path` via a temporary file and rename."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp.")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
 #Section 2: Job Runner
 
-def run_and_tee(cmd, env=None):
+def parse_jobid(line):
+    """Return the job ID from a psubmit 'Job ID <id>' line, or None."""
+    if line.startswith("Job ID"):
+        try:
+            return line.split(" ", 1)[1].split()[1]
+        except IndexError:
+            pass # Ignore malformed "Job ID" lines
+    return None
+
+def run_and_tee(cmd, log_path, env=None):
     """
-    Launch subprocess(cmd), stream all output to console,
-    detect 'Job ID <id>' line, and return (jobid, full_output).
-    This implementation streams output to avoid deadlocks.
+    Launch subprocess(cmd), stream all output to console and to `log_path`
+    as it arrives, detect 'Job ID <id>' line, and return (jobid, log_path).
+    Only a bounded tail of the output is kept in memory. While the command
+    runs the log is `<log_path>.part` (follow it with `tail -f`).
     It warns on non-zero exit from the subprocess but does not raise an exception,
     as some submission scripts may exit non-zero on success.
     """
@@ -57,51 +106,400 @@ def run_and_tee(cmd, env=None):
         bufsize=1, # line-buffered
     )
 
-    stdout_lines = []
-    for line in proc.stdout:
-        sys.stdout.write(line)
-        stdout_lines.append(line)
+    jobid = None
+    with LogCapture(log_path, atomic=True) as log:
+        for line in proc.stdout:
+            log.write(line)
+            if jobid is None:
+                jobid = parse_jobid(line)
+        proc.wait()
 
-    proc.wait()
-    full_output = "".join(stdout_lines)
+        if proc.returncode != 0:
+            print(f"\nWarning: '{' '.join(cmd)}' exited with status {proc.returncode}", file=sys.stderr)
 
-    jobid = None
-    for line in full_output.splitlines():
-        if line.startswith("Job ID"):
-            try:
-                jobid = line.split(" ", 1)[1].split()[1]
+        if not jobid:
+            # Leaves the log at its .part path, so the run is not taken as done
+            raise RuntimeError("Could not find Job ID in psubmit output")
+
+    return [jobid, log.path]
+
+class Submission:
+    """
+    A psubmit.sh process running in the background.
+
+    psubmit prints 'Job ID <id>' as soon as the job is queued and then stays
+    alive until the job has finished and results.<id> is in place. The output
+    is drained by a thread into `log_path` (`<log_path>.part` until psubmit
+    exits) so the process never blocks on a full pipe; only a bounded tail is
+    kept in memory.
+    """
+
+    def __init__(self, cmd, log_path, env=None):
+        full_env = os.environ.copy()
+        if env:
+            full_env.update(env)
+        self.cmd = cmd
+        self.proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            env=full_env,
+            bufsize=1, # line-buffered
+        )
+        self.log = LogCapture(log_path, echo=False, atomic=True)
+        self.jobid = None
+        self._queued = threading.Event()
+        self._reader = threading.Thread(target=self._drain, daemon=True)
+        self._reader.start()
+
+    def _drain(self):
+        for line in self.proc.stdout:
+            self.log.write(line)
+            if self.jobid is None:
+                self.jobid = parse_jobid(line)
+                if self.jobid:
+                    self._queued.set()
+        self._queued.set()
+
+    def wait_queued(self):
+        """Block until psubmit has reported the job ID and return it."""
+        self._queued.wait()
+        if not self.jobid:
+            self.finish()
+            sys.stdout.write(self.log.tail())
+            raise RuntimeError("Could not find Job ID in psubmit output")
+        return self.jobid
+
+    def finish(self):
+        """Wait for psubmit to exit, close the log and return its path."""
+        self.proc.wait()
+        self._reader.join()
+        self.log.close()
+        if self.proc.returncode != 0:
+            print(f"\nWarning: '{' '.join(self.cmd)}' exited with status {self.proc.returncode}", file=sys.stderr)
+        return self.log.path
+
+#Section 3: Run Cache
+
+RUN_CACHE_FILENAME = "run_cache.json"
+
+def hash_file(path, h, chunk_size=1 << 20):
+    """Feed the contents of `path` into hash object `h` in chunks."""
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+
+def build_identity(subdir, build_info=None):
+    """
+    Return a digest identifying the build in `subdir`: the normalized
+    bundle_validation.json (if given) plus a checksum of every executable
+    below `subdir`. Returns None if no executable is found, since nothing
+    could then be said about the binary.
+    """
+    h = hashlib.sha256()
+    if build_info and os.path.isfile(build_info):
+        with open(build_info) as f:
+            h.update(json.dumps(json.load(f), sort_keys=True).encode())
+    elif build_info:
+        print(f"[WARN] build info {build_info} not found: keying run cache on binaries only")
+
+    found = False
+    for dirpath, dirnames, filenames in os.walk(subdir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                found = True
+                h.update(os.path.relpath(path, subdir).encode())
+                hash_file(path, h)
+    if not found:
+        print(f"[WARN] no executables found below {subdir}: run cache disabled")
+        return None
+    return h.hexdigest()
+
+def valid_fingerprint(fingerprint_path, subdirs):
+    """
+    Return the digest of the build fingerprint at `fingerprint_path` if it
+    still describes the build in `subdirs`, else None.
+
+    The fingerprint is written by `bundle_validator.py fingerprint`. It only
+    counts for the one sandbox it was computed for, and not if an executable
+    there changed since (checked by mtime, nothing is hashed).
+    """
+    if not fingerprint_path or len(subdirs) != 1:
+        return None
+    try:
+        with open(fingerprint_path) as f:
+            test = json.load(f)
+        written = os.path.getmtime(fingerprint_path)
+    except (OSError, ValueError):
+        return None
+    if not test.get("fingerprint"):
+        return None
+    subdir = os.path.realpath(subdirs[0])
+    if test.get("sandbox") != subdir:
+        print(f"[WARN] fingerprint {fingerprint_path} is for {test.get('sandbox')}, not {subdir}: ignoring it")
+        return None
+    for dirpath, dirnames, filenames in os.walk(subdir):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if os.access(path, os.X_OK) and os.path.isfile(path) and os.path.getmtime(path) > written:
+                print(f"[WARN] {path} changed after fingerprint {fingerprint_path} was written: ignoring it")
+                return None
+    return test["fingerprint"]
+
+def matching_fingerprint(fingerprint, ref_fingerprint_path):
+    """
+    Return `fingerprint` (a digest from valid_fingerprint()) if the reference
+    fingerprint written by `bundle_validator.py create-refs --sandbox` is the
+    same, i.e. the build under test is identical to the reference build,
+    else None.
+    """
+    if not (fingerprint and ref_fingerprint_path):
+        return None
+    try:
+        with open(ref_fingerprint_path) as f:
+            ref = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[FINGERPRINT] no usable reference fingerprint ({e}): the build is not checked against the reference")
+        return None
+    return fingerprint if ref.get("fingerprint") == fingerprint else None
+
+def run_cache_key(identity, run):
+    """Return the cache key of a run: its build identity and run parameters."""
+    params = {k: str(run[k]) for k in ("resolution", "nthreads", "ppn", "nnodes", "gpus", "nsteps")}
+    payload = json.dumps({"build": identity, "params": params}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def run_succeeded(run_logdir):
+    """True if run_logdir/results holds a result.*.yaml reporting success."""
+    try:
+        sections, _ = norms.read_result_yaml(norms.find_result_yaml(os.path.join(run_logdir, "results")))
+    except (norms.ResultFileError, OSError):
+        return False
+    return sections.get("execution.success") == "true"
+
+def cached_run(run_logdir, key):
+    """True if run_logdir holds successful results produced with cache key `key`."""
+    path = os.path.join(run_logdir, RUN_CACHE_FILENAME)
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return entry.get("key") == key and run_succeeded(run_logdir)
+
+def record_run(run, jobid):
+    """Store the cache key of a finished run next to its results, if it succeeded."""
+    if not run.get("cache_key") or not run_succeeded(run["run_logdir"]):
+        return
+    write_json_atomic(os.path.join(run["run_logdir"], RUN_CACHE_FILENAME), {
+        "key": run["cache_key"],
+        "jobid": jobid,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    })
+
+#Section 4: Run Index
+
+# Every output root holds an index of its runs, so that compare and listings
+# read one file instead of probing the run directories on GPFS
+RUN_INDEX_FILENAME = "run_index.json"
+RUN_INDEX_VERSION = 1
+
+def run_index_path(root):
+    return os.path.join(root, RUN_INDEX_FILENAME)
+
+def run_index_key(root, run_logdir):
+    """Return the index key of a run: its directory relative to the root."""
+    return os.path.relpath(run_logdir, root)
+
+def load_run_index(root):
+    """Return the runs of the index of `root` by key; empty if there is no index."""
+    try:
+        with open(run_index_path(root)) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if index.get("version") != RUN_INDEX_VERSION:
+        return {}
+    return index.get("runs", {})
+
+def update_run_index(root, entries):
+    """
+    Add or replace entries of the index of `root` ({key: entry}, None removes
+    the key). Several compare_norms processes may share a root, so the update
+    is made under a lock and the index replaced atomically.
+    """
+    ensure_dir(root)
+    with open(run_index_path(root) + ".lock", "a") as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        runs = load_run_index(root)
+        for key, entry in entries.items():
+            if entry is None:
+                runs.pop(key, None)
+            else:
+                runs[key] = entry
+        write_json_atomic(run_index_path(root), {"version": RUN_INDEX_VERSION, "runs": runs})
+
+def run_index_entry(root, run, jobid=None, status=None):
+    """
+    Return the index entry of `run` (a dict from iter_runs). Unless a status
+    is given, the result file in run_logdir/results is looked up and the
+    status is "completed" or "failed" from its execution.success, or
+    "no results".
+    """
+    result_file = checksum = None
+    if status is None:
+        status = "no results"
+        try:
+            path = norms.find_result_yaml(os.path.join(run["run_logdir"], "results"))
+            h = hashlib.sha256()
+            hash_file(path, h)
+            result_file, checksum = os.path.relpath(path, root), h.hexdigest()
+            status = "completed" if run_succeeded(run["run_logdir"]) else "failed"
+        except (norms.ResultFileError, OSError):
+            pass
+    return {
+        "subdir": os.path.basename(run["subdir"].rstrip(os.sep)),
+        "resolution": run["resolution"],
+        "nthreads": run["nthreads"],
+        "ppn": run["ppn"],
+        "nnodes": run["nnodes"],
+        "gpus": run["gpus"],
+        "nsteps": run["nsteps"],
+        "runtype": run["runtype"],
+        "jobid": jobid,
+        "result_file": result_file,
+        "checksum": checksum,
+        "cache_key": run.get("cache_key"),
+        "status": status,
+        "updated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+def index_run(root, run, jobid=None, status=None):
+    """Record `run` in the index of `root` (see run_index_entry())."""
+    update_run_index(root, {run_index_key(root, run["run_logdir"]): run_index_entry(root, run, jobid, status)})
+
+def indexed_result_valid(root, entry):
+    """True if the result file of an index entry still exists with its recorded checksum."""
+    if not entry.get("result_file"):
+        return False
+    path = os.path.join(root, entry["result_file"])
+    if not os.path.isfile(path):
+        return False
+    if entry.get("checksum"):
+        h = hashlib.sha256()
+        try:
+            hash_file(path, h)
+        except OSError:
+            return False
+        return h.hexdigest() == entry["checksum"]
+    return True
+
+def parse_run_dir(root, run_logdir):
+    """
+    Return the run parameters encoded in a run directory (see run_dir()),
+    or None if it does not follow that layout.
+    """
+    parts = run_index_key(root, run_logdir).split(os.sep)
+    if len(parts) not in (6, 7):
+        return None
+    run = {"subdir": parts[0], "resolution": parts[1], "gpus": 0}
+    for part in parts[2:]:
+        for name in ("nthreads", "ppn", "nnodes", "gpus", "nsteps"):
+            if part.startswith(name) and part != name:
+                run[name] = part[len(name):]
                 break
-            except IndexError:
-                pass # Ignore malformed "Job ID" lines
+        else:
+            return None
+    if not all(k in run for k in ("nthreads", "ppn", "nnodes", "nsteps")):
+        return None
+    for name in ("nthreads", "ppn", "nnodes", "gpus"):
+        try:
+            run[name] = int(run[name])
+        except ValueError:
+            return None
+    run["run_logdir"] = run_logdir
+    return run
+
+def rebuild_run_index(root):
+    """
+    Rebuild the index of `root` by walking its run directories once, e.g.
+    for roots created before the index existed. Returns the new runs.
+    """
+    runs = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        if "results" not in dirnames:
+            continue
+        run = parse_run_dir(root, dirpath)
+        if run is None:
+            continue
+        dirnames.remove("results")
+        run["runtype"] = next((name.split(".", 1)[0] for name in filenames
+                               if name.endswith(".log") and name.split(".", 1)[0] in ("ref", "test")), None)
+        jobid = None
+        try:
+            with open(os.path.join(dirpath, RUN_CACHE_FILENAME)) as f:
+                cache = json.load(f)
+            jobid, run["cache_key"] = cache.get("jobid"), cache.get("key")
+        except (OSError, ValueError):
+            pass
+        runs[run_index_key(root, dirpath)] = run_index_entry(root, run, jobid)
+    ensure_dir(root)
+    with open(run_index_path(root) + ".lock", "a") as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        write_json_atomic(run_index_path(root), {"version": RUN_INDEX_VERSION, "runs": runs})
+    return runs
 
-    if proc.returncode != 0:
-        print(f"\nWarning: '{' '.join(cmd)}' exited with status {proc.returncode}", file=sys.stderr)
+def list_runs(root, rebuild=False, json_output=False):
+    """Print the runs recorded in the index of `root`."""
+    runs = rebuild_run_index(root) if rebuild else load_run_index(root)
+    if json_output:
+        print(json.dumps(runs, indent=2))
+        return 0
+    if not runs:
+        print(f"No runs indexed in {run_index_path(root)} (use --rebuild for roots created before the index)")
+        return 0
+    for key in sorted(runs):
+        entry = runs[key]
+        print(f"{entry['status']:<11} {str(entry.get('jobid') or '-'):<10} {key}")
+    print(f"{len(runs)} run(s) in {run_index_path(root)}")
+    return 0
 
-    if not jobid:
-        raise RuntimeError("Could not find Job ID in psubmit output")
+#Section 5: Task Loops
 
-    return [jobid, full_output]
+def psubmit_command(subdir, nthreads, ppn, nnodes, gpus):
+    """Return the psubmit.sh command line for one run."""
+    return [
+        "psubmit.sh",
+        "-t", str(nthreads), "-p", str(ppn), "-n", str(nnodes),
+        "-u", subdir,
+        "-l", f"time={120}:ngpus={gpus}",
+    ]
 
-#Section 3: Task Loops
+def psubmit_env(res, nsteps):
+    """Return the extra environment psubmit.sh needs for one run."""
+    return {"RESOLUTION":res, "NSTEPS":str(nsteps), "PSUBMIT_OMIT_STACKTRACE_SCAN": "ON"}
 
-def create_runs(subdirs, root, resolutions, nthreads, ppn, nnodes, nsteps, gpus, runtype):
+def iter_runs(subdirs, root, resolutions, nthreads, ppn, nnodes, nsteps, gpus, runtype,
+              use_cache=False, build_info=None, identity=None):
     """
-    For each combination of subdir, res, nsteps, nnodes:
-      1) submits the job via run_and_tee()
-      2) moves results.<jobid> into the right spot under 'root'
+    Yield a dict describing each run of the parameter matrix that still has to
+    be submitted, creating its run directory on the way.
 
-    :param subdirs:      list of test names 
-    :param resolutions:  list of resolution strings
-    :param nthreads:     list of ints
-    :param ppn:          list of ints
-    :param nnodes:       list of ints
-    :param nsteps:       list of ints or strings
-    :param gpus:         list of ints
-    :param runtype:      "ref" or "test"
+    Earlier results of the test runs to submit are removed. With use_cache,
+    test runs whose directory already holds successful results for the same
+    build identity and parameters are skipped. Runs recorded as completed with the same cache
+    key in the run index of `root` are skipped if the indexed result file is
+    still there with its checksum; otherwise the run directory is checked
+    and the stale entry replaced or dropped.
+    The build identity of the cache key is `identity` (the digest of a valid
+    build fingerprint) if given, else computed by build_identity().
     """
-    if runtype not in ("ref", "test"):
-        raise ValueError("runtype must be 'ref' or 'test'")
-    
+    identities = {}
+    index = load_run_index(root[0]) if use_cache and runtype == "test" else {}
     for subdir, res, nthreads, ppn, nnodes, gpus, nsteps in itertools.product(
         subdirs,
         resolutions,
@@ -112,20 +510,8 @@ def create_runs(subdirs, root, resolutions, nthreads, ppn, nnodes, nsteps, gpus,
         nsteps
     ):
 
-        # Build path components, include gpus part only when non-zero
-        parts = [
-                root[0],
-                os.path.basename(subdir.rstrip(os.sep)),
-                str(res),
-                "nthreads"+str(nthreads),
-                "ppn"+str(ppn),
-                "nnodes"+str(nnodes),
-        ]
-        if gpus != 0:
-            parts.append("gpus"+str(gpus))
-        parts.append("nsteps"+str(nsteps))
-
-        run_logdir = os.path.join(*parts)
+        run_logdir = run_dir(root[0], os.path.basename(subdir.rstrip(os.sep)),
+                             res, nthreads, ppn, nnodes, gpus, nsteps)
 
         run_logfile = f"{runtype}.res={res}_nt={nthreads}_ppn={ppn}_nn={nnodes}_g={gpus}_nst={nsteps}.log"
 
@@ -137,80 +523,339 @@ def create_runs(subdirs, root, resolutions, nthreads, ppn, nnodes, nsteps, gpus,
             print(f"[SKIP] {run_logdir} already contains a run log and we are running {runtype} creation")
             continue
 
+        cache_key = None
+        if use_cache and runtype == "test":
+            if subdir not in identities:
+                identities[subdir] = identity or build_identity(subdir, build_info)
+            if identities[subdir]:
+                cache_key = run_cache_key(identities[subdir], {
+                    "resolution": res, "nthreads": nthreads, "ppn": ppn,
+                    "nnodes": nnodes, "gpus": gpus, "nsteps": nsteps,
+                })
+                entry = index.get(run_index_key(root[0], run_logdir))
+                if entry and entry["status"] == "completed" and entry.get("cache_key") == cache_key:
+                    if indexed_result_valid(root[0], entry):
+                        print(f"[CACHED] {run_logdir} already holds results for this build and configuration")
+                        continue
+                    print(f"[WARN] indexed result of {run_logdir} is missing or changed: checking the run directory")
+                if cached_run(run_logdir, cache_key):
+                    print(f"[CACHED] {run_logdir} already holds results for this build and configuration")
+                    index_run(root[0], dict(subdir=subdir, resolution=res, nthreads=nthreads, ppn=ppn, nnodes=nnodes,
+                                            gpus=gpus, nsteps=nsteps, runtype=runtype, run_logdir=run_logdir,
+                                            cache_key=cache_key))
+                    continue
+            if run_index_key(root[0], run_logdir) in index:
+                update_run_index(root[0], {run_index_key(root[0], run_logdir): None})
+        if runtype == "test":
+            # Results of an earlier run would be mixed with the new ones
+            stale = os.path.join(run_logdir, "results")
+            if os.path.isdir(stale):
+                print(f"Removing stale results {stale}")
+                shutil.rmtree(stale)
+
         print(f"Creating {run_logdir}")
         ensure_dir(run_logdir)
 
-        print(f"Running {runtype} {subdir}:  res={res} nthreads={nthreads} ppn={ppn} nnodes={nnodes} gpus={gpus} nsteps={nsteps}\n")
+        yield {
+            "subdir": subdir,
+            "resolution": res,
+            "nthreads": nthreads,
+            "ppn": ppn,
+            "nnodes": nnodes,
+            "gpus": gpus,
+            "nsteps": nsteps,
+            "runtype": runtype,
+            "run_logdir": run_logdir,
+            "run_logfile": run_logfilepath,
+            "cache_key": cache_key,
+        }
 
-        psubmit_cmd = [
-            "psubmit.sh",
-            "-t", str(nthreads), "-p", str(ppn), "-n", str(nnodes),
-            "-u", subdir,
-            "-l", f"time={120}:ngpus={gpus}",
-        ]
-        
-        run_jobid, ref_out = run_and_tee(psubmit_cmd,
-                                         env={"RESOLUTION":res, "NSTEPS":str(nsteps), "PSUBMIT_OMIT_STACKTRACE_SCAN": "ON"})
+def create_runs(subdirs, root, resolutions, nthreads, ppn, nnodes, nsteps, gpus, runtype, submit_all=False,
+                use_cache=False, build_info=None, fingerprint=None, ref_fingerprint=None):
+    """
+    For each combination of subdir, res, nsteps, nnodes:
+      1) submits the job via run_and_tee()
+      2) moves results.<jobid> into the right spot under 'root'
+      3) records the run in the run index of 'root'
+
+    With submit_all, every combination is submitted up front instead (see
+    submit_all_runs()).
+
+    :param subdirs:      list of test names 
+    :param resolutions:  list of resolution strings
+    :param nthreads:     list of ints
+    :param ppn:          list of ints
+    :param nnodes:       list of ints
+    :param nsteps:       list of ints or strings
+    :param gpus:         list of ints
+    :param runtype:      "ref" or "test"
+    :param submit_all:   submit all runs before waiting for any of them
+    :param use_cache:    skip test runs with cached results (see iter_runs())
+    :param build_info:   bundle_validation.json of the build, part of the cache key
+    :param fingerprint:  fingerprint JSON of the build under test; if valid it
+                         is the build identity of the run cache, and with
+                         ref_fingerprint no test run is made if the build is
+                         identical to the reference build
+    :return:             0 if every run completed, 1 otherwise (submit_all only)
+    """
+    if runtype not in ("ref", "test"):
+        raise ValueError("runtype must be 'ref' or 'test'")
+
+    identity = None
+    if runtype == "test" and (use_cache or ref_fingerprint):
+        identity = valid_fingerprint(fingerprint, subdirs)
+        if matching_fingerprint(identity, ref_fingerprint):
+            print(f"[FINGERPRINT] build {identity[:12]} is identical to the reference build: no test runs needed")
+            return 0
+
+    runs = iter_runs(subdirs, root, resolutions, nthreads, ppn, nnodes, nsteps, gpus, runtype,
+                     use_cache=use_cache, build_info=build_info, identity=identity)
+    if submit_all:
+        return submit_all_runs(runs, root, runtype)
+
+    for run in runs:
+        run_logdir = run["run_logdir"]
+        run_logfilepath = run["run_logfile"]
+
+        print(f"Running {runtype} {run['subdir']}:  res={run['resolution']} nthreads={run['nthreads']} ppn={run['ppn']} nnodes={run['nnodes']} gpus={run['gpus']} nsteps={run['nsteps']}\n")
+
+        psubmit_cmd = psubmit_command(run["subdir"], run["nthreads"], run["ppn"], run["nnodes"], run["gpus"])
         
-        ## Log ref output
-        print(f"Creating {run_logfilepath}")
-        with open(run_logfilepath, "w") as f:
-            f.write(ref_out)
+        print(f"Streaming output to {run_logfilepath}.part")
+        run_jobid, _ = run_and_tee(psubmit_cmd, run_logfilepath,
+                                   env=psubmit_env(run["resolution"], run["nsteps"]))
         print(f"output of {runtype} run {run_jobid} in {run_logfilepath}")
 
         ## Copy psubmit results to the run_logdir folder
         copy_results(run_jobid, run_logdir)
+        record_run(run, run_jobid)
+        index_run(root[0], run, run_jobid)
+    return 0
 
+def submit_all_runs(runs, root, runtype):
+    """
+    Submit every run up front and record the job IDs in
+    <root>/<runtype>_manifest.json and the run index, then wait for all jobs together and copy
+    the results of each one as soon as it finishes. The whole matrix then
+    costs roughly one queue wait instead of one per combination.
+    """
+    manifest_path = os.path.join(root[0], f"{runtype}_manifest.json")
+    ensure_dir(root[0])
+    manifest = {"runtype": runtype, "submitted": time.strftime("%Y-%m-%dT%H:%M:%S"), "runs": []}
+    submissions = {}
 
+    for run in runs:
+        print(f"Submitting {runtype} {run['subdir']}:  res={run['resolution']} nthreads={run['nthreads']} ppn={run['ppn']} nnodes={run['nnodes']} gpus={run['gpus']} nsteps={run['nsteps']}")
+        submission = Submission(psubmit_command(run["subdir"], run["nthreads"], run["ppn"], run["nnodes"], run["gpus"]),
+                                run["run_logfile"], env=psubmit_env(run["resolution"], run["nsteps"]))
+        jobid = submission.wait_queued()
+        print(f"  queued as job {jobid}")
 
-def compare(ref_subdir, test_subdirs, ref_root, test_root, resolutions, nthreads, ppn, nnodes, nsteps, gpus):
+        run["jobid"] = jobid
+        run["state"] = "PENDING"
+        manifest["runs"].append(run)
+        submissions[jobid] = (submission, run)
+        write_json_atomic(manifest_path, manifest)
+        index_run(root[0], run, jobid, status="submitted")
+
+    if not submissions:
+        print("Nothing to submit.")
+        return 0
+    print(f"Submitted {len(submissions)} {runtype} run(s), job IDs recorded in {manifest_path}")
+
+    watcher = JobWatcher()
+    for jobid in submissions:
+        watcher.add(jobid)
+
+    failed = 0
+    for jobid, state in watcher.iter_finished():
+        submission, run = submissions[jobid]
+        submission.finish()
+        run["state"] = state
+        print(f"output of {runtype} run {jobid} in {run['run_logfile']}")
+
+        if state != "COMPLETED":
+            failed += 1
+            print(f"[WARN] {runtype} run {jobid} ended in state {state}", file=sys.stderr)
+        if os.path.isdir(f"results.{jobid}"):
+            copy_results(jobid, run["run_logdir"])
+            record_run(run, jobid)
+            index_run(root[0], run, jobid)
+        else:
+            print(f"[WARN] results.{jobid} not found: nothing to copy", file=sys.stderr)
+            index_run(root[0], run, jobid, status=state.lower())
+        write_json_atomic(manifest_path, manifest)
+
+    print(f"{len(submissions) - failed}/{len(submissions)} {runtype} run(s) completed")
+    return 1 if failed else 0
+
+
+
+def find_pairs(ref_subdir, test_subdirs, ref_root, test_root, resolutions, nthreads, ppn, nnodes, nsteps, gpus):
     """
-    Iterating over the parameters:
-    - Run the reference branch test
-    - Capture the <test_jobid>; the test results are in results.<test_jobid>
-    - Compare norms with the reference results in `<root>/<ref_subdir>/...`
+    Find every reference/test result pair of the parameter matrix.
+
+    Runs are looked up in the run index of each root; the result directory is
+    only probed for runs the index does not know about (e.g. references
+    created before the index existed) or whose indexed result file is gone
+    (e.g. references restaged since, or a wiped tests tree). Such stale
+    entries are repaired from the result directory, or dropped.
+
+    Returns:
+        (pairs, skipped): pairs is a list of (config, ref_result, test_result),
+        each result being the result.*.yaml from the index or the results
+        directory, and skipped a list of configs whose reference or test
+        results are missing
     """
+    indexes = {ref_root[0]: load_run_index(ref_root[0]), test_root[0]: load_run_index(test_root[0])}
+    stale = {}
+
+    def lookup(root, subdir, kind, *params):
+        """Return the results of one run, or None (after a warning) if missing."""
+        logdir = run_dir(root, subdir, *params)
+        key = run_index_key(root, logdir)
+        entry = indexes[root].get(key)
+        if entry is not None:
+            if not entry.get("result_file"):
+                print(f"[WARN] {kind} run {logdir} is indexed as '{entry['status']}' without results: skipping")
+                return None
+            path = os.path.join(root, entry["result_file"])
+            if os.path.isfile(path):
+                return path
+            print(f"[WARN] indexed {kind} result {path} no longer exists: looking the run up again")
+        base = os.path.join(logdir, "results")
+        print(f"Expecting {kind} dir at {base}" + (" (not in the run index)" if entry is None else ""))
+        if not os.path.isdir(base):
+            print(f"[WARN] missing {kind} dir {base}: skipping")
+            if entry is not None:
+                stale.setdefault(root, {})[key] = None
+            return None
+        if entry is not None:
+            run = parse_run_dir(root, logdir)
+            if run is not None:
+                run["runtype"] = entry.get("runtype")
+            stale.setdefault(root, {})[key] = run_index_entry(root, run) if run is not None else None
+        return base
+
+    pairs = []
+    skipped = []
     for test in test_subdirs:
         for res, nthreads, ppn, nnodes, gpus, nsteps in itertools.product(resolutions, nthreads, ppn, nnodes, gpus, nsteps):
-            # Build reference path components, include gpus part only when non-zero
-            ref_parts = [
-                ref_root[0],
-                ref_subdir,
-                f"{res}",
-                f"nthreads{nthreads}",
-                f"ppn{ppn}",
-                f"nnodes{nnodes}",
-            ]
-            if gpus != 0:
-                ref_parts.append(f"gpus{gpus}")
-            ref_parts.append(f"nsteps{nsteps}")
-            base_ref = os.path.join(*ref_parts, "results")
-
-            print(f"Expecting reference dir at {base_ref}")
-            if not os.path.isdir(base_ref):
-                print(f"[WARN] missing reference dir {base_ref}: skipping")
+            config = {"test": test, "resolution": res, "nthreads": nthreads, "ppn": ppn,
+                      "nnodes": nnodes, "gpus": gpus, "nsteps": nsteps}
+            params = (res, nthreads, ppn, nnodes, gpus, nsteps)
+
+            base_ref = lookup(ref_root[0], ref_subdir, "reference", *params)
+            if base_ref is None:
+                skipped.append(dict(config, reason=f"missing reference results for {run_dir(ref_root[0], ref_subdir, *params)}"))
                 continue
 
-            # Build test path components, include gpus part only when non-zero
-            test_parts = [
-                test_root[0],
-                test,
-                f"{res}",
-                f"nthreads{nthreads}",
-                f"ppn{ppn}",
-                f"nnodes{nnodes}",
-            ]
-            if gpus != 0:
-                test_parts.append(f"gpus{gpus}")
-            test_parts.append(f"nsteps{nsteps}")
-            base_test = os.path.join(*test_parts, "results")
-
-            print(f"Expecting test dir at {base_test}")
-            if not os.path.isdir(base_test):
-                print(f"[WARN] missing test dir {base_test}: skipping")
+            base_test = lookup(test_root[0], test, "test", *params)
+            if base_test is None:
+                skipped.append(dict(config, reason=f"missing test results for {run_dir(test_root[0], test, *params)}"))
                 continue
 
-            compare_cmd = ["./compare.sh", base_ref, base_test]
+            pairs.append((config, base_ref, base_test))
+
+    for root, entries in stale.items():
+        try:
+            update_run_index(root, entries)
+            print(f"Updated {len(entries)} stale entr{'y' if len(entries) == 1 else 'ies'} of {run_index_path(root)}")
+        except OSError as e:
+            print(f"[WARN] could not update {run_index_path(root)}: {e}")
+    return pairs, skipped
+
+def compare_pairs(pairs, jobs=1, perf=None, norm_cache=True, tolerances=None, fail_fast=False):
+    """
+    Compare every (config, ref_dir, test_dir) pair, on a process pool when
+    there is more than one pair and more than one job. With `perf` (options
+    of norms.compare_timings) the timing sections are compared too. With
+    norm_cache the norms are loaded from (and saved to) the .norms.npz
+    sidecars of the result files. `tolerances` are the per-variable
+    tolerances of norms.compare_norm_sets(); with fail_fast each comparison
+    stops at its first step beyond tolerance, and no further pair is
+    compared after a failed one.
+
+    Returns:
+        List of comparison reports in the order of `pairs`, each with its
+        config; shorter than `pairs` if fail_fast stopped early
+    """
+    compare_dirs = partial(norms.compare_result_dirs, perf=perf, use_cache=norm_cache,
+                           tolerances=tolerances, fail_fast=fail_fast)
+    workers = min(jobs, len(pairs))
+    reports = []
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(compare_dirs, ref, test) for _, ref, test in pairs]
+            for future in futures:
+                reports.append(future.result())
+                if fail_fast and not reports[-1]["passed"]:
+                    for pending in futures:
+                        pending.cancel()
+                    break
+    else:
+        for _, ref, test in pairs:
+            reports.append(compare_dirs(ref, test))
+            if fail_fast and not reports[-1]["passed"]:
+                break
+    for (config, _, _), report in zip(pairs, reports):
+        report["config"] = config
+    return reports
+
+def compare(ref_subdir, test_subdirs, ref_root, test_root, resolutions, nthreads, ppn, nnodes, nsteps, gpus,
+            use_scripts=False, json_path=None, jobs=1, perf=None, fail_on_perf=False,
+            fingerprint=None, ref_fingerprint=None, norm_cache=True, tolerances=None, fail_fast=False):
+    """
+    Compare norms of every test run in the parameter matrix with the reference
+    results in `<root>/<ref_subdir>/...`.
+
+    All ref/test pairs are found up front and compared in-process on a pool of
+    `jobs` processes (see norms.py), then aggregated into a single report with
+    per-config pass/fail and metrics. With use_scripts, or if NumPy is
+    unavailable, compare.sh is run for each pair instead.
+    With `perf` (options of norms.compare_timings) the timing sections are
+    compared as well and the report gets "perf_passed"; performance
+    regressions only change the exit code with fail_on_perf.
+    If the fingerprints show that the build under test is identical to the
+    reference build, nothing is compared and the report says so.
+    Unless norm_cache is False, result files are loaded from their columnar
+    sidecars (see norms.load_result()).
+    A pair passes if every step of every variable is within `tolerances`
+    ({pattern: (abs, rel)}, bitwise equality by default). With fail_fast the
+    comparison stops at the first step beyond tolerance and the remaining
+    pairs are reported as skipped.
+    Returns 0 if every pair of the matrix was compared and matches, 1 if any
+    pair differs, 2 if none differs but some had no results to compare
+    (the report then has "incomplete" and is not "passed").
+    """
+    identical = matching_fingerprint(valid_fingerprint(fingerprint, test_subdirs) if ref_fingerprint else None,
+                                     ref_fingerprint)
+    if identical:
+        print(f"[FINGERPRINT] build {identical[:12]} is identical to the reference build: nothing to compare")
+        summary = {"passed": True, "compared": 0, "failed": 0, "skipped": [], "reports": [],
+                   "fingerprint_match": identical}
+        if json_path:
+            ensure_dir(os.path.dirname(os.path.abspath(json_path)))
+            write_json_atomic(json_path, summary)
+            print(f"Comparison report written to {json_path}")
+        else:
+            print(json.dumps(summary, indent=2))
+        return 0
+
+    if not use_scripts and norms.np is None:
+        print("[WARN] NumPy not available: falling back to compare.sh", file=sys.stderr)
+        use_scripts = True
+
+    pairs, skipped = find_pairs(ref_subdir, test_subdirs, ref_root, test_root,
+                                resolutions, nthreads, ppn, nnodes, nsteps, gpus)
+
+    if use_scripts:
+        if tolerances or fail_fast:
+            print("[WARN] compare.sh compares bitwise: --tolerance and --fail-fast are ignored", file=sys.stderr)
+        for _, base_ref, base_test in pairs:
+            # compare.sh takes result directories
+            compare_cmd = ["./compare.sh"] + [os.path.dirname(path) if path.endswith(".yaml") else path
+                                              for path in (base_ref, base_test)]
             result = subprocess.run(
                 compare_cmd,
                 capture_output=True,
@@ -219,9 +864,88 @@ def compare(ref_subdir, test_subdirs, ref_root, test_root, resolutions, nthreads
             print(f"\n>>> {compare_cmd[0]} exited {result.returncode}")
             print("stdout:", result.stdout)
             print("stderr:", result.stderr)
+        return 0
+
+    reports = compare_pairs(pairs, jobs, perf, norm_cache, tolerances, fail_fast)
+    for report in reports:
+        print(norms.format_report(report))
+    failed = sum(1 for report in reports if not report["passed"])
+    # Pairs skipped for missing results leave the comparison incomplete: the
+    # matrix cannot pass when part of it was never compared
+    incomplete = bool(skipped) or not reports
+    for config, _, _ in pairs[len(reports):]:
+        skipped.append(dict(config, reason="not compared: --fail-fast stopped at an earlier failure"))
+
+    first = next((dict(report["first_exceedance"], config=report["config"])
+                  for report in reports if report.get("first_exceedance")), None)
+    summary = {
+        "passed": failed == 0 and not incomplete,
+        "incomplete": incomplete,
+        "compared": len(reports),
+        "failed": failed,
+        "skipped": skipped,
+        "tolerances": {pattern: {"abs": a, "rel": r} for pattern, (a, r) in (tolerances or {}).items()},
+        "fail_fast": fail_fast,
+        "first_exceedance": first,
+        "reports": reports,
+    }
+    print(f"{len(reports) - failed}/{len(reports)} comparison(s) passed, {len(skipped)} skipped")
+    if incomplete and not failed:
+        print("[WARN] comparison incomplete: " + (f"{len(skipped)} configuration(s) without results"
+                                                    if skipped else "no configuration was compared"))
+    if first:
+        print(f"First step beyond tolerance: {first['variable']}[{first['step']}] of {first['config']['test']}")
+    perf_failed = 0
+    if perf is not None:
+        perf_failed = sum(1 for report in reports if report["perf"]["passed"] is False)
+        unchecked = sum(1 for report in reports if report["perf"]["passed"] is None)
+        summary["perf_passed"] = perf_failed == 0
+        summary["perf_failed"] = perf_failed
+        print(f"{perf_failed} performance regression(s), {unchecked} comparison(s) without timing")
+    if json_path:
+        ensure_dir(os.path.dirname(os.path.abspath(json_path)))
+        write_json_atomic(json_path, summary)
+        print(f"Comparison report written to {json_path}")
+    else:
+        print(json.dumps(summary, indent=2))
+    if failed or (fail_on_perf and perf_failed):
+        return 1
+    return 2 if incomplete else 0
 
 
-#Section 4: CLI Glue
+#Section 6: CLI Glue
+
+def perf_options(args):
+    """Options of norms.compare_timings from the compare arguments, None with --no-perf."""
+    if not args.perf:
+        return None
+    thresholds = {}
+    for spec in args.perf_metric_threshold:
+        pattern, sep, value = spec.rpartition("=")
+        if not sep or not pattern:
+            raise SystemExit(f"--perf-metric-threshold expects PATTERN=RATIO, got '{spec}'")
+        thresholds[pattern] = float(value)
+    return {
+        "threshold": args.perf_threshold,
+        "thresholds": thresholds,
+        "metrics": args.perf_metrics,
+        "min_seconds": args.perf_min_seconds,
+        "noise_sigmas": args.perf_noise_sigmas,
+    }
+
+def tolerance_options(args):
+    """Per-variable tolerances {pattern: (abs, rel)} from the --tolerance arguments."""
+    tolerances = {}
+    for spec in args.tolerance:
+        pattern, sep, values = spec.rpartition("=")
+        abs_tol, comma, rel_tol = values.partition(",")
+        try:
+            tolerances[pattern] = (float(abs_tol), float(rel_tol or 0.0))
+        except ValueError:
+            sep = ""
+        if not sep or not pattern:
+            raise SystemExit(f"--tolerance expects PATTERN=ABS[,REL], got '{spec}'")
+    return tolerances
 
 def parse_args():
     p = argparse.ArgumentParser(prog="compare_norms",
@@ -246,8 +970,11 @@ def parse_args():
                     help="Number of steps (can be string, e.g., 'd1')")
     p1.add_argument("--gpus", nargs="+", type=int, default=[0],
                     help="Number of gpus")
+    p1.add_argument("--submit-all", action="store_true",
+                    help="Submit every combination up front, then wait for all of them together")
     p1.set_defaults(func=lambda args: create_runs(
-        args.ref_subdirs, args.output_refdir, args.resolutions, args.nthreads, args.ppn, args.nnodes, args.nsteps, args.gpus, runtype="ref"
+        args.ref_subdirs, args.output_refdir, args.resolutions, args.nthreads, args.ppn, args.nnodes, args.nsteps, args.gpus, runtype="ref",
+        submit_all=args.submit_all
     ))
 
     # run tests
@@ -267,9 +994,21 @@ def parse_args():
                     help="Number of steps (can be string, e.g., 'd1')")
     p2.add_argument("--gpus", nargs="+", type=int, default=[0],
                     help="Number of gpus")
+    p2.add_argument("--submit-all", action="store_true",
+                    help="Submit every combination up front, then wait for all of them together")
+    p2.add_argument("--build-info",
+                    help="bundle_validation.json of the build under test, part of the run cache key")
+    p2.add_argument("--no-cache", dest="use_cache", action="store_false",
+                    help="Always resubmit test runs, ignoring run_cache.json and the run index")
+    p2.add_argument("--fingerprint",
+                    help="Fingerprint JSON of the build under test (bundle_validator.py fingerprint)")
+    p2.add_argument("--ref-fingerprint",
+                    help="Fingerprint JSON of the reference build; no test runs are made if it matches --fingerprint")
 
     p2.set_defaults(func=lambda args: create_runs(
-        args.test_subdirs, args.output_testdir, args.resolutions, args.nthreads, args.ppn, args.nnodes, args.nsteps, args.gpus, runtype="test"
+        args.test_subdirs, args.output_testdir, args.resolutions, args.nthreads, args.ppn, args.nnodes, args.nsteps, args.gpus, runtype="test",
+        submit_all=args.submit_all, use_cache=args.use_cache, build_info=args.build_info,
+        fingerprint=args.fingerprint, ref_fingerprint=args.ref_fingerprint
     ))
 
     # compare
@@ -293,17 +1032,62 @@ def parse_args():
                     help="Number of steps (can be string, e.g., 'd1')")
     p3.add_argument("--gpus", nargs="+", type=int, default=[0],
                     help="Number of gpus")
+    p3.add_argument("--use-scripts", action="store_true",
+                    help="Compare with compare.sh instead of the in-process comparator")
+    p3.add_argument("--json", dest="json_path",
+                    help="Write the comparison report to this JSON file (default: print it)")
+    p3.add_argument("-j", "--jobs", type=int, default=min(8, os.cpu_count() or 1),
+                    help="Number of processes comparing pairs in parallel")
+    p3.add_argument("--no-perf", dest="perf", action="store_false",
+                    help="Do not compare the timing sections")
+    p3.add_argument("--perf-threshold", type=float, default=norms.DEFAULT_PERF_THRESHOLD,
+                    help="Allowed relative slowdown of a timing metric (default: %(default)s)")
+    p3.add_argument("--perf-metric-threshold", action="append", default=[], metavar="PATTERN=RATIO",
+                    help="Allowed relative slowdown of the metrics matching PATTERN (repeatable)")
+    p3.add_argument("--perf-metrics", nargs="+", metavar="PATTERN",
+                    help="Only compare timing metrics matching these patterns")
+    p3.add_argument("--perf-min-seconds", type=float, default=1.0,
+                    help="Ignore slowdowns shorter than this many seconds (default: %(default)s)")
+    p3.add_argument("--perf-noise-sigmas", type=float, default=norms.DEFAULT_PERF_NOISE_SIGMAS,
+                    help="Slowdown required in standard errors when metrics have repeated samples (default: %(default)s)")
+    p3.add_argument("--fail-on-perf", action="store_true",
+                    help="Exit non-zero on performance regressions too")
+    p3.add_argument("--fingerprint",
+                    help="Fingerprint JSON of the build under test (bundle_validator.py fingerprint)")
+    p3.add_argument("--ref-fingerprint",
+                    help="Fingerprint JSON of the reference build; nothing is compared if it matches --fingerprint")
+    p3.add_argument("--tolerance", action="append", default=[], metavar="PATTERN=ABS[,REL]",
+                    help="Absolute and relative tolerance of the variables matching PATTERN: a step passes if "
+                         "|test - ref| <= ABS + REL * |ref| (repeatable, first match wins; default: bitwise)")
+    p3.add_argument("--fail-fast", action="store_true",
+                    help="Stop at the first step beyond tolerance and after the first failed pair")
+    p3.add_argument("--no-norm-cache", dest="norm_cache", action="store_false",
+                    help="Parse every result.*.yaml instead of using (and writing) its .norms.npz sidecar")
     p3.set_defaults(func=lambda args: compare(
         args.ref_subdir, args.test_subdirs,
         args.output_refdir, args.output_testdir,
-        args.resolutions, args.nthreads, args.ppn, args.nnodes, args.nsteps, args.gpus
+        args.resolutions, args.nthreads, args.ppn, args.nnodes, args.nsteps, args.gpus,
+        use_scripts=args.use_scripts, json_path=args.json_path, jobs=args.jobs,
+        perf=perf_options(args), fail_on_perf=args.fail_on_perf,
+        fingerprint=args.fingerprint, ref_fingerprint=args.ref_fingerprint,
+        norm_cache=args.norm_cache, tolerances=tolerance_options(args), fail_fast=args.fail_fast
     ))
 
+    # list
+    p4 = subs.add_parser("list", help="List the runs recorded in the run index of an output root")
+    p4.add_argument("-o", "--output-dir", required=True,
+                    help="Output root (the directory given with -og/-ot)")
+    p4.add_argument("--rebuild", action="store_true",
+                    help="Rebuild the index from the run directories first")
+    p4.add_argument("--json", dest="json_output", action="store_true",
+                    help="Print the index entries as JSON")
+    p4.set_defaults(func=lambda args: list_runs(args.output_dir, rebuild=args.rebuild, json_output=args.json_output))
+
     return p.parse_args()
 
 def main():
     args = parse_args()
-    args.func(args)
+    sys.exit(args.func(args) or 0)
 
 if __name__ == "__main__":
     main()
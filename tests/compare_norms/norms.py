@@ -0,0 +1,674 @@
+#!/usr/bin/env python3
+"""
+In-process norm comparison for compare_norms.
+
+Loads the `model:` section of a psubmit `result.*.yaml` once into NumPy arrays
+and compares reference and test norms (ssh_norm_max, U_norm_max, S_min, S_max,
+...) in vectorized form: absolute, relative and ULP differences, the L2 norm of
+the difference and the first divergent step of every variable.
+
+A comparison passes when every step of every variable is within its tolerance,
+|test - ref| <= abs + rel * |ref|, with per-variable tolerances chosen by
+pattern (bitwise equality by default). In fail-fast mode the steps are scanned
+in blocks and the comparison stops at the first step exceeding its tolerance.
+
+The `timing:` section is compared separately (compare_timings): every numeric
+timer is a metric where lower is better, and a test slower than the reference
+by more than the metric's threshold is a performance regression.
+
+The first load of a result file writes a columnar sidecar next to it,
+`result.<id>.norms.npz`: one uncompressed float64 member per variable (readable
+with np.load) plus the other values as JSON, keyed by the sha256 of the YAML. Later loads memory-map
+the arrays instead of parsing the text, which pays off for references compared
+against many test runs.
+
+Replaces the per-value gawk/bc forks of cmp.sh and compare.sh.
+"""
+import fnmatch
+import glob
+import hashlib
+import io
+import json
+import mmap
+import os
+import stat
+import struct
+import sys
+import tempfile
+import zipfile
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Sections of result.*.yaml delimiting the norms
+MODEL_SECTION = "model:"
+TIMING_SECTION = "timing:"
+
+# Sidecar of result.<id>.yaml holding its norms in columnar form
+NORM_CACHE_SUFFIX = ".norms.npz"
+NORM_CACHE_VERSION = 1
+NORM_CACHE_META = "meta.json"
+
+# Steps scanned at a time by the fail-fast comparison
+FAIL_FAST_BLOCK = 4096
+
+# Default allowed slowdown of a timing metric (0.10 = test may be 10% slower)
+DEFAULT_PERF_THRESHOLD = 0.10
+
+# A slowdown must also exceed this many standard errors of the medians when
+# a metric has repeated samples, so that noisy timers do not fail
+DEFAULT_PERF_NOISE_SIGMAS = 3.0
+
+# Scales the median absolute deviation to a standard deviation (normal data)
+MAD_TO_SIGMA = 1.4826
+
+
+class ResultFileError(Exception):
+    """Raised when a result directory or result.*.yaml cannot be used."""
+
+
+def require_numpy():
+    """Raise if NumPy is not available."""
+    if np is None:
+        raise ImportError("NumPy is required for the native norm comparison. Install with: pip install numpy")
+
+
+def find_result_yaml(result_dir):
+    """
+    Return the single result.*.yaml in `result_dir`. A path to the result file
+    itself (as recorded in the run index of compare_norms) is returned as-is.
+    """
+    if result_dir.endswith(".yaml"):
+        return result_dir
+    if not os.path.isdir(result_dir):
+        raise ResultFileError(f"{result_dir} does not exist")
+    matches = glob.glob(os.path.join(result_dir, "result.*.yaml"))
+    if len(matches) != 1:
+        raise ResultFileError(f"pattern {result_dir}/result.*.yaml doesn't give a single yaml-result file")
+    return matches[0]
+
+
+def _parse_value(raw):
+    """Split a flow-style '[ a, b, c ]' list into its items, or return the scalar."""
+    raw = raw.strip()
+    if raw.startswith("[") and raw.endswith("]"):
+        return [item.strip() for item in raw[1:-1].split(",") if item.strip()]
+    return raw.strip("\"'")
+
+
+def read_result_yaml(path):
+    """
+    Read the top-level scalars of each section and the norm arrays of the
+    `model:` section of a result.*.yaml.
+
+    Returns:
+        Tuple (sections, model) where sections maps "section.key" to the raw
+        scalar string, and model maps variable names to lists of raw strings
+        (arrays) or raw scalars.
+    """
+    sections = {}
+    model = {}
+    section = None
+    with open(path) as f:
+        for line in f:
+            stripped = line.rstrip("\n")
+            if not stripped.strip() or stripped.startswith("---"):
+                continue
+            if not stripped[0].isspace():
+                # A new top-level section, e.g. "model:"
+                section = stripped.strip().rstrip(":")
+                if stripped.strip() == TIMING_SECTION:
+                    # Norms end where timing starts; timing is parsed separately
+                    section = "timing"
+                continue
+            if ":" not in stripped:
+                continue
+            key, raw = stripped.strip().split(":", 1)
+            value = _parse_value(raw)
+            if section == "model":
+                model[key] = value
+            elif not isinstance(value, list):
+                sections[f"{section}.{key}"] = value
+    return sections, model
+
+
+def norm_cache_path(path):
+    """Return the sidecar of a result file: result.<id>.yaml -> result.<id>.norms.npz."""
+    return os.path.splitext(path)[0] + NORM_CACHE_SUFFIX
+
+
+def file_checksum(path):
+    """Return the sha256 of the file at `path`."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def write_norm_cache(path, checksum, sections, arrays, raw, timing):
+    """
+    Write the sidecar of the result file `path`: one stored (uncompressed)
+    .npy member per array, so that they can be memory-mapped, and the other
+    values as JSON. The file is replaced atomically since several compare
+    processes may load the same reference. Failures (e.g. a read-only
+    reference tree) are ignored.
+    """
+    meta = {"version": NORM_CACHE_VERSION, "checksum": checksum, "sections": sections,
+            "raw": raw, "timing": timing, "arrays": sorted(arrays)}
+    target = norm_cache_path(path)
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target) or ".", prefix=".tmp.")
+        try:
+            with os.fdopen(fd, "wb") as f, zipfile.ZipFile(f, "w", zipfile.ZIP_STORED) as zf:
+                for name in sorted(arrays):
+                    buf = io.BytesIO()
+                    np.lib.format.write_array(buf, np.ascontiguousarray(arrays[name], dtype=np.float64))
+                    zf.writestr(f"{name}.npy", buf.getvalue())
+                zf.writestr(NORM_CACHE_META, json.dumps(meta))
+            # mkstemp creates the file 0600: give it the permissions of the
+            # YAML so other users of a shared tree can read it
+            os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode))
+            os.replace(tmp, target)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    except OSError:
+        pass
+
+
+def read_norm_cache(path, checksum):
+    """
+    Return (meta, arrays) from the sidecar of the result file `path`, the
+    arrays memory-mapped, or None if there is no sidecar or it was not written
+    for `checksum`.
+    """
+    try:
+        with open(norm_cache_path(path), "rb") as f:
+            with zipfile.ZipFile(f) as zf:
+                meta = json.loads(zf.read(NORM_CACHE_META))
+                if meta.get("version") != NORM_CACHE_VERSION or meta.get("checksum") != checksum:
+                    return None
+                members = [zf.getinfo(f"{name}.npy") for name in meta["arrays"]]
+            if any(info.compress_type != zipfile.ZIP_STORED for info in members):
+                return None
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+
+    arrays = {}
+    try:
+        for name, info in zip(meta["arrays"], members):
+            # Data of a stored member follows its local header and the .npy header
+            name_len, extra_len = struct.unpack("<HH", buf[info.header_offset + 26:info.header_offset + 30])
+            start = info.header_offset + 30 + name_len + extra_len
+            f = io.BytesIO(buf[start:start + min(info.file_size, 1 << 16)])
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+            elif version == (2, 0):
+                shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+            else:
+                return None
+            if dtype != np.float64 or len(shape) != 1:
+                return None
+            arrays[name] = np.frombuffer(buf, dtype=np.float64, count=shape[0], offset=start + f.tell())
+    except (ValueError, struct.error):
+        return None
+    return meta, arrays
+
+
+def load_result(path, use_cache=True):
+    """
+    Load a result file into (sections, arrays, raw, timing): the scalars of
+    each section, the numeric model arrays as float64, the other model
+    values and the timers. With use_cache the sidecar is read if it matches
+    the checksum of `path`, and (re)written otherwise.
+    """
+    require_numpy()
+    checksum = None
+    if use_cache:
+        checksum = file_checksum(path)
+        cached = read_norm_cache(path, checksum)
+        if cached is not None:
+            meta, arrays = cached
+            return meta["sections"], arrays, meta["raw"], meta["timing"]
+
+    sections, model = read_result_yaml(path)
+    arrays = {}
+    for name, value in model.items():
+        if isinstance(value, list):
+            try:
+                arrays[name] = np.array(value, dtype=np.float64)
+            except ValueError:
+                pass  # non-numeric list, compared textually below
+    raw = {name: value for name, value in model.items() if name not in arrays}
+    timing = read_timing(path)
+    if use_cache:
+        write_norm_cache(path, checksum, sections, arrays, raw, timing)
+    return sections, arrays, raw, timing
+
+
+class NormSet:
+    """Norm arrays of one result directory."""
+
+    def __init__(self, path, sections, arrays, raw):
+        self.path = path
+        self.sections = sections
+        self.arrays = arrays
+        self.raw = raw
+
+    @property
+    def success(self):
+        return self.sections.get("execution.success", "") == "true"
+
+    @property
+    def last_step(self):
+        return self.raw.get("last_step")
+
+
+def load_norms(result_dir, use_cache=True):
+    """
+    Load the norms of `result_dir` into float64 arrays (see load_result()).
+
+    Returns:
+        NormSet with one array per numeric model variable
+    """
+    path = find_result_yaml(result_dir)
+    sections, arrays, raw, _ = load_result(path, use_cache)
+    return NormSet(path, sections, arrays, raw)
+
+
+def _ordered_bits(a):
+    """Map float64 values onto int64 so that adjacent floats differ by one."""
+    bits = a.view(np.int64)
+    return np.where(bits < 0, np.int64(np.iinfo(np.int64).min) - bits, bits)
+
+
+def variable_tolerance(name, tolerances):
+    """(abs, rel) tolerance of variable `name`: the first matching pattern of `tolerances`, else (0, 0)."""
+    for pattern, value in (tolerances or {}).items():
+        if fnmatch.fnmatchcase(name, pattern):
+            return value
+    return 0.0, 0.0
+
+
+def exceeds_tolerance(r, t, abs_tol, rel_tol):
+    """Boolean mask of the steps where `t` differs from `r` by more than abs_tol + rel_tol * |r|."""
+    equal = (r == t) | (np.isnan(r) & np.isnan(t))
+    with np.errstate(invalid="ignore"):
+        within = np.abs(r - t) <= abs_tol + rel_tol * np.abs(r)
+    return ~(equal | within)
+
+
+def first_exceeding_step(ref_arrays, test_arrays, tolerances=None, block=FAIL_FAST_BLOCK):
+    """
+    Scan the variables common to both sets block by block and stop at the
+    first step where one of them exceeds its tolerance. Only the blocks up
+    to that step are read, which matters for memory-mapped norms.
+
+    Returns:
+        (step, variable) of the first exceedance (earliest step, then
+        variable name), or None
+    """
+    names = sorted(set(ref_arrays) & set(test_arrays))
+    sizes = {name: min(ref_arrays[name].size, test_arrays[name].size) for name in names}
+    for start in range(0, max(sizes.values(), default=0), block):
+        hits = []
+        for name in names:
+            stop = min(start + block, sizes[name])
+            if stop <= start:
+                continue
+            mask = exceeds_tolerance(ref_arrays[name][start:stop], test_arrays[name][start:stop],
+                                     *variable_tolerance(name, tolerances))
+            steps = np.flatnonzero(mask)
+            if steps.size:
+                hits.append((start + int(steps[0]), name))
+        if hits:
+            return min(hits)
+    return None
+
+
+def compare_arrays(ref, test, abs_tol=0.0, rel_tol=0.0, limit=None):
+    """
+    Compare two float64 arrays step by step, the first `limit` steps only if
+    given.
+
+    Returns:
+        Dictionary of metrics for the variable
+    """
+    n = min(ref.size, test.size)
+    if limit is not None:
+        n = min(n, limit)
+    r, t = ref[:n], test[:n]
+    both_nan = np.isnan(r) & np.isnan(t)
+    equal = (r == t) | both_nan
+    with np.errstate(invalid="ignore"):
+        abs_diff = np.where(equal, 0.0, np.abs(r - t))
+    abs_diff = np.where(np.isnan(abs_diff), np.inf, abs_diff)
+    scale = np.abs(r)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rel_diff = np.where(abs_diff == 0.0, 0.0, abs_diff / scale)
+    ulp_diff = np.abs(_ordered_bits(r).astype(np.float64) - _ordered_bits(t).astype(np.float64))
+    ulp_diff = np.where(equal, 0.0, ulp_diff)
+
+    diverged = abs_diff != 0.0
+    divergent_steps = np.flatnonzero(diverged)
+    first = int(divergent_steps[0]) if divergent_steps.size else None
+    if ref.size != test.size and first is None and limit is None:
+        first = n
+    exceeding_steps = np.flatnonzero(exceeds_tolerance(r, t, abs_tol, rel_tol))
+    first_exceeding = int(exceeding_steps[0]) if exceeding_steps.size else None
+    if ref.size != test.size and first_exceeding is None and limit is None:
+        first_exceeding = n
+    finite = np.isfinite(abs_diff)
+
+    return {
+        "steps": int(n),
+        "length_mismatch": ref.size != test.size,
+        "identical": first is None,
+        "n_diffs": int(divergent_steps.size),
+        "first_divergent_step": first,
+        "abs_tol": abs_tol,
+        "rel_tol": rel_tol,
+        "n_exceeding": int(exceeding_steps.size),
+        "first_exceeding_step": first_exceeding,
+        "within_tolerance": first_exceeding is None,
+        "max_abs_diff": float(abs_diff.max()) if n else 0.0,
+        "max_rel_diff": float(rel_diff.max()) if n else 0.0,
+        "max_ulp_diff": float(ulp_diff.max()) if n else 0.0,
+        "l2_diff": float(np.sqrt(np.sum(abs_diff[finite] ** 2))) if n else 0.0,
+        "l2_ref": float(np.sqrt(np.nansum(r ** 2))) if n else 0.0,
+    }
+
+
+def compare_norm_sets(ref, test, tolerances=None, fail_fast=False):
+    """
+    Compare the norms of two loaded result directories.
+
+    Args:
+        ref, test: NormSets to compare
+        tolerances: {variable pattern: (abs, rel)}, first match wins;
+            variables matching no pattern must be bitwise identical
+        fail_fast: stop at the first step exceeding its tolerance, the
+            metrics then only cover the steps up to that one
+
+    Returns:
+        Report dictionary with per-variable metrics, the first divergence
+        and the first step exceeding the tolerance (earliest step, then
+        variable name) and an overall pass flag
+    """
+    errors = []
+    if not ref.success:
+        errors.append(f"In directory {ref.path}: execution result is not success")
+    if not test.success:
+        errors.append(f"In directory {test.path}: execution result is not success")
+    if ref.last_step != test.last_step:
+        errors.append(f"Not matching number of time steps: {ref.last_step} and {test.last_step}")
+
+    limit = None
+    if fail_fast:
+        stop = first_exceeding_step(ref.arrays, test.arrays, tolerances)
+        limit = stop[0] + 1 if stop else None
+
+    variables = {}
+    for name, ref_arr in ref.arrays.items():
+        if name not in test.arrays:
+            errors.append(f"Variable {name} missing from {test.path}")
+            continue
+        variables[name] = compare_arrays(ref_arr, test.arrays[name], *variable_tolerance(name, tolerances), limit=limit)
+    for name in test.arrays:
+        if name not in ref.arrays:
+            errors.append(f"Variable {name} missing from {ref.path}")
+
+    # Anything else in the model section (scalars, non-numeric lists) must match textually
+    for name, value in ref.raw.items():
+        if name in ref.arrays or name == "last_step":
+            continue
+        if test.raw.get(name) != value:
+            errors.append(f"{name}: '{value}' != '{test.raw.get(name)}'")
+
+    first = first_exceeding = None
+    for name, metrics in variables.items():
+        step = metrics["first_divergent_step"]
+        if step is not None and (first is None or (step, name) < (first["step"], first["variable"])):
+            first = {"step": step, "variable": name}
+        step = metrics["first_exceeding_step"]
+        if step is not None and (first_exceeding is None or (step, name) < (first_exceeding["step"], first_exceeding["variable"])):
+            first_exceeding = {"step": step, "variable": name}
+    if first_exceeding:
+        # Values at the first exceedance, to say exactly where and by how much
+        name, step = first_exceeding["variable"], first_exceeding["step"]
+        r, t = ref.arrays[name], test.arrays[name]
+        if step < min(r.size, t.size):
+            first_exceeding.update(ref=float(r[step]), test=float(t[step]), abs_diff=float(abs(r[step] - t[step])))
+
+    return {
+        "ref": ref.path,
+        "test": test.path,
+        "passed": not errors and first_exceeding is None,
+        "errors": errors,
+        "first_divergence": first,
+        "first_exceedance": first_exceeding,
+        "stopped_at_step": limit - 1 if limit else None,
+        "variables": variables,
+    }
+
+
+def compare_result_dirs(ref_dir, test_dir, perf=None, use_cache=True, tolerances=None, fail_fast=False):
+    """
+    Load and compare two result directories; errors are reported in the result.
+    With `perf` (options of compare_timings) the timers are compared as well,
+    under the "perf" key. use_cache is passed on to load_result(), tolerances
+    and fail_fast to compare_norm_sets().
+    """
+    try:
+        report = compare_norm_sets(load_norms(ref_dir, use_cache), load_norms(test_dir, use_cache),
+                                   tolerances, fail_fast)
+    except (ResultFileError, OSError) as e:
+        report = {"ref": ref_dir, "test": test_dir, "passed": False, "errors": [str(e)],
+                  "first_divergence": None, "first_exceedance": None, "stopped_at_step": None,
+                  "variables": {}}
+    if perf is not None:
+        report["perf"] = compare_timing_dirs([ref_dir], [test_dir], use_cache=use_cache, **perf)
+    return report
+
+
+def read_timing(path):
+    """
+    Read the numeric timers of the `timing:` section of a result.*.yaml.
+
+    Nested mappings give dotted names, e.g. "steps.mean". Lists are kept as
+    samples of the metric (e.g. per-step or repeated timings).
+
+    Returns:
+        Dictionary mapping metric names to lists of floats
+    """
+    timing = {}
+    parents = []  # (indent, key) of the enclosing mappings
+    in_timing = False
+    with open(path) as f:
+        for line in f:
+            stripped = line.rstrip("\n")
+            if not stripped.strip() or stripped.startswith("---") or stripped.lstrip().startswith("#"):
+                continue
+            if not stripped[0].isspace():
+                in_timing = stripped.strip() == TIMING_SECTION
+                parents = []
+                continue
+            if not in_timing or ":" not in stripped:
+                continue
+            indent = len(stripped) - len(stripped.lstrip())
+            while parents and parents[-1][0] >= indent:
+                parents.pop()
+            key, raw = stripped.strip().split(":", 1)
+            if not raw.strip():
+                parents.append((indent, key))
+                continue
+            value = _parse_value(raw)
+            try:
+                samples = [float(v) for v in (value if isinstance(value, list) else [value])]
+            except ValueError:
+                continue  # e.g. units or host names
+            if samples:
+                timing[".".join([k for _, k in parents] + [key])] = samples
+    return timing
+
+
+def load_timings(result_dirs, use_cache=True):
+    """
+    Pool the timers of one or more result directories (repeats of one run).
+
+    Returns:
+        Dictionary mapping metric names to float64 arrays of samples
+    """
+    require_numpy()
+    pooled = {}
+    for result_dir in result_dirs:
+        path = find_result_yaml(result_dir)
+        timing = load_result(path)[3] if use_cache else read_timing(path)
+        for name, samples in timing.items():
+            pooled.setdefault(name, []).extend(samples)
+    return {name: np.array(samples, dtype=np.float64) for name, samples in pooled.items()}
+
+
+def _median_stderr(samples):
+    """Robust standard error of the median; 0 with fewer than three samples."""
+    if samples.size < 3:
+        return 0.0
+    mad = np.median(np.abs(samples - np.median(samples))) * MAD_TO_SIGMA
+    # The median's standard error is sqrt(pi/2) times that of the mean
+    return float(1.2533 * mad / np.sqrt(samples.size))
+
+
+def metric_threshold(name, threshold, thresholds):
+    """Threshold of metric `name`: the first matching pattern of `thresholds`, else `threshold`."""
+    for pattern, value in (thresholds or {}).items():
+        if fnmatch.fnmatchcase(name, pattern):
+            return value
+    return threshold
+
+
+def compare_timings(ref, test, threshold=DEFAULT_PERF_THRESHOLD, thresholds=None, metrics=None,
+                    min_seconds=0.0, noise_sigmas=DEFAULT_PERF_NOISE_SIGMAS):
+    """
+    Compare the timers of a reference and a test run.
+
+    Each metric is summarized by the median of its samples. A metric regresses
+    when the test median exceeds the reference median by more than its
+    threshold (relative), by more than `min_seconds`, and, when there are
+    repeated samples, by more than `noise_sigmas` standard errors.
+
+    Args:
+        ref: Reference timers from load_timings
+        test: Test timers from load_timings
+        threshold: Default allowed relative slowdown
+        thresholds: {metric name pattern: allowed relative slowdown}
+        metrics: Only compare metrics matching one of these patterns
+        min_seconds: Ignore slowdowns smaller than this (absolute)
+        noise_sigmas: Required slowdown in standard errors of the medians
+
+    Returns:
+        Dictionary with the per-metric statistics, the regressed metrics and
+        an overall pass flag
+    """
+    results = {}
+    regressions = []
+    for name in sorted(set(ref) & set(test)):
+        if metrics and not any(fnmatch.fnmatchcase(name, pattern) for pattern in metrics):
+            continue
+        r, t = ref[name], test[name]
+        ref_median, test_median = float(np.median(r)), float(np.median(t))
+        delta = test_median - ref_median
+        noise = float(np.hypot(_median_stderr(r), _median_stderr(t)))
+        limit = metric_threshold(name, threshold, thresholds)
+        ratio = test_median / ref_median if ref_median > 0 else None
+        regressed = (ratio is not None and ratio > 1.0 + limit
+                     and delta > min_seconds and delta > noise_sigmas * noise)
+        results[name] = {
+            "ref": ref_median,
+            "test": test_median,
+            "ratio": ratio,
+            "threshold": limit,
+            "ref_samples": int(r.size),
+            "test_samples": int(t.size),
+            "noise": noise,
+            "regressed": bool(regressed),
+        }
+        if regressed:
+            regressions.append(name)
+    return {
+        "passed": not regressions,
+        "regressions": regressions,
+        "missing": sorted(set(ref) - set(test)),
+        "metrics": results,
+    }
+
+
+def compare_timing_dirs(ref_dirs, test_dirs, use_cache=True, **options):
+    """
+    Load and compare the timers of two runs. Without timers to compare (e.g.
+    references written before timing was recorded) "passed" is None.
+    """
+    try:
+        report = compare_timings(load_timings(ref_dirs, use_cache), load_timings(test_dirs, use_cache), **options)
+    except (ResultFileError, OSError) as e:
+        return {"passed": None, "regressions": [], "missing": [], "metrics": {}, "error": str(e)}
+    if not report["metrics"]:
+        report.update(passed=None, error="no common timing metrics")
+    return report
+
+
+def format_report(report):
+    """Render a comparison report as human-readable text."""
+    lines = [f"ref:  {report['ref']}", f"test: {report['test']}"]
+    for error in report["errors"]:
+        lines.append(f"  ERROR: {error}")
+    for name, m in report["variables"].items():
+        if m["identical"]:
+            lines.append(f"  {name}: identical ({m['steps']} steps)")
+        else:
+            tolerance = ""
+            if m["abs_tol"] or m["rel_tol"]:
+                tolerance = (f", {m['n_exceeding']} beyond tolerance (abs {m['abs_tol']:g}, rel {m['rel_tol']:g})"
+                             if not m["within_tolerance"] else f", within tolerance (abs {m['abs_tol']:g}, rel {m['rel_tol']:g})")
+            lines.append(
+                f"  {name}: DIFF in {m['n_diffs']}/{m['steps']} steps from step {m['first_divergent_step']}: "
+                f"max abs {m['max_abs_diff']:.6e}, max rel {m['max_rel_diff']:.6e}, "
+                f"max ulp {m['max_ulp_diff']:.0f}, L_2 {m['l2_diff']:.6e}{tolerance}"
+            )
+    first = report["first_divergence"]
+    if first:
+        lines.append(f"  first divergence: {first['variable']}[{first['step']}]")
+    first = report.get("first_exceedance")
+    if first and "ref" in first:
+        lines.append(f"  first step beyond tolerance: {first['variable']}[{first['step']}] "
+                     f"{first['ref']!r} -> {first['test']!r} (abs diff {first['abs_diff']:.6e})")
+    elif first:
+        lines.append(f"  first step beyond tolerance: {first['variable']}[{first['step']}] (length mismatch)")
+    if report.get("stopped_at_step") is not None:
+        lines.append(f"  stopped at step {report['stopped_at_step']} (fail-fast)")
+    lines.append("  PASSED" if report["passed"] else "  FAILED")
+    perf = report.get("perf")
+    if perf:
+        if perf.get("error"):
+            lines.append(f"  timing: {perf['error']}")
+        for name, m in perf["metrics"].items():
+            ratio = f"x{m['ratio']:.3f}" if m["ratio"] is not None else "n/a"
+            state = "REGRESSION" if m["regressed"] else "ok"
+            lines.append(f"  timing {name}: {m['ref']:.3f} -> {m['test']:.3f} ({ratio}, "
+                         f"limit x{1 + m['threshold']:.2f}) {state}")
+        if perf["passed"] is not None:
+            lines.append("  PERF PASSED" if perf["passed"] else "  PERF FAILED")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("FATAL: Two result directory names are required as args", file=sys.stderr)
+        sys.exit(2)
+    result = compare_result_dirs(sys.argv[1], sys.argv[2])
+    print(json.dumps(result, indent=2))
+    sys.exit(0 if result["passed"] else 1)
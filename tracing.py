@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Stage timing spans for pipeline runs.
+
+Every stage of a pipeline run (reference clone, bundle download, sync, build
+queue wait and run time, install, each suite command) is recorded as a span
+with its wall-clock start and end. At the end of the run the spans are written
+to the results directory as a plain JSON summary and as a Chrome trace that
+can be opened in chrome://tracing or https://ui.perfetto.dev.
+
+A single module-level tracer is shared by pipeline.py and test_runner.py:
+
+    from tracing import tracer
+    with tracer.span("dnb.sh :du", "network"):
+        ...
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+TIMINGS_FILENAME = "timings.json"
+TRACE_FILENAME = "trace.json"
+
+
+class Tracer:
+    """Thread-safe collector of timing spans."""
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name: str, category: str, start: float, end: float, status: str = "ok",
+            thread: str = None, **args) -> None:
+        """
+        Record a span with explicit start and end times.
+
+        Args:
+            name: Name of the span, e.g. "dnb.sh :i"
+            category: Kind of work: "local", "network", "queue", "compute", "remote" or "suite"
+            start: Start time (seconds since the epoch)
+            end: End time (seconds since the epoch)
+            status: "ok" or "error"
+            thread: Track of the span (default: the name of the current thread)
+            **args: Extra details shown with the span (job ID, test ID, ...)
+        """
+        with self._lock:
+            self.spans.append({
+                "name": name,
+                "category": category,
+                "start": start,
+                "end": end,
+                "seconds": end - start,
+                "thread": thread or threading.current_thread().name,
+                "status": status,
+                "args": args,
+            })
+
+    @contextmanager
+    def span(self, name: str, category: str, **args):
+        """Time the enclosed block; the span is recorded even if it raises."""
+        start = time.time()
+        status = "ok"
+        try:
+            yield args
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            self.add(name, category, start, time.time(), status, **args)
+
+    def load(self, run_dir: Path) -> None:
+        """Prepend the spans of an earlier attempt of the run in `run_dir`, if any."""
+        path = Path(run_dir) / TIMINGS_FILENAME
+        if path.exists():
+            with open(path) as f:
+                previous = json.load(f).get("spans", [])
+            with self._lock:
+                self.spans[:0] = previous
+
+    def summary(self) -> dict:
+        """Total seconds per category."""
+        totals = {}
+        for span in self.spans:
+            totals[span["category"]] = totals.get(span["category"], 0.0) + span["seconds"]
+        return totals
+
+    def chrome_trace(self) -> dict:
+        """Return the spans in Chrome trace event format (one track per thread)."""
+        origin = min((s["start"] for s in self.spans), default=0.0)
+        tids = {}
+        events = []
+        for span in sorted(self.spans, key=lambda s: s["start"]):
+            tid = tids.setdefault(span["thread"], len(tids) + 1)
+            events.append({
+                "name": span["name"],
+                "cat": span["category"],
+                "ph": "X",
+                "ts": (span["start"] - origin) * 1e6,
+                "dur": span["seconds"] * 1e6,
+                "pid": 1,
+                "tid": tid,
+                "args": dict(span["args"], status=span["status"]),
+            })
+        for thread, tid in tids.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": thread}})
+        events.append({"name": "process_name", "ph": "M", "pid": 1, "args": {"name": "pipeline"}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, run_dir: Path) -> None:
+        """Write timings.json and trace.json to `run_dir`."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s["start"])
+        timings = {"summary": self.summary(), "spans": spans}
+        for filename, data in ((TIMINGS_FILENAME, timings), (TRACE_FILENAME, self.chrome_trace())):
+            path = Path(run_dir) / filename
+            tmp = path.with_suffix(".tmp")
+            with open(tmp, "w") as f:
+                json.dump(data, f, indent=4)
+            os.replace(tmp, path)
+
+    def print_summary(self) -> None:
+        """Print the wall-clock seconds spent per category."""
+        totals = self.summary()
+        if totals:
+            print("Time by category: " + ", ".join(f"{c} {s:.1f}s" for c, s in sorted(totals.items())))
+
+
+# Shared by every module of a pipeline run
+tracer = Tracer()